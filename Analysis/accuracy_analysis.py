@@ -27,6 +27,97 @@ shunt_vals_ohms[5] = 100.0
 shunt_vals_ohms[6] = 12.76666
 shunt_vals_ohms[7] = 7.66
 
+# Firmware stage limits (set_current_level() in main.c), in mA. Entry i is
+# the upper limit of shunt_vals_ohms[i].
+stage_limits_ma = np.array([250.0 * 1.0e-6, 0.002, 0.02, 0.2, 2.0, 20.0, 190.0, 326.0])
+
+# Monte Carlo tolerance analysis. Every component error is drawn uniformly
+# within its tolerance, once per simulated board (shunts once per stage),
+# and the current error is evaluated over a dense grid of setpoints.
+# Boards are processed in chunks of about mc_chunk_elements board x
+# setpoint values so memory stays bounded however many are drawn; the
+# errors are accumulated into per-setpoint histograms of mc_num_bins bins
+# spanning the worst case, and percentiles are read back from those.
+mc_num_boards = 1000000
+mc_num_currents = 200
+mc_chunk_elements = 4000000
+mc_num_bins = 4000
+mc_percentiles = np.array([0.1, 2.5, 50.0, 97.5, 99.9])
+mc_seed = 0
+
+def mc_draw(rng, n, fixed_ref):
+    # Component errors for n boards: (gain, offset_v, shunt_scale, r_fet).
+    # The reference error is the fixed reference's accuracy or the DAC's
+    # total unadjusted error, applied ahead of the AD8276.
+    def uniform(tol):
+        return rng.uniform(-tol, tol, n).astype(np.float32)
+    gain = 1.0 + uniform(ad8276_gain_error_percent * 0.01)
+    if fixed_ref:
+        ref_gain = 1.0 + uniform(fixed_ref_accuracy_percent * 0.01)
+        ref_offset_v = np.zeros(n, dtype=np.float32)
+    else:
+        ref_gain = np.ones(n, dtype=np.float32)
+        ref_offset_v = uniform(dac_tue_fsr_percent * 0.01 * variable_reference_voltage_max)
+    offset_v = gain * ref_offset_v + uniform(ad8603_offset_voltages) + uniform(ad8276_offset_voltage)
+    shunt_scale = 1.0 + rng.uniform(-shunt_accuracy_percent * 0.01, shunt_accuracy_percent * 0.01, (n, 8)).astype(np.float32)
+    r_fet = r_fet_assumed_ohm + uniform(r_fet_variability_ohm)
+    return (gain * ref_gain, offset_v, shunt_scale, r_fet)
+
+def mc_errors_percent(ref_v, stage, draws):
+    # Error of the current at each (board, setpoint), shape (boards, setpoints)
+    (gain, offset_v, shunt_scale, r_fet) = draws
+    current = (gain[:, None] * ref_v + offset_v[:, None]) / (shunt_scale[:, stage] * shunt_vals_ohms[stage].astype(np.float32) + r_fet[:, None])
+    nominal = (ref_v / (shunt_vals_ohms[stage] + r_fet_assumed_ohm)).astype(np.float32)
+    return 100.0 * (current / nominal - 1.0)
+
+def mc_worst_case_percent(ref_v, stage, fixed_ref):
+    # Largest error magnitude over every corner of the tolerance box, which
+    # bounds the histograms since the error is monotonic in each component
+    # One column per error term: amp gain, reference, two offsets, shunt
+    # and FET resistance
+    num_terms = 6
+    corners = np.array(np.meshgrid(*[[-1.0, 1.0]] * num_terms)).reshape(num_terms, -1).T
+    n = len(corners)
+    gain = 1.0 + corners[:, 0] * ad8276_gain_error_percent * 0.01
+    if fixed_ref:
+        gain = gain * (1.0 + corners[:, 1] * fixed_ref_accuracy_percent * 0.01)
+        ref_offset_v = np.zeros(n)
+    else:
+        ref_offset_v = corners[:, 1] * dac_tue_fsr_percent * 0.01 * variable_reference_voltage_max
+    offset_v = gain * ref_offset_v + corners[:, 2] * ad8603_offset_voltages + corners[:, 3] * ad8276_offset_voltage
+    shunt_scale = np.repeat(1.0 + corners[:, 4:5] * shunt_accuracy_percent * 0.01, 8, axis=1)
+    r_fet = r_fet_assumed_ohm + corners[:, 5] * r_fet_variability_ohm
+    draws = (gain.astype(np.float32), offset_v.astype(np.float32), shunt_scale.astype(np.float32), r_fet.astype(np.float32))
+    return np.max(np.abs(mc_errors_percent(ref_v, stage, draws)), axis=0)
+
+def monte_carlo(ref_v, stage, fixed_ref, num_boards, seed=None):
+    # Percentiles (len(mc_percentiles), setpoints) of the current error in
+    # percent at each setpoint, given its reference voltage and stage
+    rng = np.random.default_rng(seed)
+    ref_v = np.asarray(ref_v, dtype=np.float32)
+    num_currents = len(ref_v)
+    bound = 1.01 * mc_worst_case_percent(ref_v, stage, fixed_ref)
+    bin_width = (2.0 * bound / mc_num_bins).astype(np.float32)
+    row_offset = np.arange(num_currents) * mc_num_bins
+    counts = np.zeros(num_currents * mc_num_bins, dtype=np.int64)
+
+    chunk = max(1, mc_chunk_elements // num_currents)
+    for start in range(0, num_boards, chunk):
+        n = min(chunk, num_boards - start)
+        errors = mc_errors_percent(ref_v, stage, mc_draw(rng, n, fixed_ref))
+        bins = ((errors + bound) / bin_width).astype(np.int64)
+        np.clip(bins, 0, mc_num_bins - 1, out=bins)
+        bins += row_offset
+        counts += np.bincount(bins.ravel(), minlength=len(counts))
+
+    # Percentiles by interpolating within bins of the cumulative histogram
+    cdf = np.cumsum(counts.reshape(num_currents, mc_num_bins), axis=1) / num_boards
+    edges = -bound[:, None] + bin_width[:, None] * np.arange(1, mc_num_bins + 1)
+    result = np.empty((len(mc_percentiles), num_currents))
+    for j in range(num_currents):
+        result[:, j] = np.interp(mc_percentiles * 0.01, np.concatenate(([0.0], cdf[j])), np.concatenate(([-bound[j]], edges[j])))
+    return result
+
 # Fixed reference analysis
 fr_perfect_current_levels = np.zeros(8)
 for i in range(8):
@@ -53,6 +144,23 @@ for i in range(8):
         ar_errors_percent[i,j] = 100.0 * (ar_perfect_current_levels[i,j] - ar_worst_case_current_levels[i,j]) / ar_perfect_current_levels[i,j]
         print("Adjustable voltage reference shunt level {0}, V level {1}, error is {2:.3f} percent, current is {3:.5f} mA".format(i, j, ar_errors_percent[i,j], ar_perfect_current_levels[i,j]*1000.0))
 
+# Monte Carlo over a dense grid of adjustable reference setpoints, with
+# each current on the stage the firmware would pick
+mc_currents_a = np.geomspace(1.0e-9, 0.3, mc_num_currents)
+mc_stage = np.searchsorted(stage_limits_ma, mc_currents_a * 1000.0, side='right')
+mc_ref_v = mc_currents_a * (shunt_vals_ohms[mc_stage] + r_fet_assumed_ohm)
+mc_ok = mc_ref_v <= variable_reference_voltage_max
+mc_currents_a = mc_currents_a[mc_ok]
+mc_stage = mc_stage[mc_ok]
+mc_ref_v = mc_ref_v[mc_ok]
+ar_mc_percentiles = monte_carlo(mc_ref_v, mc_stage, False, mc_num_boards, seed=mc_seed)
+fr_mc_percentiles = monte_carlo(np.full(8, fixed_ref_voltage), np.arange(8), True, mc_num_boards, seed=mc_seed)
+mc_percentile_names = ", ".join("{0:g}%".format(p) for p in mc_percentiles)
+for i in range(8):
+    print("Fixed voltage reference level {0}, error percentiles ({1}) are {2} percent".format(i, mc_percentile_names, ", ".join("{0:.4f}".format(e) for e in fr_mc_percentiles[:, i])))
+for j in range(0, len(mc_currents_a), max(1, len(mc_currents_a) // 20)):
+    print("Adjustable reference at {0:.6g} mA, error percentiles ({1}) are {2} percent".format(mc_currents_a[j]*1000.0, mc_percentile_names, ", ".join("{0:.4f}".format(e) for e in ar_mc_percentiles[:, j])))
+
 ar_perfect_currents_flattened = ar_perfect_current_levels.flatten()
 ar_errors_percent_flattened = ar_errors_percent.flatten()
 sort_idx = np.argsort(ar_perfect_currents_flattened)
@@ -67,5 +175,17 @@ ax.legend()
 ax.minorticks_on()
 ax.grid(which='both')
 
+fig, ax = plt.subplots()
+ax.fill_between(mc_currents_a, ar_mc_percentiles[0], ar_mc_percentiles[-1], alpha=0.2, label='Adjustable Reference {0}-{1}%'.format(mc_percentiles[0], mc_percentiles[-1]))
+ax.fill_between(mc_currents_a, ar_mc_percentiles[1], ar_mc_percentiles[-2], alpha=0.4, label='Adjustable Reference {0}-{1}%'.format(mc_percentiles[1], mc_percentiles[-2]))
+ax.semilogx(mc_currents_a, ar_mc_percentiles[2], '-', label='Adjustable Reference Median')
+ax.errorbar(fr_perfect_current_levels, fr_mc_percentiles[2], yerr=[fr_mc_percentiles[2] - fr_mc_percentiles[0], fr_mc_percentiles[-1] - fr_mc_percentiles[2]], fmt='.', label='Fixed Reference')
+
+ax.set(xlabel='Current Supply, A', ylabel='Error, %',
+       title='High Dynamic Range Current Supply Error Distribution ({0} boards)'.format(mc_num_boards))
+ax.legend()
+ax.minorticks_on()
+ax.grid(which='both')
+
 
 plt.show()
\ No newline at end of file
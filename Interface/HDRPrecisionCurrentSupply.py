@@ -1,10 +1,18 @@
-
-import serial
+import collections
 import time 
 import struct 
-import serial.tools.list_ports
+import serial_protocol as sp
+import device_discovery as dd
+from instrumentation import Instrumentation
 from enum import Enum
 
+# USB IDs the device enumerates with
+USB_VID = 1155
+USB_PID = 100
+
+def list_serial_numbers():
+    return dd.default_index.serial_numbers(USB_VID, USB_PID)
+
 class CurrentSupplyType(Enum):
     FIXED_REFERENCE = 1
     ADJUSTABLE_REFERENCE = 2
@@ -13,111 +21,199 @@ class HDRPrecisionCurrentSupply:
     def __init__(self, supply_type : CurrentSupplyType):
         self.supply_type = supply_type
         self.ser = None
+        self.decoder = sp.FrameDecoder()
+        self.encoder = sp.FrameEncoder()
+        # Protocol counters and latencies; see instrumentation.snapshot()
+        self.instrumentation = Instrumentation("HDR Current Supply")
+        # Host time.time() stamps of confirmed commands: last_command_time
+        # is (sent, replied) for the latest, and command_log keeps
+        # (sent, replied, msg_type, value, reported_ma) for recent ones
+        self.last_command_time = None
+        self.command_log = collections.deque(maxlen=10000)
+        # USB serial number of the connected device. If it drops off the bus
+        # the next command or read reopens it, for up to reconnect_timeout
+        # seconds, and puts back the last confirmed command (last_frame).
+        self.serial_number = None
+        self.auto_reconnect = True
+        self.reconnect_timeout = 5.0
+        self.last_frame = None
 
     def get_packet(self, start_time, timeout):
-        step = 0
-        count = 0
-        msg_type = 0
-        length = 0
-        chk = 0
-        payload = []
-
-        while time.time() < start_time + timeout:
-            try:
-                data = self.ser.read(1)
-            except TypeError:
-                return (None, None, None)
-            if data:
-                data = ord(data)
-
-            if(step == 0 and data == 0xAA):
-                step += 1
-                chk = 0
-            elif(step == 1):
-                msg_type = data
-                step += 1
-                chk += data
-                chk &= 0xFF
-            elif(step == 2):
-                length = data 
-                step += 1
-                chk += data
-                chk &= 0xFF
-            elif(step == 3):
-                if(count < length):
-                    payload.append(data)
-                    count += 1
-                    chk += data
-                    chk &= 0xFF
-                    if count == length:
-                        step += 1
-            elif(step == 4):
-                if(data == chk):
-                    return (msg_type, length, payload)
-                else:
-                    print("HDR Current Supply checksum wrong. Should be {0}, was {1}".format(chk, data))
-                    print("Payload: ")
-                    print(payload)
-                    step = 0
-                    count = 0
-                    payload = []
-        return (None, None, None)
+        decoder = self.decoder
+        (num_frames, num_bad_checksum, num_skipped) = (decoder.num_frames, decoder.num_bad_checksum, decoder.num_skipped)
+        (msg_type, payload) = sp.read_frame(self.ser, decoder, start_time + timeout - time.time(), instrumentation=self.instrumentation)
+        self.instrumentation.count("frames_decoded", decoder.num_frames - num_frames)
+        self.instrumentation.count("resync_bytes", decoder.num_skipped - num_skipped)
+        if decoder.num_bad_checksum > num_bad_checksum:
+            self.instrumentation.count("checksum_failures", decoder.num_bad_checksum - num_bad_checksum)
+            self.instrumentation.report("checksum", "checksum wrong on {0} frames".format(decoder.num_bad_checksum - num_bad_checksum))
+        if msg_type is None:
+            return (None, None, None)
+        return (msg_type, len(payload), payload)
     
-    def connect(self):
-        # Figure out the correct port
-        port = ""
-        connected = [comport for comport in serial.tools.list_ports.comports()]
-
-        for comport in connected:
-            if comport.vid == 1155 and comport.pid == 100:
-                port = comport[0]
-                break
-
-        if port != "":
-            self.ser = serial.Serial(port, timeout=0.1)  # open serial port
+    def connect(self, ser=None, serial_number=None):
+        # ser is an already open serial-like port to use instead of
+        # searching (e.g. a device_simulator port). With several devices
+        # attached, serial_number picks one by its USB serial number;
+        # otherwise the first found is used.
+        self.serial_number = None
+        if ser is None:
+            opened = dd.default_index.open(USB_VID, USB_PID, serial_number)
+            if opened is not None:
+                (ser, self.serial_number) = opened
+
+        if ser is not None:
+            self.ser = ser
             self.ser.reset_input_buffer()
+            self.decoder.reset()
             print("Connected to HDR Precision Current Source")
             return True
         else:
             print("Could not connect to HDR Precision Current Source")
             return False
+
+    def reconnect(self, timeout=None):
+        # Reopen the same device after it has dropped off the bus or been
+        # re-enumerated, and resend the last confirmed command so it comes
+        # back to the same output. Returns True once it is back.
+        if self.serial_number is None:
+            return False
+        if timeout is None:
+            timeout = self.reconnect_timeout
+        start_time = time.perf_counter()
+        try:
+            self.ser.close()
+        except OSError:
+            pass
+        opened = dd.default_index.wait_for_device(USB_VID, USB_PID, self.serial_number, timeout)
+        if opened is None:
+            self.instrumentation.report("reconnect", "{0} did not come back".format(self.serial_number))
+            return False
+        self.ser = opened[0]
+        self.ser.reset_input_buffer()
+        self.decoder.reset()
+        if self.last_frame is not None:
+            # Take the reply here so it can't be mistaken for the reply to
+            # the next command
+            start = time.time()
+            self.ser.write(self.last_frame)
+            while True:
+                (reply_type, length, payload) = self.get_packet(start, 0.1)
+                if reply_type is None or reply_type == sp.CURRENT_SET:
+                    break
+        self.instrumentation.count("reconnects")
+        self.instrumentation.record_time("reconnect_s", time.perf_counter() - start_time)
+        self.instrumentation.report("reconnect", "reconnected to {0}".format(self.serial_number))
+        return True
+
+    def _write(self, frame):
+        # Send a frame, reopening the port first if it has dropped
+        try:
+            self.ser.write(frame)
+        except OSError:
+            if not self.auto_reconnect or not self.reconnect():
+                raise
+            self.ser.write(frame)
         
     def command_stage(self, stage):
         if self.supply_type == CurrentSupplyType.ADJUSTABLE_REFERENCE:
             print("ERROR: In adjustable reference mode. Please command current directly")
             return
 
-        # Assemble command and send
-        payload = [0xAA,0x04,1,stage]
-
-        chk = 0
-        for i in range(1,len(payload)):
-            chk += payload[i]
-            chk &= 0xFF
-        payload.append(chk)
-        self.ser.write(bytearray(payload))
+        self._write(self.encoder.pack(sp.SET_SCALE, "<B", stage))
 
     def command_current_ma(self, current_cmd_ma):
         if self.supply_type == CurrentSupplyType.FIXED_REFERENCE:
             print("ERROR: In fixed reference mode. Cannot command current directly")
             return
 
-        payload = [0xAA,0x00,4]
-        payload.extend(struct.pack('<f', current_cmd_ma))
+        self._write(self.encoder.pack(sp.SET_CURRENT, "<f", current_cmd_ma))
+
+    def _flush_replies(self):
+        # Drop any reply still buffered from earlier commands, so the next
+        # CURRENT_SET read is the one the next command triggers
+        self.ser.reset_input_buffer()
+        while self.ser.in_waiting > 0:
+            self.instrumentation.count("bytes_flushed", len(self.ser.read(self.ser.in_waiting)))
+        self.decoder.reset()
+
+    def set_and_confirm(self, stage=None, current_ma=None, expected_ma=None, rel_tol=0.05, timeout=0.1, max_attempts=3):
+        # Command a stage (fixed reference mode) or a current (adjustable
+        # reference mode) and wait for the CURRENT_SET reply to that command.
+        # The firmware's reply carries no sequence number, so stale replies
+        # are flushed before each send and only the first one after it is
+        # taken. With expected_ma, a reply further than rel_tol from it is
+        # treated as wrong. Each attempt waits at most timeout seconds before
+        # the command is sent again; setting a stage or current twice is
+        # harmless. Returns the current the supply reports in mA, or None if
+        # no attempt was confirmed.
+        if stage is not None:
+            if self.supply_type == CurrentSupplyType.ADJUSTABLE_REFERENCE:
+                print("ERROR: In adjustable reference mode. Please command current directly")
+                return None
+            (msg_type, value) = (sp.SET_SCALE, stage)
+            frame = self.encoder.pack(sp.SET_SCALE, "<B", stage)
+        else:
+            if self.supply_type == CurrentSupplyType.FIXED_REFERENCE:
+                print("ERROR: In fixed reference mode. Cannot command current directly")
+                return None
+            (msg_type, value) = (sp.SET_CURRENT, current_ma)
+            frame = self.encoder.pack(sp.SET_CURRENT, "<f", current_ma)
+
+        for attempt in range(max_attempts):
+            if attempt > 0:
+                self.instrumentation.count("command_retries")
+            try:
+                self._flush_replies()
+                start_time = time.time()
+                send_time = time.perf_counter()
+                self.ser.write(frame)
+                self.instrumentation.count("commands_sent")
+                while True:
+                    (reply_type, length, payload) = self.get_packet(start_time, timeout)
+                    if reply_type is None:
+                        break
+                    if reply_type == sp.CURRENT_SET and length == 4:
+                        break
+            except OSError:
+                # Unplugged or re-enumerated (SerialException is an OSError
+                # too); the next attempt goes to the reopened port
+                if not self.auto_reconnect or not self.reconnect():
+                    raise
+                continue
+            if reply_type is None:
+                self.instrumentation.count("command_timeouts")
+                continue
+            reply_time = time.time()
+            self.instrumentation.record_time("command_round_trip_s", time.perf_counter() - send_time)
+
+            current_set_ma = struct.unpack('<f', payload)[0]
+            if expected_ma is not None and abs(current_set_ma - expected_ma) > rel_tol * abs(expected_ma):
+                self.instrumentation.count("wrong_replies")
+                self.instrumentation.report("wrong_reply", "reported {0} mA, expected {1} mA".format(current_set_ma, expected_ma))
+                continue
+            self.last_command_time = (start_time, reply_time)
+            self.last_frame = frame
+            self.command_log.append((start_time, reply_time, msg_type, value, current_set_ma))
+            return current_set_ma
 
-        chk = 0
-        for i in range(1,len(payload)):
-            chk += payload[i]
-            chk &= 0xFF
-        payload.append(chk)
-        self.ser.write(bytearray(payload))
+        self.instrumentation.count("commands_failed")
+        self.instrumentation.report("unconfirmed", "did not confirm the command after {0} attempts".format(max_attempts))
+        return None
 
     def get_current_setting_ma(self):
-        (msg_type, length, payload) = self.get_packet(time.time(), 0.5)
+        # The first CURRENT_SET frame to arrive, which may be a stale reply
+        # to an earlier command; set_and_confirm() avoids that. None if the
+        # port dropped, after reopening it.
+        try:
+            (msg_type, length, payload) = self.get_packet(time.time(), 0.5)
+        except OSError:
+            if not self.auto_reconnect or not self.reconnect():
+                raise
+            return None
         if(msg_type is not None and length is not None):
-            if(msg_type == 5 and length == 4):
-                # CURRENT_SET 
-                current_set_mA = struct.unpack('<f', bytes(payload))[0]
+            if(msg_type == sp.CURRENT_SET and length == 4):
+                current_set_mA = struct.unpack('<f', payload)[0]
                 return current_set_mA
         else:
             return None
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import struct
+import time
+import serial_protocol as sp
+import device_discovery as dd
+import metashunt_v2 as ms2
+import HDRPrecisionCurrentSupply as pcs
+import timing
+from measurement_store import MeasurementStore
+from streaming_stats import RunningStats
+from instrumentation import Instrumentation
+
+# asyncio counterparts of HDRPrecisionCurrentSupply and MetaShuntV2, so one
+# event loop can drive any number of instruments alongside a GUI or a
+# network API without a thread per device. The wire protocol, decoding and
+# bookkeeping are the same as the blocking classes; only the waiting
+# differs.
+#
+#   async def main():
+#       supply = AsyncHDRPrecisionCurrentSupply(pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
+#       metashunt = AsyncMetaShuntV2()
+#       await supply.connect()
+#       await metashunt.connect()
+#       await supply.command_current_ma(1.0)
+#       async for samples in metashunt.samples():
+#           ...
+
+class AsyncSerialTransport:
+    # Non-blocking reads from a serial port. Where the port has a file
+    # descriptor (pyserial on POSIX) a read waits on the event loop for it
+    # to become readable, so an idle device costs nothing; other ports
+    # (Windows, device_simulator) are polled every poll_interval seconds.
+    def __init__(self, ser, poll_interval=0.001):
+        self.ser = ser
+        self.ser.timeout = 0
+        self.poll_interval = poll_interval
+        try:
+            self.fd = ser.fileno()
+        except (AttributeError, OSError):
+            self.fd = None
+
+    async def read(self):
+        # Everything the port has buffered, waiting for at least one byte.
+        # Always lets the loop run first, so a device that streams faster
+        # than it is read can't starve the other tasks.
+        await asyncio.sleep(0)
+        while True:
+            n = self.ser.in_waiting
+            if n > 0:
+                return self.ser.read(n)
+            if self.fd is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            loop = asyncio.get_running_loop()
+            readable = loop.create_future()
+            loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self.fd)
+
+    def write(self, data):
+        return self.ser.write(data)
+
+    def reset_input_buffer(self):
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        self.ser.close()
+
+class AsyncHDRPrecisionCurrentSupply:
+    def __init__(self, supply_type : pcs.CurrentSupplyType):
+        self.supply_type = supply_type
+        self.transport = None
+        self.serial_number = None
+        self.decoder = sp.FrameDecoder()
+        self.encoder = sp.FrameEncoder()
+        self.instrumentation = Instrumentation("HDR Current Supply")
+        self.last_command_time = None
+        # One command and its reply at a time, whoever is awaiting
+        self.lock = asyncio.Lock()
+
+    async def connect(self, ser=None, serial_number=None):
+        # As HDRPrecisionCurrentSupply.connect()
+        self.serial_number = None
+        if ser is None:
+            opened = dd.default_index.open(pcs.USB_VID, pcs.USB_PID, serial_number)
+            if opened is not None:
+                (ser, self.serial_number) = opened
+
+        if ser is not None:
+            self.transport = AsyncSerialTransport(ser)
+            self.transport.reset_input_buffer()
+            self.decoder.reset()
+            print("Connected to HDR Precision Current Source")
+            return True
+        else:
+            print("Could not connect to HDR Precision Current Source")
+            return False
+
+    async def _read_frame(self, timeout, msg_type=None):
+        # As serial_protocol.read_frame(). Returns (msg_type, payload) or
+        # (None, None) after timeout seconds.
+        decoder = self.decoder
+        end_time = time.time() + timeout
+        while True:
+            while decoder.pending:
+                frame = decoder.pending.popleft()
+                if msg_type is None or frame[0] == msg_type:
+                    return frame
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return (None, None)
+            try:
+                data = await asyncio.wait_for(self.transport.read(), remaining)
+            except asyncio.TimeoutError:
+                return (None, None)
+            num_bad_checksum = decoder.num_bad_checksum
+            decoder.pending.extend(decoder.feed(data))
+            self.instrumentation.count("bytes_read", len(data))
+            if decoder.num_bad_checksum > num_bad_checksum:
+                self.instrumentation.count("checksum_failures", decoder.num_bad_checksum - num_bad_checksum)
+
+    def _flush_replies(self):
+        self.transport.reset_input_buffer()
+        while self.transport.ser.in_waiting > 0:
+            self.instrumentation.count("bytes_flushed", len(self.transport.ser.read(self.transport.ser.in_waiting)))
+        self.decoder.reset()
+
+    async def set_and_confirm(self, stage=None, current_ma=None, expected_ma=None, rel_tol=0.05, timeout=0.1, max_attempts=3):
+        # As HDRPrecisionCurrentSupply.set_and_confirm()
+        if stage is not None:
+            if self.supply_type == pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE:
+                print("ERROR: In adjustable reference mode. Please command current directly")
+                return None
+            frame = self.encoder.pack(sp.SET_SCALE, "<B", stage)
+        else:
+            if self.supply_type == pcs.CurrentSupplyType.FIXED_REFERENCE:
+                print("ERROR: In fixed reference mode. Cannot command current directly")
+                return None
+            frame = self.encoder.pack(sp.SET_CURRENT, "<f", current_ma)
+
+        async with self.lock:
+            for attempt in range(max_attempts):
+                if attempt > 0:
+                    self.instrumentation.count("command_retries")
+                self._flush_replies()
+                start_time = time.time()
+                send_time = time.perf_counter()
+                self.transport.write(frame)
+                self.instrumentation.count("commands_sent")
+                (reply_type, payload) = await self._read_frame(timeout, sp.CURRENT_SET)
+                if reply_type is None or len(payload) != 4:
+                    self.instrumentation.count("command_timeouts")
+                    continue
+                self.instrumentation.record_time("command_round_trip_s", time.perf_counter() - send_time)
+                current_set_ma = struct.unpack('<f', payload)[0]
+                if expected_ma is not None and abs(current_set_ma - expected_ma) > rel_tol * abs(expected_ma):
+                    self.instrumentation.count("wrong_replies")
+                    continue
+                self.last_command_time = (start_time, time.time())
+                return current_set_ma
+
+        self.instrumentation.count("commands_failed")
+        return None
+
+    async def command_stage(self, stage, timeout=0.1, max_attempts=3):
+        # Unlike the blocking class, which only sends the command, these
+        # wait for the supply to confirm it, since that is what there is to
+        # await. Return the current it reports, or None.
+        return await self.set_and_confirm(stage=stage, timeout=timeout, max_attempts=max_attempts)
+
+    async def command_current_ma(self, current_cmd_ma, timeout=0.1, max_attempts=3):
+        return await self.set_and_confirm(current_ma=current_cmd_ma, timeout=timeout, max_attempts=max_attempts)
+
+    async def get_current_setting_ma(self, timeout=0.5):
+        # The first CURRENT_SET frame to arrive, as the blocking class
+        async with self.lock:
+            (msg_type, payload) = await self._read_frame(timeout, sp.CURRENT_SET)
+        if msg_type is None or len(payload) != 4:
+            return None
+        return struct.unpack('<f', payload)[0]
+
+    async def disconnect(self):
+        self.transport.close()
+
+class AsyncMetaShuntV2:
+    # A reader task started by connect() decodes everything the device
+    # sends: samples go to the measurement store, the running stats and
+    # every samples() iterator, and config replies to whoever is waiting for
+    # them. max_samples caps the store as for MetaShuntV2.
+    def __init__(self, max_samples=None, queue_batches=1000):
+        self.transport = None
+        self.serial_number = None
+        self.measurements = MeasurementStore(max_samples=max_samples)
+        self.stats = RunningStats()
+        self.rx_buffer = bytearray()
+        self.config_decoder = sp.FrameDecoder(payload_lengths={ms2.CONFIG_RESPONSE : ms2.CONFIG_RESPONSE_LEN})
+        self.encoder = sp.FrameEncoder()
+        self.config = ms2.ConfigState()
+        self.config_event = asyncio.Event()
+        self.instrumentation = Instrumentation("MetaShunt V2")
+        self.ticks = timing.TickUnwrapper()
+        self.clock = timing.ClockSync()
+        # Queues of the samples() iterators; a slow consumer loses its
+        # oldest batches beyond queue_batches rather than holding up the rest
+        self.queue_batches = queue_batches
+        self.subscribers = set()
+        self.reader_task = None
+
+    async def connect(self, ser=None, serial_number=None):
+        # As MetaShuntV2.connect(), and starts the reader task
+        self.serial_number = None
+        if ser is None:
+            opened = dd.default_index.open(ms2.USB_VID, ms2.USB_PID, serial_number)
+            if opened is not None:
+                (ser, self.serial_number) = opened
+
+        if ser is not None:
+            self.transport = AsyncSerialTransport(ser)
+            self.transport.reset_input_buffer()
+            self.rx_buffer = bytearray()
+            self.config_decoder.reset()
+            self.ticks.reset()
+            self.clock.reset()
+            self.config = ms2.ConfigState()
+            self.reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+            print("Connected to MetaShunt V2")
+            return True
+        else:
+            print("Could not connect to MetaShunt V2")
+            return False
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.transport.read()
+                read_time = time.time()
+                self.rx_buffer += data
+
+                # As MetaShuntV2.read_samples()
+                samples = ms2.decode_received(self.rx_buffer, self.config_decoder, self._accept_config, self.instrumentation)
+                self.instrumentation.count("bytes_read", len(data))
+                if len(samples) == 0:
+                    continue
+                self.clock.add(self.ticks.unwrap(samples["time"])[-1], read_time)
+                self.measurements.append(samples)
+                self.stats.update(samples["current_ma"])
+                for queue in self.subscribers:
+                    if queue.full():
+                        queue.get_nowait()
+                        self.instrumentation.count("batches_dropped")
+                    queue.put_nowait(samples)
+        except OSError as e:
+            print("MetaShunt V2 stream stopped: {0}".format(e))
+        finally:
+            # Ends every samples() iterator
+            for queue in self.subscribers:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _accept_config(self, index, value):
+        if not self.config.accept(index, value):
+            return False
+        self.config_event.set()
+        return True
+
+    async def samples(self):
+        # Async iterator over batches of decoded samples (SAMPLE_DTYPE
+        # arrays) as they arrive, from now until the device disconnects
+        queue = asyncio.Queue(maxsize=self.queue_batches)
+        self.subscribers.add(queue)
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            self.subscribers.discard(queue)
+
+    async def measure(self, run_time):
+        # Record for run_time seconds. Everything is stored as usual; the
+        # return value is (num_measurements, mean_ma, std_dev_ma) over just
+        # this period.
+        stats = RunningStats()
+
+        async def collect():
+            async for batch in self.samples():
+                stats.update(batch["current_ma"])
+
+        try:
+            await asyncio.wait_for(collect(), run_time)
+        except asyncio.TimeoutError:
+            pass
+        return stats.summary()
+
+    def get_measurements(self):
+        return self.measurements.get_current_ma().copy()
+
+    def get_measurement_times(self):
+        return self.measurements.get_time().copy()
+
+    def measurement_stats(self):
+        return self.stats.summary()
+
+    def clear_measurements(self):
+        self.measurements.clear()
+        self.stats.reset()
+
+    async def _wait_config_readback(self, indices, timeout):
+        # As MetaShuntV2._wait_config_readback(), the reader task doing the
+        # reading
+        end_time = time.time() + timeout
+        while not self.config.answered(indices):
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            self.config_event.clear()
+            try:
+                await asyncio.wait_for(self.config_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.config.finish(indices)
+
+    async def _exchange_config(self, writes, reads, timeout, frame_gap):
+        # As MetaShuntV2._exchange_config(): one command in the firmware's
+        # slot at a time
+        readback = {}
+        send_time = time.perf_counter()
+        for index in reads:
+            self.config.request([index])
+            if index in writes:
+                self.transport.write(self.encoder.pack(ms2.SET_CONFIG, "<Bf", index, writes[index]))
+                await asyncio.sleep(frame_gap)
+            self.transport.write(self.encoder.pack(ms2.GET_CONFIG, "<B", index))
+            readback.update(await self._wait_config_readback([index], timeout))
+        self.instrumentation.record_time("config_round_trip_s", time.perf_counter() - send_time)
+        self.instrumentation.count("config_timeouts", len(reads) - len(readback))
+        return readback
+
+    async def configure(self, config_file_name, rel_tol=1e-5, max_attempts=3, timeout=0.25, frame_gap=0.002):
+        with open(config_file_name) as f:
+            config_data = json.load(f)
+        return await self.write_config(config_data, rel_tol=rel_tol, max_attempts=max_attempts, timeout=timeout, frame_gap=frame_gap)
+
+    async def write_config(self, config_data, rel_tol=1e-5, max_attempts=3, timeout=0.25, frame_gap=0.002):
+        # As MetaShuntV2.write_config()
+        write = self.config.start_write(config_data, rel_tol, max_attempts)
+        while write.next_attempt():
+            write.update(await self._exchange_config(write.pending, list(write.pending), timeout, frame_gap))
+        return write.finish()
+
+    async def read_all_config(self, timeout=0.15, frame_gap=0.002):
+        readback = await self._exchange_config({}, list(ms2.config_key_dict), timeout, frame_gap)
+        return {ms2.config_key_dict[index] : value for (index, value) in readback.items()}
+
+    async def get_config_param(self, key, fresh=False, timeout=0.15):
+        if not fresh and key in self.config.cache:
+            return self.config.cache[key]
+        index = ms2.config_index_dict[key]
+        readback = await self._exchange_config({}, [index], timeout, 0.0)
+        return readback.get(index)
+
+    async def disconnect(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+        self.transport.close()
@@ -0,0 +1,166 @@
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import device_simulator as ds
+import metashunt_v2 as ms2
+import HDRPrecisionCurrentSupply as pcs
+import sweep_engine as se
+from measurement_store import MeasurementStore
+
+# Throughput and latency of the host interface, run against recorded byte
+# streams and the device simulators so no hardware is needed.
+#
+# python benchmark_interface.py [results.json] [recorded_stream.bin]
+#
+# Results are printed and, if a file name is given, written as JSON so runs
+# can be compared between versions.
+
+num_decode_samples = 1000000
+decode_chunk_size = 4096
+corrupt_prob = 1e-4
+num_latency_trials = 20
+sweep_levels_ma = np.geomspace(0.00005, 250.0, num=10)
+
+class Timer:
+    # Wall and CPU time of a block; wall minus CPU is time spent waiting
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.process_time() - self.cpu_start
+
+def bench_decode(stream, chunk_size):
+    ms = ms2.MetaShuntV2()
+    ms.ser = ds.ReplaySerial(stream, chunk_size=chunk_size)
+    with Timer() as t:
+        while not ms.ser.at_end():
+            ms.record(ms.read_samples())
+    num_samples = ms.measurement_stats()[0]
+    return {
+        "bytes" : len(stream),
+        "frames_decoded" : num_samples,
+        "seconds" : t.wall,
+        "frames_per_s" : num_samples / t.wall,
+        "mb_per_s" : len(stream) / t.wall / 1.0e6,
+    }
+
+def bench_memory(num_samples):
+    samples = np.empty(num_samples, dtype=ms2.SAMPLE_DTYPE)
+    samples["time"] = np.arange(num_samples)
+    samples["current_ma"] = 1.0
+    tracemalloc.start()
+    store = MeasurementStore()
+    for chunk in np.array_split(samples, max(1, num_samples // 1000)):
+        store.append(chunk)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "bytes_per_million_samples" : current * 1.0e6 / num_samples,
+        "peak_bytes_per_million_samples" : peak * 1.0e6 / num_samples,
+    }
+
+def summarize(times):
+    times = np.array(times)
+    return {
+        "mean_s" : float(np.mean(times)),
+        "p50_s" : float(np.percentile(times, 50)),
+        "p95_s" : float(np.percentile(times, 95)),
+        "max_s" : float(np.max(times)),
+    }
+
+def bench_config(num_trials):
+    ms = ms2.MetaShuntV2()
+    ms.connect(ser=ds.SimulatedMetaShunt())
+    config_data = {key : 1.0 + 0.01 * index for (key, index) in ms2.config_index_dict.items()}
+    configure_times = []
+    read_all_times = []
+    read_one_times = []
+    for i in range(num_trials):
+        # Change every value so each upload writes all nine
+        config_data = {key : value * 1.001 for (key, value) in config_data.items()}
+        with Timer() as t:
+            ms.write_config(config_data)
+        configure_times.append(t.wall)
+        with Timer() as t:
+            ms.read_all_config()
+        read_all_times.append(t.wall)
+        with Timer() as t:
+            ms.get_config_param("R9", fresh=True)
+        read_one_times.append(t.wall)
+    ms.disconnect()
+    return {
+        "configure" : summarize(configure_times),
+        "read_all_config" : summarize(read_all_times),
+        "get_config_param" : summarize(read_one_times),
+    }
+
+def bench_command(num_trials):
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
+    supply.connect(ser=ds.SimulatedHDRSupply())
+    times = []
+    for command_ma in np.geomspace(0.001, 100.0, num=num_trials):
+        with Timer() as t:
+            supply.set_and_confirm(current_ma=command_ma)
+        times.append(t.wall)
+    supply.disconnect()
+    return summarize(times)
+
+def bench_sweep(levels_ma, use_engine):
+    supply_ser = ds.SimulatedHDRSupply()
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
+    supply.connect(ser=supply_ser)
+    ms = ms2.MetaShuntV2()
+    ms.connect(ser=ds.SimulatedMetaShunt(current_source=supply_ser.output_ma))
+    with Timer() as t:
+        if use_engine:
+            se.SweepEngine(supply, ms, rel_precision=1e-4, max_time=1.5).run(levels_ma)
+        else:
+            for command_ma in levels_ma:
+                supply.command_current_ma(command_ma)
+                supply.get_current_setting_ma()
+                ms.measure_until(rel_precision=1e-4, max_time=1.5)
+    ms.disconnect()
+    supply.disconnect()
+    return {
+        "levels" : len(levels_ma),
+        "wall_s" : t.wall,
+        "cpu_s" : t.cpu,
+        "waiting_s" : t.wall - t.cpu,
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'rb') as f:
+            stream = f.read()
+    else:
+        stream = ds.make_sample_stream(num_decode_samples, seed=0)
+    corrupt_stream = ds.damage_bytes(stream, corrupt_prob, 0.0, np.random.default_rng(0))
+
+    # Keep the interface's progress prints out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            "time" : time.time(),
+            "python" : platform.python_version(),
+            "numpy" : np.__version__,
+            "decode" : bench_decode(stream, decode_chunk_size),
+            "decode_corrupted" : bench_decode(corrupt_stream, decode_chunk_size),
+            "memory" : bench_memory(num_decode_samples),
+            "config" : bench_config(num_latency_trials),
+            "command_round_trip" : bench_command(num_latency_trials),
+            "sweep" : bench_sweep(sweep_levels_ma, use_engine=False),
+            "sweep_engine" : bench_sweep(sweep_levels_ma, use_engine=True),
+        }
+    results["decode_corrupted"]["corrupt_prob"] = corrupt_prob
+
+    print(json.dumps(results, indent=2))
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'w') as outf:
+            json.dump(results, outf, indent=2)
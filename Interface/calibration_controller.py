@@ -1,168 +1,135 @@
 import metashunt_v2 as ms2
 import HDRPrecisionCurrentSupply as pcs
+import ladder_solver as ls
+import supply_model as sm
+import device_discovery as dd
 import json
-import copy
-import time
 import numpy as np
 
 pre_cal_filename = "pre_cal_cfg.json"
 post_cal_filename = "post_cal_cfg.json"
 
+# Each stage is measured until the mean is known to this relative precision,
+# or for at most this many seconds
+measure_rel_precision = 2e-5
+measure_max_time = 4.5
+num_retries = 5
+
+expected_current_stages_ma = sm.fixed_stage_current_ma(np.arange(sm.NUM_STAGES))
+stages = range(7, -1, -1)
+
 def try_configure(filename, ms, num_attempts):
     for i in range(num_attempts):
         if(ms.configure(config_file_name=filename)):
-            break
+            return True
+    return False
 
-if __name__ == "__main__":
+def measure_stages(this_pcs, this_ms2, label="Currently", log=print):
+    # Step the supply through every stage and measure each with the
+    # MetaShunt. Returns (truth_ma, avg_ma, errors, settled) in stage order
+    # 7..0; entries for a stage the supply did not confirm are None.
+    truth_ma = []
+    avg_ma = []
+    errors = []
+    settled_stages = []
+    for stage in stages:
+        current_commanded_ma = this_pcs.set_and_confirm(stage=stage, expected_ma=expected_current_stages_ma[stage], max_attempts=num_retries)
+        if current_commanded_ma is None:
+            log("Could not set stage {0}".format(stage))
+            truth_ma.append(None)
+            avg_ma.append(None)
+            errors.append(None)
+            settled_stages.append(None)
+            continue
+        log("Set stage correctly for stage {0}, current {1}".format(stage, current_commanded_ma))
+
+        (num_meas, stage_avg_ma, std_dev_ma, settled) = this_ms2.measure_until(rel_precision=measure_rel_precision, max_time=measure_max_time, min_settle_time=sm.MIN_SETTLE_TIME_S[stage])
+        error = (current_commanded_ma-stage_avg_ma)/current_commanded_ma
+        log("{0}, measurement at stage {1} is off by {2:.2f} percent from {3:.6f}mA".format(label, stage, 100.0*error, current_commanded_ma))
+        if not settled:
+            log("Stage {0} did not settle within {1} s, so its mean is not reliable".format(stage, measure_max_time))
+        truth_ma.append(current_commanded_ma)
+        avg_ma.append(stage_avg_ma)
+        errors.append(error)
+        settled_stages.append(settled)
 
-    print("Plug in MetaShunt and supply and press enter")
-    input()
-    this_ms2 = ms2.MetaShuntV2()
-    this_ms2.connect()
+    # End at low current
+    this_pcs.set_and_confirm(stage=7)
+    return (truth_ma, avg_ma, errors, settled_stages)
 
-    this_pcs = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.FIXED_REFERENCE)
-    this_pcs.connect()
-    this_pcs.command_stage(7)
-
-    config_data = {}
-    config_data["R19"] = this_ms2.get_config_param("R19")
-    config_data["R17"] = this_ms2.get_config_param("R17")
-    config_data["R15"] = this_ms2.get_config_param("R15")
-    config_data["R13"] = this_ms2.get_config_param("R13")
-    config_data["R11"] = this_ms2.get_config_param("R11")
-    config_data["R9"] = this_ms2.get_config_param("R9")
-    config_data["R2"] = this_ms2.get_config_param("R2")
-    config_data["R1"] = this_ms2.get_config_param("R1")
-    config_data["R_FET"] = this_ms2.get_config_param("R_FET")
+def calibrate(this_pcs, this_ms2, pre_cal_filename=pre_cal_filename, post_cal_filename=post_cal_filename, log=print):
+    # Snapshot the MetaShunt's config, measure every stage, solve for
+    # corrected resistors and upload them. Returns a dict of the results,
+    # with "configured" False if any step failed.
+    this_pcs.set_and_confirm(stage=7)
+
+    config_data = this_ms2.read_all_config()
+    result = {"configured" : False, "pre_cal_config" : config_data}
+    if len(config_data) != len(ms2.config_index_dict):
+        log("Could not read the MetaShunt config")
+        return result
 
     with open(pre_cal_filename, 'w') as outf:
         json.dump(config_data, outf)
 
     # Move through all stages, take measurement, and update calibration
-    num_retries = 5
-    expected_current_stages_ma = np.flip(np.array([0.0003, 0.0033, 0.0300, 0.300, 3.00, 30.0, 234.0, 389.0]))
-    stages = range(7, -1, -1)
-    pre_cal_avg_ma = []
-    truth_ma = []
-    errors = []
-    ratios = []
-    for stage in stages:
-        for attempt in range(num_retries):
-            time.sleep(0.1)
-            this_pcs.command_stage(stage)
-            current_commanded_ma = this_pcs.get_current_setting_ma()
-            if current_commanded_ma is not None:
-                if (np.abs(current_commanded_ma - expected_current_stages_ma[stage]) / expected_current_stages_ma[stage]) < 0.05:
-                    print("Set stage correctly for stage {0}, current {1}".format(stage, current_commanded_ma))
-                    truth_ma.append(current_commanded_ma)
-                    break
-        
-        time.sleep(0.01)
-        this_ms2.measure(0.5) # Dummy measure first
-        this_ms2.clear_measurements()
-        this_ms2.measure(4.0)
-        (num_meas, avg_ma, std_dev_ma) = this_ms2.measurement_stats()
-        meas = this_ms2.get_measurements()
-        pre_cal_avg_ma.append(avg_ma)
-
-        error = (current_commanded_ma-avg_ma)/current_commanded_ma
-        print("Currently, measurement at stage {0} is off by {1:.2f} percent from {2:.6f}mA".format(stage, 100.0*error, current_commanded_ma))
-        errors.append(error)
-        ratios.append(avg_ma / current_commanded_ma)
-
-    # End at low current
-    this_pcs.command_stage(7)
-    this_pcs.command_stage(7)
-    this_pcs.command_stage(7)
+    (truth_ma, pre_cal_avg_ma, errors, settled) = measure_stages(this_pcs, this_ms2, log=log)
+    result["truth_ma"] = truth_ma
+    result["pre_cal_avg_ma"] = pre_cal_avg_ma
+    result["pre_cal_errors"] = errors
+    result["pre_cal_settled"] = settled
+    if None in truth_ma:
+        log("Not every stage was measured, leaving the calibration as it was")
+        return result
+    if False in settled:
+        log("Not every stage settled, leaving the calibration as it was")
+        return result
+    ratios = [avg / truth for (avg, truth) in zip(pre_cal_avg_ma, truth_ma)]
 
     # Compute calibration
-    updated_config_data = copy.copy(config_data)
-
-    # First, compute what actual r_eff was
-    r_eff_current = np.zeros((8,1))
-    r_eff_current[0] = config_data["R19"]
-    r_eff_current[1] = 1.0/((1.0/(config_data["R17"]+config_data["R_FET"])) + (1.0/r_eff_current[0]))
-    r_eff_current[2] = 1.0/((1.0/(config_data["R15"]+config_data["R_FET"])) + (1.0/r_eff_current[1]))
-    r_eff_current[3] = 1.0/((1.0/(config_data["R13"]+config_data["R_FET"])) + (1.0/r_eff_current[2]))
-    r_eff_current[4] = 1.0/((1.0/(config_data["R11"]+config_data["R_FET"])) + (1.0/r_eff_current[3]))
-    r_eff_current[5] = 1.0/((1.0/(config_data["R9"]+config_data["R_FET"])) + (1.0/r_eff_current[4]))
-    r_eff_current[6] = 1.0/((1.0/(config_data["R2"]+config_data["R_FET"])) + (1.0/r_eff_current[5]))
-    r_eff_current[7] = 1.0/((1.0/(config_data["R1"]+config_data["R_FET"])) + (1.0/r_eff_current[6]))
-
-    # Then compute what r_eff should be
-    r_eff_actual = np.array([r_eff_current[i] * ratio for i, ratio in enumerate(ratios)])
-
-    # Then, compute configs based on this
-    # At stage 7, only R19
-    r_eff_updated = np.zeros((8,1))
-    updated_config_data["R19"] = ratios[0] * config_data["R19"]
-    r_eff_updated[0] = updated_config_data["R19"]
-    
-    # Stage 6
-    updated_config_data["R17"] = (( 1.0 / ((1.0 / r_eff_actual[1]) - (1.0 / r_eff_updated[0]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[1] = 1.0/((1.0/(updated_config_data["R17"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[0]))
-
-    # Stage 5
-    updated_config_data["R15"] = (( 1.0 / ((1.0 / r_eff_actual[2]) - (1.0 / r_eff_updated[1]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[2] = 1.0/((1.0/(updated_config_data["R15"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[1]))
-
-    # Stage 4
-    updated_config_data["R13"] = (( 1.0 / ((1.0 / r_eff_actual[3]) - (1.0 / r_eff_updated[2]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[3] = 1.0/((1.0/(updated_config_data["R13"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[2]))
-
-    # Stage 3
-    updated_config_data["R11"] = (( 1.0 / ((1.0 / r_eff_actual[4]) - (1.0 / r_eff_updated[3]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[4] = 1.0/((1.0/(updated_config_data["R11"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[3]))
-
-    # Stage 2
-    updated_config_data["R9"] = (( 1.0 / ((1.0 / r_eff_actual[5]) - (1.0 / r_eff_updated[4]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[5] = 1.0/((1.0/(updated_config_data["R9"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[4]))
-
-    # Stage 1
-    updated_config_data["R2"] = (( 1.0 / ((1.0 / r_eff_actual[6]) - (1.0 / r_eff_updated[5]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[6] = 1.0/((1.0/(updated_config_data["R2"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[5]))
-
-    # Stage 0
-    updated_config_data["R1"] = (( 1.0 / ((1.0 / r_eff_actual[7]) - (1.0 / r_eff_updated[6]))) - updated_config_data["R_FET"]).item()
-    r_eff_updated[7] = 1.0/((1.0/(updated_config_data["R1"]+updated_config_data["R_FET"])) + (1.0/r_eff_updated[6]))
+    (resistors, r_fet) = ls.config_to_arrays(config_data)
+    updated_resistors = ls.calibrate(resistors, r_fet, ratios)
+    updated_config_data = ls.arrays_to_config(updated_resistors, r_fet)
+    result["post_cal_config"] = updated_config_data
 
     with open(post_cal_filename, 'w') as outf:
         json.dump(updated_config_data, outf)
 
-    try_configure(filename=post_cal_filename, ms=this_ms2, num_attempts=3)
+    result["configured"] = try_configure(filename=post_cal_filename, ms=this_ms2, num_attempts=3)
+    return result
+
+def wait_for_replug(this_pcs, this_ms2):
+    # Wait for both devices to be unplugged and plugged back in
+    dd.default_index.wait_until_detached(pcs.USB_VID, pcs.USB_PID, this_pcs.serial_number)
+    dd.default_index.wait_until_detached(ms2.USB_VID, ms2.USB_PID, this_ms2.serial_number)
+    dd.default_index.wait_until_attached(ms2.USB_VID, ms2.USB_PID, this_ms2.serial_number)
+    dd.default_index.wait_until_attached(pcs.USB_VID, pcs.USB_PID, this_pcs.serial_number)
+
+if __name__ == "__main__":
+
+    print("Plug in MetaShunt and supply")
+    dd.default_index.wait_until_attached(ms2.USB_VID, ms2.USB_PID)
+    dd.default_index.wait_until_attached(pcs.USB_VID, pcs.USB_PID)
+    this_ms2 = ms2.MetaShuntV2()
+    this_ms2.connect()
+
+    this_pcs = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.FIXED_REFERENCE)
+    this_pcs.connect()
+
+    calibrate(this_pcs, this_ms2)
 
     this_ms2.disconnect()
     this_pcs.disconnect()
 
+    # Power cycle both so the check reads the config the MetaShunt comes
+    # back up with
     print("Now checking calibration, unplug supply then MetaShunt. Then plug in MetaShunt and plug in supply")
-    input()
-
-    this_pcs.connect()
-    this_ms2.connect()
+    wait_for_replug(this_pcs, this_ms2)
 
-    for stage in stages:
-        for attempt in range(num_retries):
-            time.sleep(0.1)
-            this_pcs.command_stage(stage)
-            current_commanded_ma = this_pcs.get_current_setting_ma()
-            if current_commanded_ma is not None:
-                if (np.abs(current_commanded_ma - expected_current_stages_ma[stage]) / expected_current_stages_ma[stage]) < 0.05:
-                    print("Set stage correctly for stage {0}, current {1}".format(stage, current_commanded_ma))
-                    truth_ma.append(current_commanded_ma)
-                    break
-        
-        time.sleep(0.01)
-        this_ms2.measure(0.5) # Dummy measure first
-        this_ms2.clear_measurements()
-        this_ms2.measure(4.0)
-        (num_meas, avg_ma, std_dev_ma) = this_ms2.measurement_stats()
-        error = (current_commanded_ma-avg_ma)/current_commanded_ma
-        print("After calibration, measurement at stage {0} is off by {1:.2f} percent from {2:.6f}mA".format(stage, 100.0*error, current_commanded_ma))
+    this_pcs.connect(serial_number=this_pcs.serial_number)
+    this_ms2.connect(serial_number=this_ms2.serial_number)
 
-    # End at low current
-    this_pcs.command_stage(7)
-    this_pcs.command_stage(7)
-    this_pcs.command_stage(7)
+    measure_stages(this_pcs, this_ms2, label="After calibration")
 
     this_ms2.disconnect()
     this_pcs.disconnect()
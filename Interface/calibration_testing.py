@@ -1,39 +1,27 @@
 import metashunt_v2 as ms2
 import HDRPrecisionCurrentSupply as pcs
-import json
-import copy
-import time
+import sweep_engine as se
+import supply_model as sm
 import matplotlib.pyplot as plt
-import numpy as np
 
+# Each level is measured until the mean is known to this relative precision,
+# or for at most this many seconds
+measure_rel_precision = 1e-4
+measure_max_time = 1.5
 
-
-def try_measure(this_pcs, this_ms2, command_ma):
-    time.sleep(0.1)
-    this_pcs.command_current_ma(command_ma)
-    current_command_actual_ma = this_pcs.get_current_setting_ma()
-    if current_command_actual_ma is not None and ( np.abs((command_ma - current_command_actual_ma) / command_ma) < 0.01):
-        time.sleep(0.01)
-        this_ms2.measure(0.5) # Dummy measure first
-        this_ms2.clear_measurements()
-        this_ms2.measure(1.0)
-        (num_meas, avg_ma, std_dev_ma) = this_ms2.measurement_stats()
-        if avg_ma is not None:
-            return (current_command_actual_ma, num_meas, avg_ma, std_dev_ma)
-        else:
-            return (None, None, None, None)
-    else:
-        return (None, None, None, None)
+# With adaptive_sweep the levels start from a coarse grid and are refined
+# where the error changes by more than sweep_error_tol_pct between
+# neighbours or the supply changes stage; otherwise num_levels fixed levels
+# are measured
+adaptive_sweep = True
+num_levels = 75
+num_coarse_levels = 12
+sweep_error_tol_pct = 0.05
+min_current_ma = 0.00005
+max_current_ma = 250.0
 
 if __name__ == "__main__":
 
-    num_levels = 75
-    current_commands_ma = np.geomspace(0.00005, 250.0, num=num_levels, endpoint=True)
-    current_commands_actual_ma = np.zeros(num_levels)
-    current_measured_ma = np.zeros(num_levels)
-    error_pct = np.zeros(num_levels)
-    error_2sigma_pct = np.zeros(num_levels)
-
     print("Plug in MetaShunt and supply and press enter")
     input()
     this_ms2 = ms2.MetaShuntV2()
@@ -42,26 +30,26 @@ if __name__ == "__main__":
     this_pcs = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
     this_pcs.connect()
 
-    for index, command_ma in enumerate(current_commands_ma):
-        for attempt in range(3):
-            (current_command_actual_ma, num_meas, avg_ma, std_dev_ma) = try_measure(this_pcs=this_pcs, this_ms2=this_ms2, command_ma=command_ma)
-            if avg_ma is not None:
-                current_commands_actual_ma[index] = current_command_actual_ma
-                current_measured_ma[index] = avg_ma
-                error_pct[index] = 100.0 * (current_measured_ma[index] - current_commands_actual_ma[index]) / current_commands_actual_ma[index]
-                print("Currently, measurement at index {0} is off by {1:.5f} percent from {2:.6f}mA".format(index, error_pct[index], current_measured_ma[index]))
-                if current_measured_ma[index] > current_commands_actual_ma[index]:
-                    current_meas_2sigma_ma = avg_ma + 2.0*std_dev_ma
-                    error_2sigma_pct[index] = 100.0 * (current_meas_2sigma_ma - current_commands_actual_ma[index]) / current_commands_actual_ma[index]
-                else:
-                    current_meas_2sigma_ma = avg_ma - 2.0*std_dev_ma
-                    error_2sigma_pct[index] = 100.0 * (current_meas_2sigma_ma - current_commands_actual_ma[index]) / current_commands_actual_ma[index]
-                break
+    engine = se.SweepEngine(this_pcs, this_ms2, rel_precision=measure_rel_precision, max_time=measure_max_time)
+    if adaptive_sweep:
+        results = engine.run_adaptive(min_current_ma, max_current_ma, num_coarse=num_coarse_levels, error_tol_pct=sweep_error_tol_pct)
+    else:
+        # Levels the supply can hit exactly, so no time goes on levels
+        # that round to the same setting
+        results = engine.run(sm.plan_sweep(min_current_ma, max_current_ma, num_levels)["request_ma"])
+    current_commands_actual_ma = results["actual_ma"]
+    error_pct = results["error_pct"]
+    error_2sigma_pct = results["error_2sigma_pct"]
+    error_p95_pct = results["error_p95_pct"]
+
+    for index, row in enumerate(results):
+        if row["ok"]:
+            print("Currently, measurement at index {0} is off by {1:.5f} percent from {2:.6f}mA".format(index, row["error_pct"], row["mean_ma"]))
+        else:
+            print("Measurement at index {0} failed after {1} attempts".format(index, row["attempts"]))
 
     # End at low current
-    this_pcs.command_current_ma(0.01)
-    this_pcs.command_current_ma(0.01)
-    this_pcs.command_current_ma(0.01)
+    this_pcs.set_and_confirm(current_ma=0.01)
 
     # Disconnect
     this_ms2.disconnect()
@@ -70,11 +58,14 @@ if __name__ == "__main__":
     print(current_commands_actual_ma)
     print(error_pct)
     print(error_2sigma_pct)
+    print(error_p95_pct)
 
     # Plots
     fig, ax = plt.subplots()
     ax.semilogx(current_commands_actual_ma*0.001, error_pct, '.-',label='Error of Mean')
     ax.semilogx(current_commands_actual_ma*0.001, error_2sigma_pct, '.-',label='Error of Mean + 2 Sigma')
+    # Holds up where the noise is not Gaussian, e.g. on the lowest stages
+    ax.semilogx(current_commands_actual_ma*0.001, error_p95_pct, '.-',label='Error of 2.5 / 97.5 Percentile')
 
     ax.set(xlabel='Current Supply, A', ylabel='Error, %',
         title='MetaShunt V2 Accuracy vs. Current Supply')
@@ -0,0 +1,173 @@
+import json
+import os
+import struct
+import time
+import numpy as np
+
+# Binary capture files for long recordings. A fixed size header is followed
+# by a flat array of records, either decoded samples (a structured dtype
+# such as metashunt_v2.SAMPLE_DTYPE) or raw bytes from the port (uint8).
+#
+# Header: magic, format version, record size, number of records, capture
+# start time (Unix seconds) and the record dtype as a JSON descriptor.
+# The record count is rewritten on every append, so a capture cut short by
+# a crash still opens with everything appended up to then.
+CAPTURE_MAGIC = b"MSCAPTUR"
+CAPTURE_VERSION = 1
+HEADER_LEN = 128
+RAW_DTYPE = np.dtype(np.uint8)
+
+_HEADER = struct.Struct("<8sHHIQd")
+_NUM_RECORDS_OFFSET = 16
+_DESCR_LEN = HEADER_LEN - _HEADER.size
+
+def _pack_header(dtype, num_records, start_time):
+    descr = json.dumps(np.lib.format.dtype_to_descr(dtype)).encode()
+    if len(descr) > _DESCR_LEN:
+        raise ValueError("Record dtype too large for the capture header")
+    return _HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0, dtype.itemsize, num_records, start_time) + descr.ljust(_DESCR_LEN, b"\0")
+
+def read_header(file_name):
+    # Returns (dtype, num_records, start_time), or None if file_name is not
+    # a capture. num_records is limited to the records actually in the file.
+    with open(file_name, 'rb') as f:
+        header = f.read(HEADER_LEN)
+        file_len = os.fstat(f.fileno()).st_size
+    if len(header) < HEADER_LEN:
+        print("{0} is too short to be a capture".format(file_name))
+        return None
+    (magic, version, _, record_size, num_records, start_time) = _HEADER.unpack_from(header)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        print("{0} is not a version {1} capture".format(file_name, CAPTURE_VERSION))
+        return None
+    descr = json.loads(header[_HEADER.size:].rstrip(b"\0").decode())
+    # JSON turns the descriptor's tuples into lists
+    if isinstance(descr, list):
+        descr = [tuple(field) for field in descr]
+    dtype = np.lib.format.descr_to_dtype(descr)
+    num_records = min(num_records, (file_len - HEADER_LEN) // record_size)
+    return (dtype, num_records, start_time)
+
+def open_capture(file_name):
+    # The records of a capture as a read-only NumPy memmap, so captures far
+    # larger than memory can be sliced and reduced without loading them.
+    # Returns None if file_name is not a capture.
+    header = read_header(file_name)
+    if header is None:
+        return None
+    (dtype, num_records, start_time) = header
+    if num_records == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=HEADER_LEN, shape=(num_records,))
+
+class CaptureWriter:
+    # Appends records to a capture file through a memory map. The file is
+    # extended grow_bytes at a time and trimmed to the records written on
+    # close(), so memory use stays flat however long the capture runs.
+    # Only the records are mapped, and the map is dropped before every
+    # resize: Windows can't resize a file while a mapping of it is open.
+    # The header's record count is written through the file instead.
+    def __init__(self, file_name, dtype=RAW_DTYPE, grow_bytes=64 * 1024 * 1024):
+        self.file_name = file_name
+        self.dtype = np.dtype(dtype)
+        self.grow_records = max(1, grow_bytes // self.dtype.itemsize)
+        self.num_records = 0
+        self.start_time = time.time()
+        self.file = open(file_name, 'w+b')
+        self.file.write(_pack_header(self.dtype, 0, self.start_time))
+        self.file.flush()
+        self.records = None
+        self.capacity = 0
+        self._grow(self.grow_records)
+
+    def _grow(self, min_capacity):
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity += self.grow_records
+        if self.records is not None:
+            self.records.flush()
+            self.records = None
+        self.file.truncate(HEADER_LEN + capacity * self.dtype.itemsize)
+        self.records = np.memmap(self.file, dtype=self.dtype, mode='r+', offset=HEADER_LEN, shape=(capacity,))
+        self.capacity = capacity
+
+    def append(self, records):
+        # records is an array of the capture's dtype, or bytes for a raw
+        # capture
+        if self.dtype == RAW_DTYPE and not isinstance(records, np.ndarray):
+            records = np.frombuffer(records, dtype=np.uint8)
+        n = len(records)
+        if n == 0:
+            return
+        if self.num_records + n > self.capacity:
+            self._grow(self.num_records + n)
+        self.records[self.num_records:self.num_records + n] = records
+        self.num_records += n
+        self.file.seek(_NUM_RECORDS_OFFSET)
+        self.file.write(struct.pack("<Q", self.num_records))
+        self.file.flush()
+
+    def flush(self):
+        self.records.flush()
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.records = None
+        self.file.truncate(HEADER_LEN + self.num_records * self.dtype.itemsize)
+        self.file.close()
+
+class CaptureReplay:
+    # Serial-like port that plays a capture back through the normal decoder
+    # as fast as it is read. Raw captures are handed out as recorded; sample
+    # captures are turned back into frames chunk_size records at a time by
+    # encode (e.g. metashunt_v2.encode_frames). Only one chunk is held in
+    # memory at a time, and input flushes are ignored so nothing is lost.
+    def __init__(self, file_name, encode=None, chunk_size=65536):
+        self.records = open_capture(file_name)
+        if self.records is None:
+            self.records = np.empty(0, dtype=RAW_DTYPE)
+        if self.records.dtype != RAW_DTYPE and encode is None:
+            raise ValueError("Sample captures need an encode function to replay")
+        self.encode = encode
+        self.chunk_size = chunk_size
+        self.pos = 0
+        self.pending = memoryview(b"")
+        self.timeout = 0.0
+        self.is_open = True
+
+    def _next_chunk(self):
+        if len(self.pending) > 0 or self.pos >= len(self.records):
+            return
+        chunk = self.records[self.pos:self.pos + self.chunk_size]
+        self.pos += len(chunk)
+        if self.records.dtype == RAW_DTYPE:
+            self.pending = memoryview(chunk.tobytes())
+        else:
+            self.pending = memoryview(self.encode(chunk))
+
+    def at_end(self):
+        self._next_chunk()
+        return len(self.pending) == 0
+
+    @property
+    def in_waiting(self):
+        self._next_chunk()
+        return len(self.pending)
+
+    def read(self, size=1):
+        self._next_chunk()
+        data = bytes(self.pending[:size])
+        self.pending = self.pending[len(data):]
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
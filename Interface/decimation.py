@@ -0,0 +1,216 @@
+import numpy as np
+
+# Min / max / mean / count of a sample stream at several resolutions, kept
+# up to date as samples arrive so a plot or summary of any stretch of a
+# long capture reads a few thousand buckets instead of every sample.
+#
+# Level 0 buckets base consecutive samples and each level above merges
+# factor buckets of the one below. A level keeps only its newest
+# max_buckets buckets, and a new level is added once the top one has
+# enough to merge, so memory grows with the log of the capture length and
+# the coarser levels always reach back to the start.
+BUCKET_DTYPE = np.dtype([
+    ("t_first", "i8"),
+    ("t_last", "i8"),
+    ("min", "f4"),
+    ("max", "f4"),
+    ("sum", "f8"),
+    ("count", "i8"),
+])
+
+# What view() returns: as BUCKET_DTYPE with the mean in place of the sum
+VIEW_DTYPE = np.dtype([
+    ("t_first", "i8"),
+    ("t_last", "i8"),
+    ("min", "f4"),
+    ("max", "f4"),
+    ("mean", "f8"),
+    ("count", "i8"),
+])
+
+def _merge_groups(buckets, size):
+    # Merge each run of size consecutive buckets into one
+    groups = buckets.reshape(-1, size)
+    merged = np.empty(len(groups), dtype=BUCKET_DTYPE)
+    merged["t_first"] = groups["t_first"][:, 0]
+    merged["t_last"] = groups["t_last"][:, -1]
+    merged["min"] = groups["min"].min(axis=1)
+    merged["max"] = groups["max"].max(axis=1)
+    merged["sum"] = groups["sum"].sum(axis=1)
+    merged["count"] = groups["count"].sum(axis=1)
+    return merged
+
+def _merge_all(buckets):
+    # One bucket covering all of buckets, or None if there are none
+    if len(buckets) == 0:
+        return None
+    return _merge_groups(buckets, len(buckets))
+
+class _Level:
+    # Completed buckets of one level, newest max_buckets of them kept
+    # contiguous as in MeasurementStore, plus the buckets from the level
+    # below (or raw samples, for level 0) not yet making a full bucket
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        capacity = 2 * max_buckets if max_buckets is not None else 64
+        self.buckets = np.empty(capacity, dtype=BUCKET_DTYPE)
+        self.start = 0
+        self.end = 0
+        self.num_total = 0
+        self.tail = np.empty(0, dtype=BUCKET_DTYPE)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get(self):
+        return self.buckets[self.start:self.end]
+
+    def append(self, buckets):
+        n = len(buckets)
+        if n == 0:
+            return
+        self.num_total += n
+        if self.max_buckets is not None and n > self.max_buckets:
+            buckets = buckets[n - self.max_buckets:]
+            n = self.max_buckets
+            (self.start, self.end) = (0, 0)
+        if self.end + n > len(self.buckets):
+            count = self.end - self.start
+            if self.max_buckets is None:
+                capacity = len(self.buckets)
+                while capacity < count + n:
+                    capacity *= 2
+                grown = np.empty(capacity, dtype=BUCKET_DTYPE)
+                grown[:count] = self.buckets[self.start:self.end]
+                self.buckets = grown
+            else:
+                count = min(count, self.max_buckets - n)
+                self.buckets[:count] = self.buckets[self.end - count:self.end]
+            (self.start, self.end) = (0, count)
+        self.buckets[self.end:self.end + n] = buckets
+        self.end += n
+        if self.max_buckets is not None and self.end - self.start > self.max_buckets:
+            self.start = self.end - self.max_buckets
+
+class DecimationPyramid:
+    # Times are any increasing int64 count, e.g. the MetaShunt's unwrapped
+    # device ticks. max_buckets=None keeps every bucket at every level.
+    def __init__(self, base=16, factor=4, max_buckets=8192):
+        if base < 1 or factor < 2:
+            raise ValueError("Need base >= 1 and factor >= 2")
+        if max_buckets is not None and max_buckets < factor:
+            raise ValueError("max_buckets must be at least factor")
+        self.base = base
+        self.factor = factor
+        self.max_buckets = max_buckets
+        self.reset()
+
+    def reset(self):
+        self.levels = [_Level(self.max_buckets)]
+        self.count = 0
+
+    def append(self, t, values):
+        # t and values are arrays of the same length, t increasing
+        n = len(values)
+        if n == 0:
+            return
+        self.count += n
+        samples = np.empty(n, dtype=BUCKET_DTYPE)
+        samples["t_first"] = t
+        samples["t_last"] = t
+        samples["min"] = values
+        samples["max"] = values
+        samples["sum"] = values
+        samples["count"] = 1
+
+        size = self.base
+        level_index = 0
+        while True:
+            level = self.levels[level_index]
+            pending = np.concatenate((level.tail, samples)) if len(level.tail) > 0 else samples
+            num_full = len(pending) // size * size
+            level.tail = pending[num_full:].copy()
+            samples = _merge_groups(pending[:num_full], size) if num_full > 0 else pending[:0]
+            level.append(samples)
+            if level_index + 1 == len(self.levels):
+                if level.num_total < self.factor:
+                    break
+                # Enough to merge, so start the next level from everything
+                # this one holds
+                self.levels.append(_Level(self.max_buckets))
+                samples = level.get()
+            if len(samples) == 0:
+                break
+            size = self.factor
+            level_index += 1
+
+    def num_levels(self):
+        return len(self.levels)
+
+    def bucket_size(self, level):
+        # Samples per bucket at level, for full buckets
+        return self.base * self.factor ** level
+
+    def memory_bytes(self):
+        return sum(level.buckets.nbytes + level.tail.nbytes for level in self.levels)
+
+    def _partial(self, level_index):
+        # One bucket of everything not yet in a completed bucket at
+        # level_index, or None
+        partial = None
+        for level in self.levels[:level_index + 1]:
+            parts = [bucket for bucket in (_merge_all(level.tail), partial) if bucket is not None]
+            partial = _merge_all(np.concatenate(parts)) if parts else None
+        return partial
+
+    def _level_buckets(self, level_index):
+        # Completed buckets of a level, and the partial one after them
+        buckets = self.levels[level_index].get()
+        partial = self._partial(level_index)
+        if partial is None:
+            return buckets
+        return np.concatenate((buckets, partial))
+
+    def get_level(self, level_index, t0=None, t1=None):
+        # VIEW_DTYPE buckets of a level that overlap [t0, t1], the newest
+        # one possibly partial
+        buckets = self._level_buckets(level_index)
+        first = 0 if t0 is None else np.searchsorted(buckets["t_last"], t0, side="left")
+        last = len(buckets) if t1 is None else np.searchsorted(buckets["t_first"], t1, side="right")
+        buckets = buckets[first:last]
+        view = np.empty(len(buckets), dtype=VIEW_DTYPE)
+        for name in ("t_first", "t_last", "min", "max", "count"):
+            view[name] = buckets[name]
+        view["mean"] = buckets["sum"] / np.maximum(buckets["count"], 1)
+        return view
+
+    def choose_level(self, t0=None, t1=None, max_points=2000):
+        # Finest level that still holds [t0, t1] (or everything) in at most
+        # max_points buckets
+        for level_index in range(len(self.levels)):
+            level = self.levels[level_index]
+            if len(level) < level.num_total:
+                # Older buckets have been dropped; only usable from where
+                # they start
+                held_from = level.get()["t_first"][0]
+                if t0 is None or t0 < held_from:
+                    continue
+            if len(self.get_level(level_index, t0, t1)) <= max_points:
+                return level_index
+        return len(self.levels) - 1
+
+    def view(self, t0=None, t1=None, max_points=2000):
+        # Buckets covering [t0, t1] at the finest resolution that fits in
+        # max_points, e.g. for a min/max envelope plot
+        return self.get_level(self.choose_level(t0, t1, max_points), t0, t1)
+
+    def summarize(self, t0=None, t1=None, max_points=2000):
+        # (count, mean, min, max) of the samples in [t0, t1], from the
+        # buckets of view(). Buckets straddling t0 or t1 are counted whole,
+        # so the range is only as exact as that level's bucket width.
+        view = self.view(t0, t1, max_points)
+        count = int(view["count"].sum())
+        if count == 0:
+            return (0, None, None, None)
+        mean = float(np.dot(view["mean"], view["count"]) / count)
+        return (count, mean, float(view["min"].min()), float(view["max"].max()))
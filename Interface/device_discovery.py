@@ -0,0 +1,209 @@
+import json
+import math
+import os
+import threading
+import time
+import serial
+import serial.tools.list_ports
+
+try:
+    from serial.tools.list_ports_linux import SysFS
+except ImportError:
+    SysFS = None
+
+# Attached USB serial devices indexed by (vid, pid) and serial number, with
+# the port each was last seen on kept in cache_filename between runs. A
+# device is opened straight from the cached port when the OS can confirm
+# cheaply that the same device is still there (sysfs on Linux), so the
+# port list is only enumerated when something has moved.
+
+cache_filename = os.path.join(os.path.expanduser("~"), ".hdr_device_ports.json")
+
+# How often the wait_ methods look again. Where the device isn't at its
+# cached port each look enumerates every port, so this is kept to the
+# quarter second DeviceWatcher rescans at.
+poll_interval = 0.25
+
+def _type_key(vid, pid):
+    return "{0:04x}:{1:04x}".format(vid, pid)
+
+class DeviceIndex:
+    def __init__(self, cache_filename=cache_filename):
+        self.cache_filename = cache_filename
+        self.lock = threading.Lock()
+        # type key -> serial number -> port, as of the last scan() or
+        # as loaded from the cache
+        self.ports = {}
+        if cache_filename is not None and os.path.exists(cache_filename):
+            try:
+                with open(cache_filename) as f:
+                    self.ports = json.load(f)
+            except (OSError, ValueError):
+                print("Ignoring unreadable device cache {0}".format(cache_filename))
+
+    def _save(self):
+        if self.cache_filename is None:
+            return
+        try:
+            with open(self.cache_filename, 'w') as outf:
+                json.dump(self.ports, outf, indent=2)
+        except OSError:
+            pass
+
+    def scan(self):
+        # Enumerate the ports and rebuild the index. Returns it.
+        ports = {}
+        for comport in serial.tools.list_ports.comports():
+            if comport.vid is None:
+                continue
+            ports.setdefault(_type_key(comport.vid, comport.pid), {})[comport.serial_number or ""] = comport.device
+        with self.lock:
+            changed = ports != self.ports
+            self.ports = ports
+            if changed:
+                self._save()
+            return {key : dict(devices) for (key, devices) in ports.items()}
+
+    def serial_numbers(self, vid, pid):
+        # Serial numbers of the attached devices of a type, in order
+        return sorted(self.scan().get(_type_key(vid, pid), {}))
+
+    def _cached_port(self, vid, pid, serial_number):
+        # The cached port for the device, if it is confirmed to still be
+        # there. Returns (port, serial_number) or None.
+        with self.lock:
+            devices = dict(self.ports.get(_type_key(vid, pid), {}))
+        if SysFS is None or not devices:
+            return None
+        if serial_number is None:
+            if len(devices) != 1:
+                return None
+            (serial_number, port) = next(iter(devices.items()))
+        else:
+            port = devices.get(serial_number)
+            if port is None:
+                return None
+        try:
+            info = SysFS(port)
+        except (OSError, ValueError):
+            return None
+        if info.vid != vid or info.pid != pid or (info.serial_number or "") != serial_number:
+            return None
+        return (port, serial_number)
+
+    def find(self, vid, pid, serial_number=None):
+        # (port, serial_number) of the device, or of the first of its type
+        # without a serial number, or None if it is not attached
+        found = self._cached_port(vid, pid, serial_number)
+        if found is not None:
+            return found
+        devices = self.scan().get(_type_key(vid, pid), {})
+        if serial_number is None:
+            if not devices:
+                return None
+            serial_number = sorted(devices)[0]
+        port = devices.get(serial_number)
+        if port is None:
+            return None
+        return (port, serial_number)
+
+    def open(self, vid, pid, serial_number=None, timeout=0.1):
+        # (serial.Serial, serial_number) for the device, or None
+        found = self.find(vid, pid, serial_number)
+        if found is None:
+            return None
+        (port, serial_number) = found
+        try:
+            return (serial.Serial(port, timeout=timeout), serial_number)
+        except serial.SerialException:
+            # Gone or renumbered since it was found; look once more
+            found = self.find(vid, pid, serial_number)
+            if found is None or found[0] == port:
+                return None
+            try:
+                return (serial.Serial(found[0], timeout=timeout), serial_number)
+            except serial.SerialException:
+                return None
+
+    def wait_until_attached(self, vid, pid, serial_number=None, timeout=math.inf):
+        # Poll until the device (or one of its type) is attached. Returns
+        # find()'s (port, serial_number), or None after timeout seconds.
+        end_time = time.time() + timeout
+        while True:
+            found = self.find(vid, pid, serial_number)
+            if found is not None or time.time() >= end_time:
+                return found
+            time.sleep(poll_interval)
+
+    def wait_until_detached(self, vid, pid, serial_number, timeout=math.inf):
+        # Poll until the device is gone. Returns False if it is still there
+        # after timeout seconds. While it is still at its cached port that
+        # is all each look checks.
+        end_time = time.time() + timeout
+        while ((serial_number is not None and self._cached_port(vid, pid, serial_number) is not None)
+                or serial_number in self.serial_numbers(vid, pid)):
+            if time.time() >= end_time:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def wait_for_device(self, vid, pid, serial_number, timeout, port_timeout=0.1):
+        # Keep trying to open the device until it is back or timeout seconds
+        # pass. Returns (serial.Serial, serial_number) or None.
+        end_time = time.time() + timeout
+        while True:
+            opened = self.open(vid, pid, serial_number, port_timeout)
+            if opened is not None or time.time() >= end_time:
+                return opened
+            time.sleep(poll_interval)
+
+# Shared by the device classes
+default_index = DeviceIndex()
+
+class DeviceWatcher:
+    # Rescans index every interval seconds on a background thread and calls
+    # on_added(vid, pid, serial_number, port) and
+    # on_removed(vid, pid, serial_number, port) as devices come and go. A
+    # device that re-enumerates on a new port shows up as removed then
+    # added.
+    def __init__(self, index=default_index, on_added=None, on_removed=None, interval=0.25):
+        self.index = index
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _entries(self, ports):
+        entries = set()
+        for (key, devices) in ports.items():
+            (vid, pid) = (int(value, 16) for value in key.split(":"))
+            for (serial_number, port) in devices.items():
+                entries.add((vid, pid, serial_number, port))
+        return entries
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._watch_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def _watch_loop(self):
+        known = self._entries(self.index.scan())
+        while not self.stop_event.wait(self.interval):
+            current = self._entries(self.index.scan())
+            for entry in sorted(known - current):
+                if self.on_removed is not None:
+                    self.on_removed(*entry)
+            for entry in sorted(current - known):
+                if self.on_added is not None:
+                    self.on_added(*entry)
+            known = current
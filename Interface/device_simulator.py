@@ -0,0 +1,401 @@
+import heapq
+import itertools
+import math
+import struct
+import threading
+import time
+import numpy as np
+import ladder_solver as ls
+import metashunt_v2 as ms2
+import serial_protocol as sp
+import supply_model as sm
+
+# In-process stand-ins for the HDR supply and the MetaShunt V2 that look
+# like a pyserial port, so the interface scripts can run without hardware:
+#
+#   supply_ser = SimulatedHDRSupply()
+#   ms_ser = SimulatedMetaShunt(current_source=supply_ser.output_ma)
+#   this_pcs.connect(ser=supply_ser)
+#   this_ms2.connect(ser=ms_ser)
+#
+# Both take latency (seconds before anything the device sends becomes
+# readable) and per-byte corrupt_prob / drop_prob for injecting faults.
+
+def damage_bytes(data, corrupt_prob, drop_prob, rng):
+    # Flip each byte to a different value with probability corrupt_prob and
+    # then drop each with probability drop_prob
+    if corrupt_prob <= 0.0 and drop_prob <= 0.0:
+        return bytes(data)
+    data = np.frombuffer(bytes(data), dtype=np.uint8).copy()
+    if corrupt_prob > 0.0:
+        hit = rng.random(len(data)) < corrupt_prob
+        data[hit] ^= rng.integers(1, 256, np.count_nonzero(hit), dtype=np.uint8)
+    if drop_prob > 0.0:
+        data = data[rng.random(len(data)) >= drop_prob]
+    return data.tobytes()
+
+def make_sample_stream(num_samples, current_ma=1.0, noise_ma=1e-3, tick_step=100, seed=None):
+    # A recorded-looking MetaShunt V2 stream of num_samples frames
+    rng = np.random.default_rng(seed)
+    samples = np.empty(num_samples, dtype=ms2.SAMPLE_DTYPE)
+    samples["time"] = (np.arange(num_samples, dtype=np.int64) * tick_step) & 0xFFFFFFFF
+    samples["current_ma"] = current_ma + noise_ma * rng.standard_normal(num_samples)
+    return ms2.encode_frames(samples)
+
+class ReplaySerial:
+    # Serial-like port that hands out a recorded byte stream as fast as it
+    # is read, chunk_size bytes at a time. Input flushes are ignored so
+    # nothing in the recording is lost.
+    def __init__(self, data, chunk_size=4096):
+        self.data = memoryview(bytes(data))
+        self.chunk_size = chunk_size
+        self.pos = 0
+        self.timeout = 0.0
+        self.is_open = True
+
+    def at_end(self):
+        return self.pos >= len(self.data)
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk_size, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        data = bytes(self.data[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+class SimulatedSerial:
+    def __init__(self, latency=0.0, corrupt_prob=0.0, drop_prob=0.0, seed=None):
+        self.timeout = 0.1
+        self.is_open = True
+        self.latency = latency
+        self.corrupt_prob = corrupt_prob
+        self.drop_prob = drop_prob
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.rx = bytearray()
+        # Bytes on their way to the host, as (ready_time, order, data)
+        self.in_flight = []
+        self.order = itertools.count()
+
+    def _poll(self, now):
+        # Subclasses generate anything the device sends on its own here
+        pass
+
+    def _send(self, data, ready_time):
+        # Called with lock held
+        data = damage_bytes(data, self.corrupt_prob, self.drop_prob, self.rng)
+        heapq.heappush(self.in_flight, (ready_time + self.latency, next(self.order), data))
+
+    def _update(self):
+        # Called with lock held
+        now = time.time()
+        self._poll(now)
+        while self.in_flight and self.in_flight[0][0] <= now:
+            self.rx += heapq.heappop(self.in_flight)[2]
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self._update()
+            return len(self.rx)
+
+    def read(self, size=1):
+        end_time = time.time() + (self.timeout if self.timeout is not None else math.inf)
+        while True:
+            with self.lock:
+                self._update()
+                if len(self.rx) >= size or time.time() >= end_time or not self.is_open:
+                    data = bytes(self.rx[:size])
+                    del self.rx[:size]
+                    return data
+            time.sleep(0.0005)
+
+    def write(self, data):
+        with self.lock:
+            self._update()
+            self._receive(bytes(data), time.time())
+        return len(data)
+
+    def _receive(self, data, now):
+        pass
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self._update()
+            self.rx = bytearray()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+def _f32(x):
+    return float(np.float32(x))
+
+# Setpoint constants from main.c. The supply's setpoint math is written out
+# again below from the C, one scalar at a time, rather than taken from
+# supply_model, so that comparing the two checks the model.
+_R_DEFAULT = np.float32(10000000.0)
+_R_G = [np.float32(r) for r in (7.66, 12.76666, 100.0, 1000.0, 10000.0, 100000.0, 1000000.0)]
+_FET_R_OHM = np.float32(0.048)
+# set_current_level()'s if / else if chain: (limit in mA, stage)
+_CURRENT_LEVELS = [(250.0 * 1.0e-6, 7), (0.002, 6), (0.02, 5), (0.2, 4), (2.0, 3), (20.0, 2), (190.0, 1), (326.0, 0)]
+
+def _calc_r_parallel_to_default(r):
+    # float argument and return, double arithmetic in between
+    return np.float32(1.0 / ((1.0 / float(_R_DEFAULT)) + (1.0 / float(r))))
+
+def _stage_r(stage):
+    # r_vals[stage] in _get_current_level()
+    if stage == 7:
+        return _R_DEFAULT
+    return _calc_r_parallel_to_default(_R_G[stage] + _FET_R_OHM)
+
+class SimulatedHDRSupply(SimulatedSerial):
+    # Emulates the command handling in usb_interface.c and main.c. Each
+    # write is handled like one USB packet: the parser restarts at the start
+    # of it and only the last complete command in it is acted on. The output
+    # current follows a commanded change with a first order response of
+    # time constant settle_time, from the DAC output as supply_model has it.
+    def __init__(self, constant_ref_mode=False, settle_time=0.001, **kwargs):
+        super().__init__(**kwargs)
+        self.constant_ref_mode = constant_ref_mode
+        self.settle_time = settle_time
+        self.scale = 7
+        # _ref_v, and the DAC command in mV that set it
+        self.ref_v = np.float32(3.0)
+        self.ref_mv = int(round(sm.FIXED_REF_V * 1000.0))
+        self.step = 0
+        self.count = 0
+        self.chk = 0
+        self.msg_type = 0
+        self.length = 0
+        self.payload = bytearray(256)
+        # Output history for output_ma(): level before and after the last change
+        self.output_from_ma = self.current_level_ma()
+        self.output_to_ma = self.output_from_ma
+        self.output_change_time = 0.0
+
+    def current_level_ma(self):
+        # _get_current_level()
+        if self.constant_ref_mode:
+            self.ref_v = np.float32(3.0)
+            self.ref_mv = int(round(sm.FIXED_REF_V * 1000.0))
+        current_level_a = self.ref_v / _stage_r(self.scale)
+        return float(np.float32(float(current_level_a) * 1000.0))
+
+    def set_scale(self, scale):
+        if scale > 7:
+            return
+        self.scale = scale
+
+    def set_voltage_on_dac(self, v_output):
+        # _set_voltage_on_dac(): (uint16_t) round(v_output * 1000.0). round()
+        # goes half away from zero; a negative command is undefined in C and
+        # taken as 0, and one past 16 bits wraps.
+        mv = float(v_output) * 1000.0
+        cmd_mv = max(0, int(math.floor(mv + 0.5))) & 0xFFFF
+        self.ref_mv = cmd_mv
+        self.ref_v = np.float32(cmd_mv * 0.001)
+
+    def set_current_level(self, current_command_ma):
+        # The float request against double literals, as in the C
+        current_command_ma = float(np.float32(current_command_ma))
+        for (limit_ma, stage) in _CURRENT_LEVELS:
+            if current_command_ma < limit_ma:
+                self.set_scale(stage)
+                v_output = np.float32((current_command_ma * 0.001) * float(_stage_r(stage)))
+                self.set_voltage_on_dac(v_output)
+                return
+
+    def _process_byte(self, b):
+        if self.step == 0:
+            if b == sp.FRAME_SYNC:
+                self.step = 1
+                self.chk = 0
+        elif self.step == 1:
+            self.msg_type = b
+            self.chk = (self.chk + b) & 0xFF
+            self.step = 2
+        elif self.step == 2:
+            self.length = b
+            self.chk = (self.chk + b) & 0xFF
+            self.step = 3
+            self.count = 0
+        elif self.step == 3:
+            self.payload[self.count] = b
+            self.count += 1
+            self.chk = (self.chk + b) & 0xFF
+            if self.count >= self.length:
+                self.step = 4
+        elif self.step == 4:
+            self.step = 0
+            return self.chk == b
+        return False
+
+    def _receive(self, data, now):
+        self.step = 0
+        command = None
+        for b in data:
+            if self._process_byte(b):
+                command = (self.msg_type, bytes(self.payload[:self.length]))
+        if command is None:
+            return
+
+        (msg_type, payload) = command
+        if msg_type == sp.SET_CURRENT:
+            self.set_current_level(struct.unpack("<f", payload[:4])[0])
+        elif msg_type == sp.SET_SCALE:
+            self.set_scale(payload[0])
+        else:
+            return
+
+        # HAL_Delay(10) then transmit_current_setting()
+        level_ma = self.current_level_ma()
+        self.output_from_ma = self.output_ma(now)
+        if self.constant_ref_mode:
+            self.output_to_ma = level_ma
+        else:
+            self.output_to_ma = float(sm.output_current_ma(self.scale, self.ref_mv))
+        self.output_change_time = now
+        frame = bytearray(struct.pack("<BBBf", sp.FRAME_SYNC, sp.CURRENT_SET, 4, level_ma))
+        frame.append(sp.checksum(frame[1:]))
+        self._send(frame, now + 0.01)
+
+    def output_ma(self, t):
+        # True output current at host time(s) t
+        t = np.asarray(t, dtype=np.float64)
+        elapsed = np.maximum(t - self.output_change_time, 0.0)
+        if self.settle_time > 0.0:
+            decay = np.exp(-elapsed / self.settle_time)
+        else:
+            decay = 0.0
+        return self.output_to_ma + (self.output_from_ma - self.output_to_ma) * decay
+
+# MetaShunt autoranging: the ladder index used for each current, by upper
+# limit in mA
+METASHUNT_RANGE_LIMITS_MA = [0.001, 0.01, 0.1, 1.0, 10.0, 100.0, 300.0]
+
+class SimulatedMetaShunt(SimulatedSerial):
+    # Streams 8-byte sample frames at sample_rate, with device time in
+    # ticks of tick_hz starting from tick_offset (so wraparound can be
+    # exercised), and answers config reads and writes. The reading is the
+    # current from current_source(t), scaled by how far the stored config
+    # is from true_config at the range in use, plus Gaussian noise of
+    # noise_rel * current + noise_ma.
+    #
+    # Like the firmware, commands land in a single slot that the main loop
+    # empties when it is free: a command that arrives while the slot is
+    # still full replaces the one in it. A read takes command_time and a
+    # write, which is persisted, write_time.
+    def __init__(self, current_source=None, sample_rate=10000.0, tick_hz=1000000.0, tick_offset=0,
+                 noise_rel=1e-4, noise_ma=1e-7, config=None, true_config=None,
+                 command_time=0.0005, write_time=0.02, **kwargs):
+        super().__init__(**kwargs)
+        self.current_source = current_source
+        self.sample_rate = sample_rate
+        self.tick_hz = tick_hz
+        self.tick_offset = tick_offset
+        self.noise_rel = noise_rel
+        self.noise_ma = noise_ma
+        if config is None:
+            config = ls.arrays_to_config([100000.0, 10000.0, 1000.0, 100.0, 10.0, 1.0, 0.1, 0.05], 0.05)
+        self.config = {ms2.config_index_dict[key] : _f32(value) for (key, value) in config.items()}
+        if true_config is None:
+            true_config = config
+        (self.true_resistors, self.true_r_fet) = ls.config_to_arrays(true_config)
+        self.decoder = sp.FrameDecoder()
+        self.command_time = command_time
+        self.write_time = write_time
+        # (arrival time, msg_type, payload) waiting in the slot, the command
+        # being worked on and when it is done
+        self.slot = None
+        self.working = None
+        self.busy_until = 0.0
+        self.num_overwritten = 0
+        self.start_time = time.time()
+        self.num_sent = 0
+        self.running = True
+
+    def _gains(self):
+        # Measured / true current at each ladder index
+        config = {key : self.config[index] for (key, index) in ms2.config_index_dict.items()}
+        (resistors, r_fet) = ls.config_to_arrays(config)
+        return ls.effective_resistance(self.true_resistors, self.true_r_fet) / ls.effective_resistance(resistors, r_fet)
+
+    def _run_commands(self, now):
+        # Everything the main loop gets through up to now
+        while True:
+            if self.working is not None:
+                if self.busy_until > now:
+                    return
+                (msg_type, payload) = self.working
+                self.working = None
+                if msg_type == ms2.SET_CONFIG:
+                    (index, value) = struct.unpack("<Bf", payload)
+                    self.config[index] = value
+                else:
+                    index = payload[0]
+                    # Lands between sample frames
+                    self._send_samples(self.busy_until)
+                    self._send(ms2.encode_config_response(index, self.config.get(index, 0.0)), self.busy_until)
+            if self.slot is None:
+                return
+            (arrival_time, msg_type, payload) = self.slot
+            self.slot = None
+            self.working = (msg_type, payload)
+            duration = self.write_time if msg_type == ms2.SET_CONFIG else self.command_time
+            self.busy_until = max(arrival_time, self.busy_until) + duration
+
+    def _poll(self, now):
+        self._run_commands(now)
+        self._send_samples(now)
+
+    def _send_samples(self, now):
+        if not self.running:
+            return
+        total = int((now - self.start_time) * self.sample_rate)
+        n = total - self.num_sent
+        if n <= 0:
+            return
+        # Like the device's USB buffer, only hold on to the last second
+        n_max = max(1, int(self.sample_rate))
+        if n > n_max:
+            self.num_sent += n - n_max
+            n = n_max
+
+        k = np.arange(self.num_sent, self.num_sent + n)
+        t = self.start_time + k / self.sample_rate
+        if self.current_source is not None:
+            true_ma = np.broadcast_to(self.current_source(t), t.shape).astype(np.float64)
+        else:
+            true_ma = np.zeros(n)
+        ladder = np.searchsorted(METASHUNT_RANGE_LIMITS_MA, np.abs(true_ma))
+        measured_ma = true_ma * self._gains()[ladder]
+        measured_ma += self.rng.standard_normal(n) * (self.noise_rel * np.abs(true_ma) + self.noise_ma)
+
+        samples = np.empty(n, dtype=ms2.SAMPLE_DTYPE)
+        samples["time"] = (self.tick_offset + np.round(k * (self.tick_hz / self.sample_rate)).astype(np.int64)) & 0xFFFFFFFF
+        samples["current_ma"] = measured_ma
+        self.num_sent += n
+        self._send(ms2.encode_frames(samples), now)
+
+    def _receive(self, data, now):
+        for (msg_type, payload) in self.decoder.feed(data):
+            if (msg_type, len(payload)) in [(ms2.SET_CONFIG, 5), (ms2.GET_CONFIG, 1)]:
+                if self.slot is not None:
+                    self.num_overwritten += 1
+                self.slot = (now, msg_type, payload)
+                self._run_commands(now)
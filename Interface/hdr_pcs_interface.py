@@ -1,151 +1,229 @@
-import serial
-import time 
-import struct 
-import sys 
-import serial.tools.list_ports
-import numpy as np
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+# Modules that take a while to import (NumPy and pyserial through the
+# device classes) are only imported when the device is used from this
+# process, so a command handed to a running server returns quickly.
+
+# Commands go to a server started with "serve" when one is listening here
+socket_path = os.environ.get("HDR_PCS_SOCKET", os.path.join(tempfile.gettempdir(), "hdr_pcs.sock"))
 
 class CURRENT_SETTING:
     def __init__(self, time, stage, current_ma):
-        self.time = time 
+        self.time = time
         self.stage = stage
-        self.current_ma = current_ma 
-
-def get_packet(ser, start_time, timeout):
-    step = 0
-    count = 0
-    msg_type = 0
-    length = 0
-    chk = 0
-    payload = []
-
-    while time.time() < start_time + timeout:
-        try:
-            data = ser.read(1)
-        except TypeError:
-            return None
-        if data:
-            data = ord(data)
-
-        if(step == 0 and data == 0xAA):
-            step += 1
-            chk = 0
-        elif(step == 1):
-            msg_type = data
-            step += 1
-            chk += data
-            chk &= 0xFF
-        elif(step == 2):
-            length = data 
-            step += 1
-            chk += data
-            chk &= 0xFF
-        elif(step == 3):
-            if(count < length):
-                payload.append(data)
-                count += 1
-                chk += data
-                chk &= 0xFF
-                if count == length:
-                    step += 1
-        elif(step == 4):
-            if(data == chk):
-                return (msg_type, length, payload)
-            else:
-                print("Checksum wrong. Should be {0}, was {1}".format(chk, data))
-                print("Payload: ")
-                print(payload)
-                step = 0
-                count = 0
-                payload = []
+        self.current_ma = current_ma
 
 def display_how_to_use():
     print("To use, follow these rules:")
     print("python hdr_pcs_interface.py h --- Provides helpful information")
     print("python hdr_pcs_interface.py s [scale] --- Set to specific scale if in constant reference mode")
     print("python hdr_pcs_interface.py c [current_setting_mA]  --- Set to specific current if in adjustable reference mode")
+    print("Several commands can be given in one call, e.g. python hdr_pcs_interface.py c 0.1 c 1.0")
+    print("python hdr_pcs_interface.py serve --- Hold the supply open and take commands from other calls")
+    print("python hdr_pcs_interface.py stop --- Stop the server")
+    print("The server listens on {0} (set HDR_PCS_SOCKET to change)".format(socket_path))
+
+def parse_commands(args):
+    # [(command_character, value), ...] from s/c arguments, or None if they
+    # don't parse
+    commands = []
+    i = 0
+    while i < len(args):
+        command_character = args[i]
+        if command_character not in ("s", "c") or i + 1 >= len(args):
+            return None
+        try:
+            value = int(args[i + 1]) if command_character == "s" else float(args[i + 1])
+        except ValueError:
+            return None
+        commands.append((command_character, value))
+        i += 2
+    return commands
+
+def describe(command_character, value, current_set_ma):
+    if current_set_ma is None:
+        return "No confirmation from HDR Precision Current Source"
+    if command_character == "s":
+        return "At stage {0}, current setting is {1:.6f} mA".format(value, current_set_ma)
+    return "Current commanded {0:.6f} mA, current setting is {1:.6f} mA".format(value, current_set_ma)
+
+class DeviceSession:
+    # The supply opened from this process. Access is serialized so any
+    # number of server clients can share it.
+    def __init__(self):
+        import HDRPrecisionCurrentSupply as pcs
+        self.pcs = pcs
+        self.supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.FIXED_REFERENCE)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return self.supply.connect()
+
+    def command(self, command_character, value):
+        # Returns the current the supply reports, or None. The script has
+        # always sent either command whatever mode the firmware is built
+        # for, so the supply type follows the command.
+        with self.lock:
+            if command_character == "s":
+                self.supply.supply_type = self.pcs.CurrentSupplyType.FIXED_REFERENCE
+                return self.supply.set_and_confirm(stage=value, timeout=0.5, max_attempts=1)
+            self.supply.supply_type = self.pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE
+            return self.supply.set_and_confirm(current_ma=value, timeout=0.5, max_attempts=1)
+
+    def reconnect(self):
+        with self.lock:
+            try:
+                self.supply.disconnect()
+            except Exception:
+                pass
+            return self.supply.connect(serial_number=self.supply.serial_number)
+
+    def disconnect(self):
+        with self.lock:
+            self.supply.disconnect()
+
+def serve(session):
+    # Line based protocol: each request is "s N" or "c X" and is answered
+    # with "ok <current_mA>" or "error <message>". A client may send any
+    # number of requests on one connection. "stop" shuts the server down.
+    import socketserver
+    import serial
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                words = line.decode().split()
+                if words == ["stop"]:
+                    self.wfile.write(b"ok\n")
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                    return
+                commands = parse_commands(words)
+                if commands is None or len(commands) != 1:
+                    self.wfile.write(b"error bad command\n")
+                    continue
+                (command_character, value) = commands[0]
+                try:
+                    current_set_ma = session.command(command_character, value)
+                except serial.SerialException as e:
+                    print("Lost HDR Precision Current Source ({0}), reconnecting".format(e))
+                    session.reconnect()
+                    self.wfile.write("error {0}\n".format(e).encode())
+                    continue
+                if current_set_ma is None:
+                    self.wfile.write(b"error no reply\n")
+                else:
+                    self.wfile.write("ok {0!r}\n".format(current_set_ma).encode())
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        # Left behind by a server that didn't shut down cleanly, unless one
+        # is still answering
+        if send_commands([]) is not None:
+            print("A server is already listening on {0}".format(socket_path))
+            return
+        os.unlink(socket_path)
+    with Server(socket_path, Handler) as server:
+        print("Serving HDR Precision Current Source on {0}".format(socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    os.unlink(socket_path)
+
+class PcsClient:
+    # Connection to a running server, for scripts that send many commands:
+    #
+    #   with PcsClient() as client:
+    #       current_set_ma = client.command("c", 1.0)
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path if path is None else path)
+        self.rfile = self.sock.makefile("rb")
+
+    def request(self, line):
+        self.sock.sendall((line + "\n").encode())
+        return self.rfile.readline().decode().strip()
+
+    def command(self, command_character, value):
+        # Returns the current the supply reports, or None
+        reply = self.request("{0} {1!r}".format(command_character, value)).split(" ", 1)
+        if reply[0] != "ok":
+            return None
+        return float(reply[1])
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def send_commands(commands):
+    # Results of commands from a running server, or None if no server is
+    # listening
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return None
+    try:
+        client = PcsClient()
+    except OSError:
+        return None
+    with client:
+        return [client.command(command_character, value) for (command_character, value) in commands]
 
 if __name__ == "__main__":
 
-    # Figure out the correct port
-    port = ""
-    connected = [comport for comport in serial.tools.list_ports.comports()]
-
-    for comport in connected:
-        if comport.vid == 1155 and comport.pid == 100:
-            port = comport[0]
-            break
-
-    if port != "":
-        ser = serial.Serial(port, timeout=0.1)  # open serial port
-        print("Connected to HDR Precision Current Source")
-    else:
-        print("Could not connect to HDR Precision Current Source")
-        sys.exit()
-
-    ser.reset_input_buffer()
-
-    if(len(sys.argv) > 1):
-        command_character = sys.argv[1]
-        if command_character == 's':
-            print("Stage command")
-            if len(sys.argv) > 2:
-                stage = int(sys.argv[2])
-            else:
-                print("With scale command, please provide a scale")
-                display_how_to_use()
-                exit()
-
-            # Assemble command and send
-            payload = [0xAA,0x04,1,stage]
-
-            chk = 0
-            for i in range(1,len(payload)):
-                chk += payload[i]
-                chk &= 0xFF
-            payload.append(chk)
-            ser.write(bytearray(payload))
-
-            (msg_type, length, payload) = get_packet(ser, time.time(), 0.5)
-            if(msg_type == 5 and length == 4):
-                # CURRENT_SET 
-                current_set_mA = struct.unpack('<f', bytes(payload))[0]
-                print("At stage {0}, current setting is {1:.6f} mA".format(stage, current_set_mA))
-
-        elif command_character == 'c':
-            print("Current command")
-            if len(sys.argv) > 2:
-                current_cmd_mA = float(sys.argv[2])
-            else:
-                print("With current command, please provide a current in mA")
-                display_how_to_use()
-                exit()
-
-            # Assemble command and send
-            payload = [0xAA,0x00,4]
-            payload.extend(struct.pack('<f', current_cmd_mA))
-
-            chk = 0
-            for i in range(1,len(payload)):
-                chk += payload[i]
-                chk &= 0xFF
-            payload.append(chk)
-            ser.write(bytearray(payload))
-
-            (msg_type, length, payload) = get_packet(ser, time.time(), 0.5)
-            if(msg_type == 5 and length == 4):
-                # CURRENT_SET 
-                current_set_mA = struct.unpack('<f', bytes(payload))[0]
-                print("Current commanded {0:.6f} mA, current setting is {1:.6f} mA".format(current_cmd_mA, current_set_mA))
-
-            
-        elif command_character == 'h':
-            display_how_to_use()
-            exit()
-    else:
+    if len(sys.argv) < 2:
+        print("Incorrect inputs. Please follow the instructions below.")
+        print("..........")
+        display_how_to_use()
+        exit()
+
+    command_character = sys.argv[1]
+    if command_character == 'h':
+        display_how_to_use()
+        exit()
+
+    if command_character == 'stop':
+        try:
+            with PcsClient() as client:
+                client.request("stop")
+            print("Server stopped")
+        except OSError:
+            print("No server listening on {0}".format(socket_path))
+        exit()
+
+    if command_character == 'serve':
+        session = DeviceSession()
+        if not session.connect():
+            sys.exit()
+        serve(session)
+        session.disconnect()
+        exit()
+
+    commands = parse_commands(sys.argv[1:])
+    if commands is None:
         print("Incorrect inputs. Please follow the instructions below.")
         print("..........")
         display_how_to_use()
         exit()
 
-    ser.close()
\ No newline at end of file
+    results = send_commands(commands)
+    if results is None:
+        # No server, so open the supply for just these commands
+        session = DeviceSession()
+        if not session.connect():
+            sys.exit()
+        results = [session.command(command_character, value) for (command_character, value) in commands]
+        session.disconnect()
+
+    for ((command_character, value), current_set_ma) in zip(commands, results):
+        print(describe(command_character, value, current_set_ma))
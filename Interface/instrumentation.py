@@ -0,0 +1,158 @@
+import json
+import math
+import queue
+import sys
+import threading
+import time
+import numpy as np
+
+# Protocol health counters and latency histograms for the device classes.
+# Everything is kept in memory and cheap enough to update from the read
+# loop; snapshot() returns a plain dict that can be printed, compared or
+# dumped as JSON.
+
+class LatencyHistogram:
+    # Durations in log spaced bins, bins_per_decade per decade from min_s to
+    # max_s, plus underflow and overflow bins at either end
+    def __init__(self, min_s=1.0e-6, max_s=100.0, bins_per_decade=10):
+        self.min_s = min_s
+        self.bins_per_decade = bins_per_decade
+        self.num_bins = int(math.ceil(math.log10(max_s / min_s) * bins_per_decade)) + 2
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(self.num_bins, dtype=np.int64)
+        self.count = 0
+        self.total_s = 0.0
+        self.min = None
+        self.max = None
+
+    def _bin(self, seconds):
+        if seconds < self.min_s:
+            return 0
+        return min(self.num_bins - 1, 1 + int(math.log10(seconds / self.min_s) * self.bins_per_decade))
+
+    def record(self, seconds):
+        self.counts[self._bin(seconds)] += 1
+        self.count += 1
+        self.total_s += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def bin_edges(self):
+        # Upper edge of each bin; the last one is open ended
+        edges = self.min_s * 10.0 ** (np.arange(self.num_bins) / self.bins_per_decade)
+        edges[-1] = math.inf
+        return edges
+
+    def percentile(self, q):
+        # Upper edge of the bin holding the q-th percentile, capped at the
+        # largest value seen
+        if self.count == 0:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), q * 0.01 * self.count))
+        return min(float(self.bin_edges()[i]), self.max)
+
+    def summary(self):
+        if self.count == 0:
+            return {"count" : 0}
+        return {
+            "count" : self.count,
+            "mean_s" : self.total_s / self.count,
+            "min_s" : self.min,
+            "p50_s" : self.percentile(50),
+            "p95_s" : self.percentile(95),
+            "p99_s" : self.percentile(99),
+            "max_s" : self.max,
+            "total_s" : self.total_s,
+        }
+
+# Messages from every ErrorReporter are handed to one background thread to
+# print to stderr, so a slow console never holds up the caller and they stay
+# out of anything written to stdout
+_messages = queue.SimpleQueue()
+_print_thread = None
+_print_lock = threading.Lock()
+
+def _print_loop():
+    while True:
+        print(_messages.get(), file=sys.stderr)
+
+def _print_message(message):
+    global _print_thread
+    with _print_lock:
+        if _print_thread is None:
+            _print_thread = threading.Thread(target=_print_loop, name="instrumentation-stderr", daemon=True)
+            _print_thread.start()
+    _messages.put(message)
+
+class ErrorReporter:
+    # Rate limited error messages. Each kind of message is printed at most
+    # once per interval seconds, with a count of how many were held back
+    # since. report() may be called from any thread.
+    def __init__(self, name, interval=1.0):
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_time = {}
+        self.num_suppressed = {}
+
+    def report(self, kind, message):
+        with self.lock:
+            now = time.monotonic()
+            last = self.last_time.get(kind)
+            if last is not None and now - last < self.interval:
+                self.num_suppressed[kind] = self.num_suppressed.get(kind, 0) + 1
+                return
+            self.last_time[kind] = now
+            suppressed = self.num_suppressed.pop(kind, 0)
+        if suppressed > 0:
+            message = "{0} ({1} more since last report)".format(message, suppressed)
+        _print_message("{0}: {1}".format(self.name, message))
+
+class Instrumentation:
+    # Named counters and latency histograms for one device
+    def __init__(self, name, report_interval=1.0):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.reporter = ErrorReporter(name, interval=report_interval)
+        self.start_time = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.start_time = time.time()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def record_time(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self.histograms[name] = histogram
+            histogram.record(seconds)
+
+    def report(self, kind, message):
+        self.reporter.report(kind, message)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "name" : self.name,
+                "time" : time.time(),
+                "elapsed_s" : time.time() - self.start_time,
+                "counters" : dict(self.counters),
+                "latency" : {name : histogram.summary() for (name, histogram) in self.histograms.items()},
+            }
+
+    def write_snapshot(self, file_name):
+        with open(file_name, 'w') as outf:
+            json.dump(self.snapshot(), outf, indent=2)
@@ -0,0 +1,71 @@
+import numpy as np
+
+# MetaShunt V2 shunt ladder. Stage 7 uses R19 alone and each lower stage
+# switches the next resistor (plus the FET on resistance) in parallel with
+# everything before it. Arrays in this module run in ladder order, i.e.
+# index 0 is stage 7 (R19) and index 7 is stage 0 (R1).
+LADDER_KEYS = ["R19", "R17", "R15", "R13", "R11", "R9", "R2", "R1"]
+NUM_STAGES = len(LADDER_KEYS)
+
+def ladder_index(stage):
+    return NUM_STAGES - 1 - stage
+
+def config_to_arrays(config_data):
+    resistors = np.array([config_data[key] for key in LADDER_KEYS], dtype=np.float64)
+    return (resistors, float(config_data["R_FET"]))
+
+def arrays_to_config(resistors, r_fet):
+    config_data = {key : float(value) for (key, value) in zip(LADDER_KEYS, resistors)}
+    config_data["R_FET"] = float(r_fet)
+    return config_data
+
+def effective_resistance(resistors, r_fet):
+    # Forward model. resistors has shape (..., 8) and r_fet broadcasts
+    # against (...), so a batch of candidate resistor sets is evaluated in
+    # one go. Returns the effective shunt resistance at each stage.
+    resistors = np.asarray(resistors, dtype=np.float64)
+    r_fet = np.asarray(r_fet, dtype=np.float64)[..., None]
+    conductance = 1.0 / (resistors + r_fet)
+    conductance[..., 0] = 1.0 / resistors[..., 0]
+    return 1.0 / np.cumsum(conductance, axis=-1)
+
+def solve_resistors(r_eff, r_fet):
+    # Inverse model: the resistor set giving effective resistances r_eff
+    # (shape (..., 8)) at each stage
+    r_eff = np.asarray(r_eff, dtype=np.float64)
+    r_fet = np.asarray(r_fet, dtype=np.float64)[..., None]
+    conductance = 1.0 / r_eff
+    resistors = np.empty_like(r_eff)
+    resistors[..., 0] = r_eff[..., 0]
+    resistors[..., 1:] = 1.0 / np.diff(conductance, axis=-1) - r_fet
+    return resistors
+
+def calibrate(resistors, r_fet, ratios):
+    # Corrected resistors given the measured / true current ratio at each
+    # stage. The MetaShunt reads ratio times the true current when its
+    # assumed effective resistance is off by that same factor.
+    r_eff_actual = effective_resistance(resistors, r_fet) * np.asarray(ratios, dtype=np.float64)
+    return solve_resistors(r_eff_actual, r_fet)
+
+def fit_ratios(stage_index, measured_ma, truth_ma, weights=None, num_stages=NUM_STAGES):
+    # Least squares measured / true ratio for each stage from any number of
+    # measurements. stage_index gives the ladder index of each measurement.
+    # Minimises sum(w * (measured - ratio * truth)^2) per stage.
+    stage_index = np.asarray(stage_index)
+    measured_ma = np.asarray(measured_ma, dtype=np.float64)
+    truth_ma = np.asarray(truth_ma, dtype=np.float64)
+    if weights is None:
+        weights = np.ones_like(measured_ma)
+    num = np.bincount(stage_index, weights=weights * measured_ma * truth_ma, minlength=num_stages)
+    den = np.bincount(stage_index, weights=weights * truth_ma * truth_ma, minlength=num_stages)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return num / den
+
+def monte_carlo(resistors, r_fet, ratios, ratio_std, num_samples, seed=None):
+    # Spread of the calibration result when each stage's ratio is only
+    # known to ratio_std. Returns corrected resistor sets of shape
+    # (num_samples, 8).
+    rng = np.random.default_rng(seed)
+    ratios = np.asarray(ratios, dtype=np.float64)
+    samples = ratios + rng.standard_normal((num_samples, len(ratios))) * np.asarray(ratio_std, dtype=np.float64)
+    return calibrate(resistors, r_fet, samples)
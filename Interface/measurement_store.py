@@ -0,0 +1,97 @@
+import numpy as np
+
+class MeasurementStore:
+    # Samples kept in typed NumPy arrays, one for device time and one for
+    # current. Unbounded by default, growing by doubling. With max_samples
+    # set it keeps only the newest max_samples and drops the oldest.
+    #
+    # Storage is laid out so the samples held are always contiguous, so
+    # get_time() and get_current_ma() return views rather than copies. A
+    # view is only valid until the next append or clear.
+    def __init__(self, max_samples=None, initial_capacity=4096):
+        self.max_samples = max_samples
+        if max_samples is not None:
+            # Twice the cap, so the newest samples only need moving back to
+            # the front once every max_samples appends
+            capacity = 2 * max_samples
+        else:
+            capacity = initial_capacity
+        self.time = np.empty(capacity, dtype=np.uint32)
+        self.current_ma = np.empty(capacity, dtype=np.float32)
+        self.start = 0
+        self.end = 0
+        self.num_discarded = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+        self.num_discarded = 0
+
+    def _make_room(self, n):
+        capacity = len(self.time)
+        if self.end + n <= capacity:
+            return
+
+        count = self.end - self.start
+        if self.max_samples is None:
+            new_capacity = capacity
+            while new_capacity < count + n:
+                new_capacity *= 2
+            time = np.empty(new_capacity, dtype=np.uint32)
+            current_ma = np.empty(new_capacity, dtype=np.float32)
+            time[:count] = self.time[self.start:self.end]
+            current_ma[:count] = self.current_ma[self.start:self.end]
+            self.time = time
+            self.current_ma = current_ma
+        else:
+            # Keep only what will still be wanted after the append
+            keep = min(count, self.max_samples - n)
+            self.time[:keep] = self.time[self.end - keep:self.end]
+            self.current_ma[:keep] = self.current_ma[self.end - keep:self.end]
+            self.num_discarded += count - keep
+            count = keep
+        self.start = 0
+        self.end = count
+
+    def append(self, samples):
+        # samples is a structured array with "time" and "current_ma" fields
+        n = len(samples)
+        if n == 0:
+            return
+        if self.max_samples is not None and n > self.max_samples:
+            self.num_discarded += len(self) + n - self.max_samples
+            samples = samples[n - self.max_samples:]
+            n = self.max_samples
+            self.start = 0
+            self.end = 0
+
+        self._make_room(n)
+        self.time[self.end:self.end + n] = samples["time"]
+        self.current_ma[self.end:self.end + n] = samples["current_ma"]
+        self.end += n
+
+        if self.max_samples is not None and self.end - self.start > self.max_samples:
+            drop = self.end - self.start - self.max_samples
+            self.start += drop
+            self.num_discarded += drop
+
+    def get_time(self):
+        return self.time[self.start:self.end]
+
+    def get_current_ma(self):
+        return self.current_ma[self.start:self.end]
+
+    def position(self):
+        # Number of samples appended since the last clear, counting any that
+        # have been discarded. Use as a mark for get_since().
+        return self.num_discarded + len(self)
+
+    def get_since(self, position):
+        # (time, current_ma) views of the samples appended after position,
+        # or of all samples held if some of those have been discarded
+        first = self.start + max(0, position - self.num_discarded)
+        first = min(first, self.end)
+        return (self.time[first:self.end], self.current_ma[first:self.end])
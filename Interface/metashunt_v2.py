@@ -1,10 +1,17 @@
 import serial
 import time 
 import struct 
-import array
-import serial.tools.list_ports
+import serial_protocol as sp
+import device_discovery as dd
+from measurement_store import MeasurementStore
+from streaming_stats import RunningStats, LogHistogram
+from decimation import DecimationPyramid, VIEW_DTYPE
+from capture import CaptureWriter
+from instrumentation import Instrumentation
+import timing
 import json
 import math
+import threading
 import numpy as np
 
 config_index_dict = {
@@ -18,215 +25,816 @@ config_index_dict = {
     "R1" : 7,
     "R_FET" : 8
 }
+config_key_dict = {index : key for (key, index) in config_index_dict.items()}
 
-class MEASUREMENT:
-    def __init__(self, time, current_ma):
-        self.time = time 
-        self.current_ma = current_ma 
+# Message types understood by the MetaShunt V2. Config responses have no
+# length byte: 0xAA, CONFIG_RESPONSE, uint8 index, float32 value, checksum
+SET_CONFIG = 2
+GET_CONFIG = 3
+CONFIG_RESPONSE = 4
+CONFIG_RESPONSE_LEN = 5
 
-class MetaShuntV2:
+_CONFIG_RESPONSE = struct.Struct("<Bf")
+
+# Streaming sample frame: 0xAA, uint32 device time, float32 current, checksum
+FRAME_SYNC = 0xAA
+FRAME_LEN = 10
+SAMPLE_DTYPE = np.dtype([("time", "<u4"), ("current_ma", "<f4")])
+
+_FRAME_OFFSETS = np.arange(FRAME_LEN)
+
+def decode_frames(buf, rejected=None):
+    # Decode every complete sample frame in buf in bulk.
+    # Returns (samples, consumed, num_bad) where samples is a SAMPLE_DTYPE
+    # array of the frames whose checksum matched, consumed is how many bytes
+    # of buf were used up (anything after it is a partial frame to keep for
+    # the next read) and num_bad is the number of frames dropped for a bad
+    # checksum. Like the byte-wise state machine, a frame is always 10 bytes
+    # from its sync byte, and a corrupt one is skipped whole before hunting
+    # for the next 0xAA. The one exception is a config response followed
+    # by the sync byte of the next sample frame, which passes a sample
+    # frame's checksum one time in 256: a frame that is also a valid
+    # config response and is not followed by another frame is dropped as
+    # bad. If rejected is given (a list), each run of consumed bytes that
+    # are not part of a good frame is appended to it as bytes.
+    data = np.frombuffer(buf, dtype=np.uint8)
+    n = len(data)
+    sync = np.flatnonzero(data == FRAME_SYNC)
+
+    starts = []
+    # Start of the last frame of each run followed by something else
+    run_ends = []
+    pos = 0
+    while True:
+        i = np.searchsorted(sync, pos)
+        if i == len(sync):
+            # Nothing left that could start a frame
+            pos = n
+            break
+        start = sync[i]
+        if start + FRAME_LEN > n:
+            # Partial frame, keep it for the next read
+            pos = start
+            break
+
+        # Take the run of back-to-back frames from here in one go
+        max_frames = (n - start) // FRAME_LEN
+        heads = data[start:start + max_frames * FRAME_LEN:FRAME_LEN]
+        breaks = np.flatnonzero(heads != FRAME_SYNC)
+        run = max_frames if len(breaks) == 0 else breaks[0]
+        starts.append(np.arange(start, start + run * FRAME_LEN, FRAME_LEN))
+        pos = start + run * FRAME_LEN
+        if run < max_frames:
+            run_ends.append(pos - FRAME_LEN)
+
+    if not starts:
+        if rejected is not None and pos > 0:
+            rejected.append(data[:pos].tobytes())
+        return (np.empty(0, dtype=SAMPLE_DTYPE), pos, 0)
+
+    starts = np.concatenate(starts)
+    frames = data[starts[:, None] + _FRAME_OFFSETS]
+    chk = frames[:, 1:9].sum(axis=1, dtype=np.uint32) & 0xFF
+    valid = chk == frames[:, 9]
+    if run_ends:
+        last = np.searchsorted(starts, run_ends)
+        config_chk = frames[last, 1:7].sum(axis=1, dtype=np.uint32) & 0xFF
+        is_config = (frames[last, 1] == CONFIG_RESPONSE) & (config_chk == frames[last, 7]) & (frames[last, 8] == FRAME_SYNC)
+        valid[last[is_config]] = False
+    samples = np.ascontiguousarray(frames[valid, 1:9]).view(SAMPLE_DTYPE).ravel()
+    if rejected is not None and len(samples) * FRAME_LEN < pos:
+        outside = np.ones(pos + 2, dtype=bool)
+        outside[[0, -1]] = False
+        outside[(starts[valid, None] + _FRAME_OFFSETS).ravel() + 1] = False
+        edges = np.flatnonzero(outside[1:] != outside[:-1])
+        for (first, last) in edges.reshape(-1, 2):
+            rejected.append(data[first:last].tobytes())
+    return (samples, pos, len(frames) - np.count_nonzero(valid))
+
+def encode_frames(samples):
+    # The stream of sample frames the device would send for a SAMPLE_DTYPE
+    # array; the inverse of decode_frames()
+    samples = np.ascontiguousarray(samples, dtype=SAMPLE_DTYPE)
+    n = len(samples)
+    frames = np.empty((n, FRAME_LEN), dtype=np.uint8)
+    frames[:, 0] = FRAME_SYNC
+    frames[:, 1:9] = samples.view(np.uint8).reshape(n, 8)
+    frames[:, 9] = frames[:, 1:9].sum(axis=1, dtype=np.uint32) & 0xFF
+    return frames.tobytes()
+
+def encode_config_response(index, value):
+    # The frame the device answers GET_CONFIG with
+    frame = bytearray([FRAME_SYNC, CONFIG_RESPONSE]) + _CONFIG_RESPONSE.pack(index, value)
+    frame.append(sp.checksum(frame[1:]))
+    return bytes(frame)
+
+def decode_received(rx_buffer, config_decoder, accept_config, instrumentation):
+    # Decode every complete frame in rx_buffer (a bytearray of what has been
+    # read so far) and remove it, leaving any partial frame for the next
+    # read. Config replies are looked for only in the runs of bytes that
+    # aren't sample frames, each on its own, as sample data is full of byte
+    # runs that pass for one, and each is passed to
+    # accept_config(index, value), which returns whether it was waited for.
+    # Returns the samples decoded.
+    rejected = []
+    (samples, consumed, num_bad) = decode_frames(rx_buffer, rejected)
+    del rx_buffer[:consumed]
+    for run in rejected:
+        config_decoder.reset()
+        for (msg_type, payload) in config_decoder.feed(run):
+            if accept_config(*_CONFIG_RESPONSE.unpack(payload)):
+                instrumentation.count("config_responses")
+            else:
+                instrumentation.count("unsolicited_config_responses")
+
+    instrumentation.count("frames_decoded", len(samples))
+    # Anything consumed that was not a sample frame, config replies
+    # included
+    instrumentation.count("resync_bytes", consumed - FRAME_LEN * (len(samples) + num_bad))
+    if num_bad > 0:
+        instrumentation.count("checksum_failures", num_bad)
+        instrumentation.report("checksum", "checksum wrong on {0} frames".format(num_bad))
+    return samples
+
+# USB IDs the device enumerates with
+USB_VID = 1155
+USB_PID = 22336
+
+def list_serial_numbers():
+    return dd.default_index.serial_numbers(USB_VID, USB_PID)
+
+class ConfigState:
+    # Config reads in flight and what the device is known to hold, kept
+    # apart from the port so MetaShuntV2 and
+    # async_interface.AsyncMetaShuntV2 share the same rules and differ only
+    # in how they wait. A config response carries nothing that sample data
+    # can't imitate, so one is only taken as the reply to a read request
+    # still outstanding for its index. Any other is counted and dropped,
+    # and since it might also be a real reply arriving late, its key is no
+    # longer taken as known.
     def __init__(self):
+        # key -> value of each write ConfigWrite confirmed, which is what
+        # is put back after a reconnect. Replies never change it, and
+        # reset() leaves it alone.
+        self.written = {}
+        self.reset()
+
+    def reset(self):
+        # Indices with a read request in flight, and replies to them
+        self.outstanding = set()
+        self.readback = {}
+        # key -> value the device answered a read with
+        self.cache = {}
+
+    def request(self, reads):
+        for index in reads:
+            self.outstanding.add(index)
+            self.readback.pop(index, None)
+
+    def accept(self, index, value):
+        # Returns True if this answers an outstanding request
+        if index not in self.outstanding:
+            if index in config_key_dict:
+                self.cache.pop(config_key_dict[index], None)
+            return False
+        self.outstanding.discard(index)
+        self.readback[index] = value
+        return True
+
+    def answered(self, reads):
+        return all(index in self.readback for index in reads)
+
+    def finish(self, reads):
+        # The replies to reads that arrived, by index, added to the cache.
+        # Reads still unanswered are given up on, so a late reply to one
+        # counts as unsolicited.
+        readback = {}
+        for index in reads:
+            self.outstanding.discard(index)
+            if index in self.readback:
+                readback[index] = self.readback.pop(index)
+                if index in config_key_dict:
+                    self.cache[config_key_dict[index]] = readback[index]
+        return readback
+
+    def start_write(self, config_data, rel_tol, max_attempts):
+        return ConfigWrite(self, config_data, rel_tol, max_attempts)
+
+class ConfigWrite:
+    # One upload of config_data (key -> value) confirmed by reading it back:
+    # keys the device is already known to hold are skipped, and only the
+    # ones that fail to read back correctly are retried. The caller does
+    # the I/O:
+    #
+    #   write = state.start_write(config_data, rel_tol, max_attempts)
+    #   while write.next_attempt():
+    #       write.update(exchange(write.pending, list(write.pending)))
+    #   return write.finish()
+    def __init__(self, state, config_data, rel_tol, max_attempts):
+        self.state = state
+        self.rel_tol = rel_tol
+        self.attempts_left = max_attempts
+        # index -> value still to be confirmed
+        self.pending = {}
+        for key in config_data:
+            cached = state.cache.get(key)
+            if cached is not None and math.isclose(cached, config_data[key], rel_tol=rel_tol):
+                state.written[key] = cached
+                continue
+            print("Setting resistor {0} to {1} Ohm".format(key, config_data[key]))
+            self.pending[config_index_dict[key]] = config_data[key]
+
+    def next_attempt(self):
+        if not self.pending or self.attempts_left <= 0:
+            return False
+        self.attempts_left -= 1
+        return True
+
+    def update(self, readback):
+        for (index, value) in readback.items():
+            if index in self.pending and math.isclose(value, self.pending[index], rel_tol=self.rel_tol):
+                self.state.written[config_key_dict[index]] = value
+                del self.pending[index]
+
+    def finish(self):
+        # Reports the outcome; True if every key was confirmed
+        for index in self.pending:
+            key = config_key_dict[index]
+            if key in self.state.cache:
+                print("Received back {} Ohm for {}, should be {} Ohm".format(self.state.cache[key], key, self.pending[index]))
+            print("ERROR Configuration of {} Failed".format(key))
+        if not self.pending:
+            print("Configuration Set Correctly")
+        return not self.pending
+
+class MetaShuntV2:
+    # max_samples caps how many measurements are held, dropping the oldest
+    # once reached. None keeps everything.
+    def __init__(self, max_samples=None):
         self.ser = None
-        self.measurements = []
+        self.measurements = MeasurementStore(max_samples=max_samples)
+        # Running statistics over everything since clear_measurements(), and
+        # over everything since the last mark()
+        self.stats = RunningStats()
+        self.mark_stats = RunningStats()
+        # Median, MAD and percentiles over the same two spans
+        self.quantiles = LogHistogram()
+        self.mark_quantiles = LogHistogram()
+        # Min / max / mean / count at several resolutions over everything
+        # since clear_measurements(), by unwrapped device tick, for views of
+        # long runs that don't touch every sample; see get_decimated()
+        self.pyramid = DecimationPyramid()
+        # Background acquisition. lock guards the store and stats while the
+        # reader thread is running, and data_ready is notified on new samples.
+        self.lock = threading.Lock()
+        self.data_ready = threading.Condition(self.lock)
+        self.stream_thread = None
+        self.stream_stop = threading.Event()
+        self.rx_buffer = bytearray()
+        self.config_decoder = sp.FrameDecoder(payload_lengths={CONFIG_RESPONSE : CONFIG_RESPONSE_LEN})
+        self.encoder = sp.FrameEncoder()
+        # Config reads in flight and values read back from the device
+        self.config = ConfigState()
+        # Capture file being written, of raw port bytes if capture_raw is
+        # set and of decoded samples otherwise
+        self.capture = None
+        self.capture_raw = False
+        # Protocol counters and latencies; see instrumentation.snapshot()
+        self.instrumentation = Instrumentation("MetaShunt V2")
+        # Device time: sample ticks unwrapped past 32 bits and fitted to
+        # host time.time() as they arrive
+        self.ticks = timing.TickUnwrapper()
+        self.clock = timing.ClockSync()
+        # USB serial number of the connected device. If it drops off the bus
+        # it is reopened, for up to reconnect_timeout seconds, with its
+        # config put back and any stream carried on.
+        self.serial_number = None
+        self.auto_reconnect = True
+        self.reconnect_timeout = 5.0
 
-    def get_packet(self, timeout):
-        step = 0
-        count = 0
-        chk = 0
-        payload = []
-        start_time = time.time()
+    def read_samples(self):
+        # Read whatever the port has buffered (blocking up to the port timeout
+        # for at least one byte) and decode every complete frame in it
+        read_start = time.perf_counter()
+        try:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+        except TypeError:
+            return np.empty(0, dtype=SAMPLE_DTYPE)
+        except OSError:
+            # Unplugged or re-enumerated (SerialException is an OSError too)
+            if not self.auto_reconnect or not self.reconnect():
+                raise
+            return np.empty(0, dtype=SAMPLE_DTYPE)
+        decode_start = time.perf_counter()
+        read_time = time.time()
+        if data:
+            self.rx_buffer += data
+            if self.capture_raw:
+                with self.lock:
+                    if self.capture is not None:
+                        self.capture.append(data)
 
-        while time.time() < start_time + timeout:
-            try:
-                data = self.ser.read(1)
-            except TypeError:
-                return None
-            if data:
-                data = ord(data)
-
-            if(step == 0 and data == 0xAA):
-                step += 1
-            elif(step == 1):
-                if(count < 8):
-                    payload.append(data)
-                    count += 1
-                    chk += data
-                    chk &= 0xFF
-                    if count == 8:
-                        step += 1
-            elif(step == 2):
-                if(data == chk):
-                    return payload
-                else:
-                    print("MetaShunt V2 checksum wrong. Should be {0}, was {1}".format(chk, data))
-                    print("Payload: ")
-                    print(payload)
-                    step = 0
-                    count = 0
-                    payload = []
-
-    def get_config_request_response(self, timeout):
-        step = 0
-        count = 0
-        chk = 0
-        payload = []
-        start_time = time.time()
+        samples = decode_received(self.rx_buffer, self.config_decoder, self._accept_config, self.instrumentation)
+        if len(samples) > 0:
+            with self.lock:
+                ticks = self.ticks.unwrap(samples["time"])
+                self.clock.add(ticks[-1], read_time)
+
+        self.instrumentation.record_time("read_s", decode_start - read_start)
+        self.instrumentation.record_time("decode_s", time.perf_counter() - decode_start)
+        self.instrumentation.count("bytes_read", len(data))
+        return samples
+
+    def _accept_config(self, index, value):
+        with self.data_ready:
+            if not self.config.accept(index, value):
+                return False
+            self.data_ready.notify_all()
+        return True
 
-        while time.time() < start_time + timeout:
-            try:
-                data = self.ser.read(1)
-            except TypeError:
-                return None
-            if data:
-                data = ord(data)
-
-            if(step == 0 and data == 0xAA):
-                step += 1
-                chk = 0
-            elif(step == 1 and data == 0x04):
-                step += 1
-                chk += data
-                chk &= 0xFF
-                payload = []
-                count = 0
-            elif(step == 1 and data != 0x04):
-                # Not a correct message, so reset
-                step = 0
-            elif(step == 2):
-                if(count < 5):
-                    payload.append(data)
-                    count += 1
-                    chk += data
-                    chk &= 0xFF
-                    if count == 5:
-                        step += 1
-            elif(step == 3):
-                if(data == chk):
-                    return payload
-                else:
-                    step = 0
-                    count = 0
-    
     def send_config(self, index, data):
-        payload = bytearray(struct.pack("<BBBBf",0xAA,2,5,index,data))
-        chk = 0
-        for i in range(1,len(payload)):
-            chk += payload[i]
-            chk &= 0xFF
-        payload.append(chk)
-        self.ser.write(bytearray(payload))
+        self.ser.write(self.encoder.pack(SET_CONFIG, "<Bf", index, data))
 
     def request_config(self, index):
-        payload = bytearray(struct.pack("<BBBB",0xAA,3,1,index))
-        chk = 0
-        for i in range(1,len(payload)):
-            chk += payload[i]
-            chk &= 0xFF
-        payload.append(chk)
-        self.ser.reset_input_buffer()
-        self.ser.write(bytearray(payload))
-        self.ser.reset_input_buffer()
+        self.ser.write(self.encoder.pack(GET_CONFIG, "<B", index))
+
+    def _wait_config_readback(self, indices, timeout):
+        # Wait until every index has been read back or timeout seconds pass.
+        # Returns the values that did arrive, by index, and stops waiting
+        # for the rest.
+        end_time = time.time() + timeout
+        while True:
+            with self.data_ready:
+                if self.config.answered(indices):
+                    break
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                if self.is_streaming() and threading.current_thread() is not self.stream_thread:
+                    self.data_ready.wait(remaining)
+                    continue
+            # Nobody else is reading the port (or this is the reader thread,
+            # restoring the config after a reconnect), so drive it from here
+            self.read_samples()
+        with self.lock:
+            return self.config.finish(indices)
+
+    def _exchange_config(self, writes, reads, timeout, frame_gap):
+        # The firmware holds only its latest command until the main loop
+        # picks it up, and persists a config write before it looks at the
+        # next, so a frame sent before the last one is dealt with can
+        # overwrite it. Each read request goes out once the reply to the one
+        # before has arrived or timeout seconds have passed. A write (every
+        # index in writes must also be in reads) goes frame_gap seconds ahead
+        # of the read of its index, and that reply confirms it. Returns the
+        # readbacks by index.
+        readback = {}
+        send_time = time.perf_counter()
+        for index in reads:
+            with self.lock:
+                self.config.request([index])
+            if index in writes:
+                self.send_config(index, writes[index])
+                time.sleep(frame_gap)
+            self.request_config(index)
+            readback.update(self._wait_config_readback([index], timeout))
+        self.instrumentation.record_time("config_round_trip_s", time.perf_counter() - send_time)
+        self.instrumentation.count("config_writes", len(writes))
+        self.instrumentation.count("config_reads", len(reads))
+        self.instrumentation.count("config_timeouts", len(reads) - len(readback))
+        return readback
     
-    def connect(self):
-        # Figure out the correct port
-        port = ""
-        connected = [comport for comport in serial.tools.list_ports.comports()]
-
-        for comport in connected:
-            if comport.vid == 1155 and comport.pid == 22336:
-                port = comport[0]
-                break
+    def connect(self, ser=None, serial_number=None):
+        # ser is an already open serial-like port to use instead of
+        # searching (e.g. a device_simulator port). With several devices
+        # attached, serial_number picks one by its USB serial number;
+        # otherwise the first found is used.
+        self.serial_number = None
+        if ser is None:
+            opened = dd.default_index.open(USB_VID, USB_PID, serial_number)
+            if opened is not None:
+                (ser, self.serial_number) = opened
 
-        if port != "":
-            self.ser = serial.Serial(port, timeout=0.1)  # open serial port
-            self.ser.reset_input_buffer()
+        if ser is not None:
+            self._attach(ser)
+            # The device may have been reconfigured or swapped since
+            with self.lock:
+                self.config = ConfigState()
             print("Connected to MetaShunt V2")
             return True
         else:
             print("Could not connect to MetaShunt V2")
             return False
-        
+
+    def _attach(self, ser):
+        self.ser = ser
+        self.ser.reset_input_buffer()
+        self.rx_buffer = bytearray()
+        self.config_decoder.reset()
+        # The new port's ticks start from anywhere, so carry the unwrapped
+        # count on from where the old clock fit puts now. Times already in
+        # the pyramid stay behind the new ones.
+        with self.lock:
+            if self.ticks.last is not None:
+                resume_at = self.ticks.last + 1
+                if self.clock.is_synced():
+                    resume_at = max(resume_at, int(self.clock.to_ticks(time.time())))
+                self.ticks.restart(resume_at)
+            self.clock.reset()
+
+    def reconnect(self, timeout=None):
+        # Reopen the same device after it has dropped off the bus or been
+        # re-enumerated, and write back whatever write_config() had
+        # confirmed that the device no longer holds. Called from
+        # read_samples(), so a running stream carries on by itself. Returns
+        # True once it is back.
+        if self.serial_number is None:
+            return False
+        if timeout is None:
+            timeout = self.reconnect_timeout
+        start_time = time.perf_counter()
+        try:
+            self.ser.close()
+        except OSError:
+            pass
+        opened = dd.default_index.wait_for_device(USB_VID, USB_PID, self.serial_number, timeout)
+        if opened is None:
+            self.instrumentation.report("reconnect", "{0} did not come back".format(self.serial_number))
+            return False
+        self._attach(opened[0])
+        with self.lock:
+            config_data = dict(self.config.written)
+            self.config.reset()
+        if config_data:
+            self.read_all_config()
+            self.write_config(config_data)
+        self.instrumentation.count("reconnects")
+        self.instrumentation.record_time("reconnect_s", time.perf_counter() - start_time)
+        self.instrumentation.report("reconnect", "reconnected to {0}".format(self.serial_number))
+        return True
+    
     def measure(self, run_time):
+        if self.is_streaming():
+            # The reader thread is already recording
+            time.sleep(run_time)
+            return
+
         start_time = time.time()
         self.ser.reset_input_buffer()
         while self.ser.in_waiting > 0:
             self.ser.read(self.ser.in_waiting)
+        self.rx_buffer = bytearray()
 
         # Record data
         while(time.time() < start_time + run_time):
-            # get payload
-            payload = self.get_packet(timeout=0.1)
-            if payload:
-                # unpack it
-                line_spec = "<If"
-                info = struct.unpack(line_spec, array.array('B',payload).tobytes())
-                self.measurements.append(MEASUREMENT(time=info[0],current_ma=info[1]))
+            self.record(self.read_samples())
+
+    def measure_until(self, rel_precision, max_time, window_samples=100, drift_sigma=3.0, min_samples=None, position=None, quantiles=None, min_settle_time=0.0):
+        # Measure until the current has settled and the standard error of
+        # the mean is within rel_precision of the mean, or max_time passes.
+        # Samples that arrive in the first min_settle_time seconds are not
+        # used. Settling is first judged on consecutive windows of
+        # window_samples: once two in a row have means within drift_sigma
+        # standard errors of each other, everything from the second of them
+        # on is averaged. Two short windows can't see a slow tail, so the
+        # average then runs for at least as many samples as it took to get
+        # there, and before stopping the first and second halves of it are
+        # compared the same way. While they differ the first half is
+        # dropped, so the span doubles again before the next look.
+        # While streaming, samples from position (default: now) on are used.
+        # Returns (num_measurements, mean_ma, std_dev_ma, settled) over the
+        # averaged samples. settled is True only if the halves agreed; if
+        # the windows never did, the stats cover only the most recent ones.
+        # quantiles, if given, is a streaming_stats.LogHistogram to fill
+        # with those same samples.
+        if min_samples is None:
+            min_samples = 2 * window_samples
+        start_time = time.time()
+        end_time = start_time + max_time
+        settle_end_time = start_time + min_settle_time
+
+        streaming = self.is_streaming()
+        if streaming:
+            if position is None:
+                position = self.stream_position()
+        else:
+            self.ser.reset_input_buffer()
+            self.rx_buffer = bytearray()
+
+        stats = RunningStats()
+        window = RunningStats()
+        prev_window = None
+        # Samples of the settling windows, and of the average once it has
+        # started, for the halves check and quantiles
+        window_values = []
+        prev_window_values = []
+        averaged_values = []
+        averaging = False
+        settled = False
+        num_settling = 0
+        while True:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            if streaming:
+                (t, current_ma) = self.wait_for_samples(1, remaining, position)
+                position += len(t)
+            else:
+                samples = self.read_samples()
+                self.record(samples)
+                current_ma = samples["current_ma"]
+            if time.time() < settle_end_time:
+                continue
+
+            if averaging:
+                stats.update(current_ma)
+                averaged_values.append(current_ma)
+            else:
+                # Walk the new samples through the settling windows
+                i = 0
+                while i < len(current_ma):
+                    take = min(window_samples - window.count, len(current_ma) - i)
+                    window.update(current_ma[i:i + take])
+                    window_values.append(current_ma[i:i + take])
+                    i += take
+                    if window.count < window_samples:
+                        break
+                    if prev_window is not None:
+                        drift = abs(window.mean - prev_window.mean)
+                        noise = math.hypot(window.std_error(), prev_window.std_error())
+                        if drift <= drift_sigma * noise:
+                            averaging = True
+                            stats.merge(window)
+                            stats.update(current_ma[i:])
+                            averaged_values = window_values + [current_ma[i:]]
+                            break
+                    prev_window = window
+                    window = RunningStats()
+                    prev_window_values = window_values
+                    window_values = []
+                    num_settling += window_samples
+
+            if averaging and stats.count >= max(min_samples, num_settling):
+                std_error = stats.std_error()
+                if std_error is not None and std_error <= rel_precision * abs(stats.mean):
+                    values = np.concatenate(averaged_values)
+                    half = len(values) // 2
+                    (first, second) = (RunningStats(), RunningStats())
+                    first.update(values[:half])
+                    second.update(values[half:])
+                    if abs(second.mean - first.mean) <= drift_sigma * math.hypot(first.std_error(), second.std_error()):
+                        settled = True
+                        break
+                    stats = second
+                    averaged_values = [values[half:]]
+                    num_settling = len(values)
+
+        if not averaging:
+            if prev_window is not None:
+                stats.merge(prev_window)
+            stats.merge(window)
+            averaged_values = prev_window_values + window_values
+        if quantiles is not None and averaged_values:
+            quantiles.update(np.concatenate(averaged_values))
+        return stats.summary() + (settled,)
+
+    def record(self, samples):
+        self.measurements.append(samples)
+        if self.capture is not None and not self.capture_raw:
+            self.capture.append(samples)
+        current_ma = samples["current_ma"]
+        self.stats.update(current_ma)
+        self.mark_stats.update(current_ma)
+        self.quantiles.update(current_ma)
+        self.mark_quantiles.update(current_ma)
+        self.pyramid.append(self.ticks.unwrap_recent(samples["time"]), current_ma)
     
+    def start_capture(self, file_name, raw=False):
+        # Append everything from now on to a capture file, as it is decoded
+        # or, with raw, as the bytes come off the port. Read it back with
+        # capture.open_capture() or replay it with capture.CaptureReplay.
+        self.stop_capture()
+        if raw:
+            writer = CaptureWriter(file_name)
+        else:
+            writer = CaptureWriter(file_name, dtype=SAMPLE_DTYPE)
+        with self.lock:
+            self.capture = writer
+            self.capture_raw = raw
+        print("Capturing MetaShunt V2 {0} to {1}".format("bytes" if raw else "samples", file_name))
+
+    def stop_capture(self):
+        with self.lock:
+            writer = self.capture
+            self.capture = None
+            self.capture_raw = False
+        if writer is not None:
+            writer.close()
+            print("Captured {0} records to {1}".format(writer.num_records, writer.file_name))
+
     def clear_measurements(self):
-        self.ser.reset_input_buffer()
-        self.measurements = []
+        with self.lock:
+            if not self.is_streaming():
+                self.ser.reset_input_buffer()
+                self.rx_buffer = bytearray()
+            self.measurements.clear()
+            self.stats.reset()
+            self.mark_stats.reset()
+            self.quantiles.reset()
+            self.mark_quantiles.reset()
+            self.pyramid.reset()
+
+    def mark(self):
+        # Start a new window for stats_since_mark(). Returns the stream
+        # position of the mark, for get_samples_since().
+        with self.lock:
+            self.mark_stats.reset()
+            self.mark_quantiles.reset()
+            return self.measurements.position()
+
+    def stats_since_mark(self):
+        with self.lock:
+            return self.mark_stats.summary()
+
+    def quantiles_since_mark(self):
+        # LogHistogram.summary(): (count, median_ma, mad_ma, p2.5_ma, p97.5_ma)
+        with self.lock:
+            return self.mark_quantiles.summary()
+
+    def start_stream(self, max_samples=None):
+        # Drain the port continuously on a background thread. With
+        # max_samples the store becomes a ring buffer of that many samples.
+        if self.is_streaming():
+            return
+        with self.lock:
+            if max_samples is not None:
+                self.measurements = MeasurementStore(max_samples=max_samples)
+            self.rx_buffer = bytearray()
+        self.stream_stop.clear()
+        self.stream_thread = threading.Thread(target=self._stream_loop, daemon=True)
+        self.stream_thread.start()
+
+    def stop_stream(self):
+        if self.stream_thread is None:
+            return
+        self.stream_stop.set()
+        self.stream_thread.join()
+        self.stream_thread = None
+
+    def is_streaming(self):
+        return self.stream_thread is not None
+
+    def _stream_loop(self):
+        while not self.stream_stop.is_set():
+            try:
+                samples = self.read_samples()
+            except serial.SerialException as e:
+                print("MetaShunt V2 stream stopped: {0}".format(e))
+                break
+            if len(samples) > 0:
+                with self.data_ready:
+                    self.record(samples)
+                    self.data_ready.notify_all()
+
+    def stream_position(self):
+        with self.lock:
+            return self.measurements.position()
+
+    def get_samples_since(self, position):
+        # Copies of (time, current_ma) for samples recorded after position
+        with self.lock:
+            (t, current_ma) = self.measurements.get_since(position)
+            return (t.copy(), current_ma.copy())
+
+    def get_samples_host(self, position):
+        # Like get_samples_since(), with each sample's device time given as
+        # host time.time() through the clock fit
+        with self.lock:
+            (t, current_ma) = self.measurements.get_since(position)
+            if not self.clock.is_synced():
+                return (np.empty(0), current_ma[:0].copy())
+            return (self.clock.to_host(self.ticks.unwrap_recent(t)), current_ma.copy())
+
+    def latest_host_time(self):
+        # Host time of the newest sample received, or -inf before any
+        with self.lock:
+            if not self.clock.is_synced():
+                return -math.inf
+            return float(self.clock.to_host(self.ticks.last))
+
+    def get_window(self, t0, t1):
+        # Copies of (time, current_ma) for samples with unwrapped device
+        # ticks in [t0, t1], as in get_decimated(), the times unwrapped too.
+        # The stored ticks wrap every 2**32, so they are unwrapped in order
+        # and lined up on the newest.
+        with self.lock:
+            raw = self.measurements.get_time()
+            t = timing.TickUnwrapper().unwrap(raw)
+            if len(t) > 0:
+                t += self.ticks.unwrap_recent(raw[-1:])[0] - t[-1]
+            in_window = (t >= t0) & (t <= t1)
+            return (t[in_window], self.measurements.get_current_ma()[in_window].copy())
+
+    def get_decimated(self, t0=None, t1=None, max_points=2000):
+        # decimation.VIEW_DTYPE buckets covering unwrapped device ticks
+        # [t0, t1] (default: everything) at the finest resolution that fits
+        # in max_points, whatever the length of the run
+        with self.lock:
+            return self.pyramid.view(t0, t1, max_points)
+
+    def get_decimated_host(self, t0=None, t1=None, max_points=2000):
+        # As get_decimated() for host time.time() t0 and t1. Returns
+        # (host_time, buckets), host_time being each bucket's midpoint.
+        with self.lock:
+            if not self.clock.is_synced():
+                return (np.empty(0), np.empty(0, dtype=VIEW_DTYPE))
+            (tick0, tick1) = (None if t is None else int(self.clock.to_ticks(t)) for t in (t0, t1))
+            buckets = self.pyramid.view(tick0, tick1, max_points)
+            return (self.clock.to_host((buckets["t_first"] + buckets["t_last"]) * 0.5), buckets)
+
+    def summarize(self, t0=None, t1=None, max_points=2000):
+        # (count, mean_ma, min_ma, max_ma) over device ticks [t0, t1], to the
+        # resolution of get_decimated()
+        with self.lock:
+            return self.pyramid.summarize(t0, t1, max_points)
+
+    def wait_samples(self, run_time, position=None):
+        # Samples recorded from position (default: now) until run_time
+        # seconds from now, without stopping or flushing the stream
+        if position is None:
+            position = self.stream_position()
+        time.sleep(run_time)
+        return self.get_samples_since(position)
+
+    def wait_for_samples(self, num_samples, timeout, position=None):
+        # Block until num_samples have been recorded after position or
+        # timeout seconds pass, then return what there is
+        end_time = time.time() + timeout
+        with self.data_ready:
+            if position is None:
+                position = self.measurements.position()
+            while self.measurements.position() - position < num_samples:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                self.data_ready.wait(remaining)
+            (t, current_ma) = self.measurements.get_since(position)
+            return (t.copy(), current_ma.copy())
 
     def get_measurements(self):
-        current_ma = np.array([ms.current_ma for ms in self.measurements])
-        return current_ma
+        # View into the store, valid until more samples are recorded
+        return self.measurements.get_current_ma()
+
+    def get_measurement_times(self):
+        return self.measurements.get_time()
     
     def measurement_stats(self):
-        num_measurements = len(self.measurements)
-        measurement_mean_ma = None
-        measurement_std_dev_ma = None
-        if num_measurements > 0:
-            current_ma = self.get_measurements()
-            measurement_mean_ma = np.mean(current_ma)
-            measurement_std_dev_ma = np.std(current_ma)
-        return (num_measurements, measurement_mean_ma, measurement_std_dev_ma)
+        # Counts every sample since clear_measurements(), including any the
+        # store has dropped to stay under max_samples
+        return self.stats.summary()
+
+    def measurement_quantiles(self):
+        # As measurement_stats(), as LogHistogram.summary()
+        with self.lock:
+            return self.quantiles.summary()
     
     def disconnect(self):
+        self.stop_stream()
+        self.stop_capture()
         self.ser.close()
 
-    def configure(self, config_file_name):
+    def configure(self, config_file_name, rel_tol=1e-5, max_attempts=3, timeout=0.25, frame_gap=0.002):
         f = open(config_file_name)
 
         config_data = json.load(f)
 
-        status = True
+        return self.write_config(config_data, rel_tol=rel_tol, max_attempts=max_attempts, timeout=timeout, frame_gap=frame_gap)
 
-        for key in config_data:
-            time.sleep(0.1)
-            # Send data
-            print("Setting resistor {0} to {1} Ohm".format(key, config_data[key]))
-            self.send_config(config_index_dict[key], config_data[key])
-            time.sleep(0.1)
-            self.request_config(config_index_dict[key])
-            payload = self.get_config_request_response(timeout=0.15)
-            if payload:
-                # unpack it
-                line_spec = "<Bf"
-                info = struct.unpack(line_spec, array.array('B',payload).tobytes())
-                index = info[0]
-                value = info[1]
-
-                if index == config_index_dict[key] and math.isclose(value, config_data[key], rel_tol=1e-5):
-                    print("Configuration Set Correctly")
-                else:
-                    status = False
-                    print("Received back {} index and {} Ohm".format(index, value))
-                    print("Should be {} index and {} Ohm".format(config_index_dict[key], config_data[key]))
-                    print("ERROR Configuration Failed")
-            else:
-                status = False
-                print("ERROR ************** Nothing heard back ************** ERROR")
-        return status
-
-    def get_config_param(self, key):
-        time.sleep(0.1)
-        self.request_config(config_index_dict[key])
-        payload = self.get_config_request_response(timeout=0.15)
-        value = None
-        if payload:
-            # unpack it
-            line_spec = "<Bf"
-            info = struct.unpack(line_spec, array.array('B',payload).tobytes())
-            index = info[0]
-            value = info[1]
-        return value
+    def write_config(self, config_data, rel_tol=1e-5, max_attempts=3, timeout=0.25, frame_gap=0.002):
+        # Upload config_data (key -> value) and confirm it by reading it
+        # back; see ConfigWrite
+        with self.lock:
+            write = self.config.start_write(config_data, rel_tol, max_attempts)
+        while write.next_attempt():
+            readback = self._exchange_config(write.pending, list(write.pending), timeout, frame_gap)
+            with self.lock:
+                write.update(readback)
+        return write.finish()
+
+    def read_all_config(self, timeout=0.15, frame_gap=0.002):
+        # Request every parameter, each as soon as the last has answered.
+        # Returns key -> value for those that answered, and refreshes the
+        # cache with them.
+        readback = self._exchange_config({}, list(config_key_dict), timeout, frame_gap)
+        return {config_key_dict[index] : value for (index, value) in readback.items()}
+
+    def get_config_param(self, key, fresh=False, timeout=0.15):
+        # Served from values read back from the device unless fresh is set
+        # or the value is unknown
+        with self.lock:
+            if not fresh and key in self.config.cache:
+                return self.config.cache[key]
+        index = config_index_dict[key]
+        readback = self._exchange_config({}, [index], timeout, 0.0)
+        return readback.get(index)
 
@@ -0,0 +1,138 @@
+import metashunt_v2 as ms2
+import HDRPrecisionCurrentSupply as pcs
+import calibration_controller as cc
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import traceback
+
+# Calibrates every supply/MetaShunt pair on the host at once. Each rig runs
+# calibration_controller.calibrate() on its own thread with its own device
+# objects and files; the threads spend nearly all their time blocked in
+# serial reads and waits, which release the GIL, so rigs run side by side
+# rather than taking turns and the whole run takes about as long as one.
+#
+# Rigs are paired by USB serial number from rig_map_filename:
+#   {"rig name" : {"supply" : "<serial>", "metashunt" : "<serial>"}, ...}
+# With no map and exactly one of each device attached, they are paired.
+
+rig_map_filename = "rigs.json"
+report_filename = "multi_rig_report.json"
+
+def pair_rigs(rig_map=None):
+    # [(name, supply_serial, metashunt_serial), ...] for the rigs in rig_map
+    # whose devices are both attached, or for the single attached pair with
+    # no map. Returns None if the devices can't be paired.
+    supplies = pcs.list_serial_numbers()
+    metashunts = ms2.list_serial_numbers()
+    if rig_map is None:
+        if len(supplies) == 1 and len(metashunts) == 1:
+            return [("rig", supplies[0], metashunts[0])]
+        print("Found supplies {0} and MetaShunts {1}; list which go together in {2}".format(supplies, metashunts, rig_map_filename))
+        return None
+
+    rigs = []
+    for (name, serials) in rig_map.items():
+        missing = [device for (device, attached) in (("supply", supplies), ("metashunt", metashunts)) if serials[device] not in attached]
+        if missing:
+            print("Skipping rig {0}: {1} not attached".format(name, " and ".join(missing)))
+            continue
+        rigs.append((name, serials["supply"], serials["metashunt"]))
+    return rigs
+
+def connect_rig(supply_serial, metashunt_serial):
+    # (supply, metashunt) connected to the given devices, or None
+    this_pcs = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.FIXED_REFERENCE)
+    if not this_pcs.connect(serial_number=supply_serial):
+        return None
+    this_ms2 = ms2.MetaShuntV2()
+    if not this_ms2.connect(serial_number=metashunt_serial):
+        this_pcs.disconnect()
+        return None
+    return (this_pcs, this_ms2)
+
+def run_rig(name, supply_serial, metashunt_serial, connect=connect_rig, check=True):
+    # Calibrate one rig, then (if check) measure every stage again with the
+    # new config. Returns the rig's entry for the report; failures are
+    # recorded in it rather than raised, so one rig can't stop the others.
+    def log(message):
+        # One write per line, so lines from different rigs don't interleave
+        print("[{0}] {1}\n".format(name, message), end="")
+
+    result = {"supply" : supply_serial, "metashunt" : metashunt_serial, "status" : "failed"}
+    start_time = time.time()
+    devices = connect(supply_serial, metashunt_serial)
+    if devices is None:
+        result["error"] = "could not connect"
+        result["elapsed_s"] = time.time() - start_time
+        return result
+    (this_pcs, this_ms2) = devices
+    try:
+        result.update(cc.calibrate(this_pcs, this_ms2, pre_cal_filename="pre_cal_cfg_{0}.json".format(name),
+                                   post_cal_filename="post_cal_cfg_{0}.json".format(name), log=log))
+        if not result["configured"]:
+            result["error"] = "calibration not applied"
+        elif check:
+            (truth_ma, avg_ma, errors, settled) = cc.measure_stages(this_pcs, this_ms2, label="After calibration", log=log)
+            result["post_cal_errors"] = errors
+            if None in errors:
+                result["error"] = "check incomplete"
+            elif False in settled:
+                result["error"] = "check did not settle"
+            else:
+                result["status"] = "ok"
+        else:
+            result["status"] = "ok"
+    except Exception as e:
+        log("Failed: {0!r}".format(e))
+        result["error"] = repr(e)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        this_ms2.disconnect()
+        this_pcs.disconnect()
+        result["elapsed_s"] = time.time() - start_time
+    return result
+
+def run_rigs(rigs, connect=connect_rig, check=True):
+    # Run every rig on its own thread. Returns the report: rig name -> the
+    # run_rig() result, plus the total run time.
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(rigs))) as executor:
+        futures = {name : executor.submit(run_rig, name, supply_serial, metashunt_serial, connect, check)
+                   for (name, supply_serial, metashunt_serial) in rigs}
+        results = {name : future.result() for (name, future) in futures.items()}
+    return {"elapsed_s" : time.time() - start_time, "rigs" : results}
+
+def print_report(report):
+    print("{0:<16}{1:<8}{2:>12}{3:>16}{4:>16}".format("Rig", "Status", "Time (s)", "Max err before", "Max err after"))
+    for (name, result) in report["rigs"].items():
+        columns = []
+        for key in ("pre_cal_errors", "post_cal_errors"):
+            errors = [abs(error) for error in result.get(key, []) if error is not None]
+            columns.append("{0:.4f}%".format(100.0 * max(errors)) if errors else "-")
+        print("{0:<16}{1:<8}{2:>12.1f}{3:>16}{4:>16}".format(name, result["status"], result["elapsed_s"], *columns))
+        if "error" in result:
+            print("    {0}".format(result["error"]))
+    num_ok = sum(result["status"] == "ok" for result in report["rigs"].values())
+    print("{0} of {1} rigs calibrated in {2:.1f} s".format(num_ok, len(report["rigs"]), report["elapsed_s"]))
+
+if __name__ == "__main__":
+
+    rig_map = None
+    if os.path.exists(rig_map_filename):
+        with open(rig_map_filename) as f:
+            rig_map = json.load(f)
+
+    rigs = pair_rigs(rig_map)
+    if not rigs:
+        print("No rigs to calibrate")
+        sys.exit()
+
+    print("Calibrating {0}".format(", ".join(name for (name, supply_serial, metashunt_serial) in rigs)))
+    report = run_rigs(rigs)
+    print_report(report)
+
+    with open(report_filename, 'w') as outf:
+        json.dump(report, outf, indent=2)
@@ -0,0 +1,160 @@
+import collections
+import struct
+import time
+
+# Framing shared by the HDR supply and MetaShunt V2:
+# 0xAA, type, length, payload[length], checksum
+# where the checksum is the low byte of the sum of everything after the sync
+FRAME_SYNC = 0xAA
+MAX_PAYLOAD_LEN = 255
+
+# Message types handled by the HDR supply firmware (usb_interface.h)
+SET_CURRENT = 0
+SET_CONFIG = 1
+GET_CONFIG = 2
+CONFIG_RESPONSE = 3
+SET_SCALE = 4
+CURRENT_SET = 5
+
+_HEADER = struct.Struct("<BBB")
+
+def checksum(data):
+    return sum(data) & 0xFF
+
+class FrameDecoder:
+    # Incremental decoder. Feed it chunks of bytes as they arrive and it
+    # returns the (msg_type, payload) frames completed so far, keeping any
+    # partial frame in its buffer for the next call.
+    #
+    # Some replies carry no length byte on the wire (e.g. the MetaShunt's
+    # config response). For those pass payload_lengths, a dict of
+    # msg_type -> payload length; frames of any other type are then
+    # treated as noise and the decoder resyncs on the next 0xAA.
+    def __init__(self, payload_lengths=None):
+        self.payload_lengths = payload_lengths
+        # With a single known type, hunt for sync and type together so a
+        # stream full of other traffic is skipped without a Python loop
+        if payload_lengths is not None and len(payload_lengths) == 1:
+            self.sync = bytes([FRAME_SYNC, next(iter(payload_lengths))])
+        else:
+            self.sync = bytes([FRAME_SYNC])
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        # Totals since creation: good frames, frames dropped on a bad
+        # checksum, and bytes skipped while hunting for a sync
+        self.num_frames = 0
+        self.num_bad_checksum = 0
+        self.num_skipped = 0
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.pending.clear()
+
+    def feed(self, data):
+        if data:
+            self.buffer += data
+
+        buf = self.buffer
+        frames = []
+        pos = 0
+        frame_bytes = 0
+        while True:
+            start = buf.find(self.sync, pos)
+            if start < 0:
+                # Keep a trailing partial sync pattern for the next chunk
+                pos = max(pos, len(buf) - len(self.sync) + 1)
+                break
+            if start + 2 > len(buf):
+                pos = start
+                break
+
+            msg_type = buf[start + 1]
+            if self.payload_lengths is None:
+                if start + 3 > len(buf):
+                    pos = start
+                    break
+                length = buf[start + 2]
+                payload_start = start + 3
+            elif msg_type in self.payload_lengths:
+                length = self.payload_lengths[msg_type]
+                payload_start = start + 2
+            else:
+                # Not a message we know, so look for the next sync
+                pos = start + 2
+                continue
+
+            end = payload_start + length
+            if end >= len(buf):
+                pos = start
+                break
+
+            pos = end + 1
+            frame_bytes += pos - start
+            with memoryview(buf) as view:
+                if checksum(view[start + 1:end]) == buf[end]:
+                    frames.append((msg_type, bytes(view[payload_start:end])))
+                else:
+                    self.num_bad_checksum += 1
+
+        del buf[:pos]
+        self.num_frames += len(frames)
+        self.num_skipped += pos - frame_bytes
+        return frames
+
+class FrameEncoder:
+    # Builds outgoing frames in a preallocated buffer using precompiled
+    # struct formats, so sending a command does not build any lists
+    def __init__(self):
+        self._buf = bytearray(_HEADER.size + MAX_PAYLOAD_LEN + 1)
+        self._view = memoryview(self._buf)
+        self._formats = {}
+
+    def _finish(self, n):
+        self._buf[n] = checksum(self._view[1:n])
+        return bytes(self._view[:n + 1])
+
+    def pack(self, msg_type, fmt, *values):
+        # Frame with the payload packed from values using struct format fmt
+        s = self._formats.get(fmt)
+        if s is None:
+            s = struct.Struct(fmt)
+            self._formats[fmt] = s
+        _HEADER.pack_into(self._buf, 0, FRAME_SYNC, msg_type, s.size)
+        s.pack_into(self._buf, _HEADER.size, *values)
+        return self._finish(_HEADER.size + s.size)
+
+    def encode(self, msg_type, payload):
+        # Frame around an already packed payload
+        length = len(payload)
+        if length > MAX_PAYLOAD_LEN:
+            raise ValueError("Payload of {0} bytes is too long".format(length))
+        _HEADER.pack_into(self._buf, 0, FRAME_SYNC, msg_type, length)
+        self._buf[_HEADER.size:_HEADER.size + length] = payload
+        return self._finish(_HEADER.size + length)
+
+def read_frame(ser, decoder, timeout, msg_type=None, instrumentation=None):
+    # Read from ser until decoder produces a frame (of msg_type, if given)
+    # or timeout seconds pass. Returns (msg_type, payload) or (None, None).
+    # Frames decoded in the same chunk after the one returned are kept on
+    # the decoder and handed out first on the next call. Bytes read and
+    # time spent reading and decoding go to instrumentation, if given.
+    end_time = time.time() + timeout
+    while True:
+        while decoder.pending:
+            frame = decoder.pending.popleft()
+            if msg_type is None or frame[0] == msg_type:
+                return frame
+        if time.time() >= end_time:
+            return (None, None)
+
+        read_start = time.perf_counter()
+        try:
+            data = ser.read(max(1, ser.in_waiting))
+        except TypeError:
+            return (None, None)
+        decode_start = time.perf_counter()
+        decoder.pending.extend(decoder.feed(data))
+        if instrumentation is not None:
+            instrumentation.count("bytes_read", len(data))
+            instrumentation.record_time("read_s", decode_start - read_start)
+            instrumentation.record_time("decode_s", time.perf_counter() - decode_start)
@@ -0,0 +1,178 @@
+import math
+import numpy as np
+
+class RunningStats:
+    # Count, mean, variance (Welford), min and max updated one chunk of
+    # samples at a time, so reading them costs the same however many
+    # samples have gone by. Chunks are folded in with the pairwise form of
+    # Welford's update (Chan et al.), which keeps the accuracy of the
+    # per-sample version without a Python loop.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _combine(self, count, mean, m2, min_value, max_value):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, min_value)
+        self.max = max(self.max, max_value)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        self._combine(values.size, mean, m2, values.min(), values.max())
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+
+    def copy(self):
+        stats = RunningStats()
+        stats.merge(self)
+        return stats
+
+    def variance(self):
+        # Population variance, as np.var
+        if self.count == 0:
+            return None
+        return self.m2 / self.count
+
+    def std_dev(self):
+        if self.count == 0:
+            return None
+        return math.sqrt(self.m2 / self.count)
+
+    def std_error(self):
+        # Standard error of the mean, from the sample standard deviation
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1) / self.count)
+
+    def summary(self):
+        if self.count == 0:
+            return (0, None, None)
+        return (self.count, self.mean, self.std_dev())
+
+class LogHistogram:
+    # Streaming quantiles in constant memory. Each sample's deviation from a
+    # reference level (ref, by default the mean of the first chunk) is
+    # counted in log spaced bins, bins_per_decade per decade of |deviation|
+    # / |ref| from min_rel to max_rel on either side, with smaller
+    # deviations in a zero bin and larger ones in an overflow bin at each
+    # end. Quantiles are interpolated within bins, so they are good to a
+    # fraction of a bin width of their own distance from ref (about 5% at
+    # 50 bins per decade), however far the tails reach or however skewed
+    # the noise. Updates are one vectorized pass per chunk and histograms
+    # with the same ref and bins merge, so any window can be summarized
+    # without keeping or sorting its samples.
+    def __init__(self, ref=None, min_rel=1.0e-9, max_rel=1.0e3, bins_per_decade=50):
+        self.min_rel = min_rel
+        self.max_rel = max_rel
+        self.bins_per_decade = bins_per_decade
+        self.num_bins = int(math.ceil(math.log10(max_rel / min_rel) * bins_per_decade)) + 1
+        # Magnitude edges of the bins on one side; the last bin is open ended
+        self.magnitude_edges = min_rel * 10.0 ** (np.arange(self.num_bins) / bins_per_decade)
+        self.initial_ref = ref
+        self.reset()
+
+    def reset(self):
+        # Bin j holds deviations below (j < num_bins), inside (j ==
+        # num_bins) and above (j > num_bins) the zero bin
+        self.counts = np.zeros(2 * self.num_bins + 1, dtype=np.int64)
+        self.count = 0
+        self.ref = self.initial_ref
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _scale(self):
+        return abs(self.ref) if self.ref else 1.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        if self.ref is None:
+            self.ref = float(values.mean())
+        deviation = (values - self.ref) / self._scale()
+        magnitude = np.abs(deviation)
+        # Only finite, non-zero deviations have a log. Zero and NaN (a
+        # garbage frame) go in the zero bin and infinities in the overflow.
+        k = np.where(np.isinf(magnitude), self.num_bins, 0)
+        has_log = np.isfinite(magnitude) & (magnitude > 0.0)
+        log_bin = np.floor(np.log10(magnitude[has_log] / self.min_rel) * self.bins_per_decade) + 1
+        k[has_log] = np.clip(log_bin, 0, self.num_bins)
+        self.counts += np.bincount(self.num_bins + np.where(deviation < 0, -k, k), minlength=len(self.counts))
+        self.count += values.size
+        self.min = min(self.min, np.fmin.reduce(values))
+        self.max = max(self.max, np.fmax.reduce(values))
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.ref is None:
+            self.ref = other.ref
+        if (other.ref, other.min_rel, other.max_rel, other.bins_per_decade) != (self.ref, self.min_rel, self.max_rel, self.bins_per_decade):
+            raise ValueError("Only histograms with the same ref and bins can be merged")
+        self.counts += other.counts
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        histogram = LogHistogram(ref=self.ref, min_rel=self.min_rel, max_rel=self.max_rel, bins_per_decade=self.bins_per_decade)
+        histogram.merge(self)
+        return histogram
+
+    def _value_edges(self):
+        # Edges of every bin in increasing value order, with the overflow
+        # bins closed off at the smallest and largest values seen
+        magnitudes = self.magnitude_edges
+        deviation = np.concatenate(([-math.inf], -magnitudes[::-1], magnitudes, [math.inf]))
+        edges = self.ref + deviation * self._scale()
+        edges[0] = min(edges[1], self.min)
+        edges[-1] = max(edges[-2], self.max)
+        return edges
+
+    def percentile(self, q):
+        # Value below which q percent of the samples fall (q may be an
+        # array), or None before any samples
+        if self.count == 0:
+            return None
+        cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        value = np.interp(np.asarray(q, dtype=np.float64) * 0.01 * self.count, cumulative, self._value_edges())
+        return np.clip(value, self.min, self.max)
+
+    def median(self):
+        return self.percentile(50.0)
+
+    def mad(self):
+        # Median absolute deviation from the median, taking each bin's
+        # samples as sitting at its middle
+        if self.count == 0:
+            return None
+        median = self.median()
+        edges = self._value_edges()
+        distance = np.abs(0.5 * (edges[:-1] + edges[1:]) - median)
+        order = np.argsort(distance)
+        cumulative = np.cumsum(self.counts[order])
+        return float(distance[order][np.searchsorted(cumulative, 0.5 * self.count)])
+
+    def summary(self):
+        # (count, median, mad, 2.5th percentile, 97.5th percentile)
+        if self.count == 0:
+            return (0, None, None, None, None)
+        (low, median, high) = self.percentile([2.5, 50.0, 97.5])
+        return (self.count, float(median), self.mad(), float(low), float(high))
@@ -0,0 +1,165 @@
+import numpy as np
+
+# Host side copy of the HDR supply firmware's setpoint math (main.c and
+# dac80501.c), so the current a request will produce is known without a
+# round trip. Arithmetic follows the firmware step by step: float values
+# are float32, and the double literals in the C (1.0, 0.001, 1000.0)
+# promote those steps to float64 before the result is stored back.
+#
+# Stage 7 is the 10 MOhm default resistor alone. Stages 6..0 switch in
+# R_G[stage] plus the FET on resistance in parallel with it.
+R_DEFAULT = 10000000.0
+R_G = [7.66, 12.76666, 100.0, 1000.0, 10000.0, 100000.0, 1000000.0]
+FET_R_OHM = 0.048
+FIXED_REF_V = 3.0
+NUM_STAGES = 8
+
+# Upper limit in mA of each stage as set_current_level() picks them for a
+# request. Entry i is the limit of stage 7 - i. Requests at or above the
+# last limit are ignored by the firmware. The limits are double literals,
+# so the float32 request is promoted and compared in float64: a request of
+# 0.02 is float32 0.0199999995... and lands in stage 5.
+STAGE_LIMITS_MA = [250.0 * 1.0e-6, 0.002, 0.02, 0.2, 2.0, 20.0, 190.0, 326.0]
+
+# Seconds to discard after switching to each stage before any sample of
+# it is used, whatever the samples look like. This is the 0.5 s dummy
+# measurement the calibration scripts always made after a stage change;
+# no stage has been found to need more or less yet.
+MIN_SETTLE_TIME_S = [0.5] * NUM_STAGES
+
+# DAC80501 at 2x gain on its 1.25 V internal reference: millivolt commands
+# clamp at DAC_MAX_MV and are then truncated to a 16 bit code
+DAC_MAX_MV = 2500
+DAC_FULL_SCALE = 65535
+
+def _calc_r_parallel_to_default(r):
+    return np.float32(1.0 / ((1.0 / np.float64(np.float32(R_DEFAULT))) + (1.0 / np.float64(r))))
+
+def _stage_resistance():
+    r_vals = np.empty(NUM_STAGES, dtype=np.float32)
+    for (stage, r_g) in enumerate(R_G):
+        r_vals[stage] = _calc_r_parallel_to_default(np.float32(r_g) + np.float32(FET_R_OHM))
+    r_vals[7] = np.float32(R_DEFAULT)
+    return r_vals
+
+# Shunt resistance of each stage as the firmware computes it (r_vals[])
+STAGE_R_OHM = _stage_resistance()
+
+def stage_for_current(current_ma):
+    # Stage set_current_level() picks for each request, or -1 where the
+    # request is ignored
+    current_ma = np.asarray(current_ma, dtype=np.float32).astype(np.float64)
+    index = np.searchsorted(np.array(STAGE_LIMITS_MA, dtype=np.float64), current_ma, side="right")
+    return np.where(index < NUM_STAGES, NUM_STAGES - 1 - index, -1)
+
+def dac_mv_for_current(current_ma, stage):
+    # _set_voltage_on_dac(): the millivolt command for a request in a stage.
+    # C's round() goes half away from zero, and the cast to uint16 wraps.
+    current_ma = np.asarray(current_ma, dtype=np.float32).astype(np.float64)
+    v_output = ((current_ma * 0.001) * STAGE_R_OHM[stage].astype(np.float64)).astype(np.float32)
+    mv = np.floor(v_output.astype(np.float64) * 1000.0 + 0.5)
+    return np.maximum(mv, 0).astype(np.int64) & 0xFFFF
+
+def reported_current_ma(stage, ref_mv):
+    # _get_current_level(): the value sent back in CURRENT_SET for a stage
+    # and reference in mV. The firmware uses the reference it asked for,
+    # before the DAC clamps it.
+    ref_v = (np.asarray(ref_mv, dtype=np.float64) * 0.001).astype(np.float32)
+    current_level_a = ref_v / STAGE_R_OHM[stage]
+    return (current_level_a.astype(np.float64) * 1000.0).astype(np.float32)
+
+def output_current_ma(stage, ref_mv):
+    # Current actually driven: the reference after the DAC's clamp and its
+    # 16 bit truncation, across the stage resistance
+    mv = np.minimum(np.asarray(ref_mv, dtype=np.int64), DAC_MAX_MV)
+    code = (mv * DAC_FULL_SCALE) // DAC_MAX_MV
+    dac_v = code * (DAC_MAX_MV * 0.001 / DAC_FULL_SCALE)
+    return dac_v / STAGE_R_OHM[stage].astype(np.float64) * 1000.0
+
+def predict(current_ma):
+    # Everything set_current_level() does with a request (adjustable
+    # reference mode). Returns (stage, dac_mv, reported_ma, output_ma);
+    # ignored requests get stage -1 and NaN currents.
+    stage = stage_for_current(current_ma)
+    valid = stage >= 0
+    safe_stage = np.where(valid, stage, 0)
+    mv = dac_mv_for_current(current_ma, safe_stage)
+    reported_ma = np.where(valid, reported_current_ma(safe_stage, mv), np.nan)
+    output_ma = np.where(valid, output_current_ma(safe_stage, mv), np.nan)
+    return (stage, mv, reported_ma, output_ma)
+
+def fixed_stage_current_ma(stage):
+    # Current of a stage in fixed reference mode
+    return reported_current_ma(stage, np.round(FIXED_REF_V * 1000.0))
+
+SETPOINT_DTYPE = np.dtype([
+    ("stage", "i1"),
+    ("dac_mv", "i4"),
+    ("request_ma", "f4"),
+    ("reported_ma", "f4"),
+    ("output_ma", "f8"),
+])
+
+def _float32_below(limit_ma):
+    # Largest float32 request that compares below a stage limit
+    x = np.float32(limit_ma)
+    if np.float64(x) >= limit_ma:
+        x = np.nextafter(x, np.float32(0.0))
+    return x
+
+def _float32_from(limit_ma):
+    # Smallest float32 request that compares at or above a stage limit
+    x = np.float32(limit_ma)
+    if np.float64(x) < limit_ma:
+        x = np.nextafter(x, np.float32(np.inf))
+    return x
+
+def _build_table():
+    # Every (stage, DAC mV) pair some request can reach without the DAC
+    # clamping, with a request that lands on it, sorted by output current
+    rows = []
+    mv = np.arange(DAC_MAX_MV + 1)
+    low_ma = np.float32(0.0)
+    for (i, limit_ma) in enumerate(STAGE_LIMITS_MA):
+        stage = NUM_STAGES - 1 - i
+        high_ma = _float32_below(limit_ma)
+        # Aim at the middle of each code, kept inside the stage's range
+        request_ma = (mv * 0.001 / STAGE_R_OHM[stage].astype(np.float64) * 1000.0).astype(np.float32)
+        request_ma = np.clip(request_ma, low_ma, high_ma)
+        (got_stage, got_mv, reported_ma, output_ma) = predict(request_ma)
+        hit = (got_stage == stage) & (got_mv == mv)
+        table = np.zeros(np.count_nonzero(hit), dtype=SETPOINT_DTYPE)
+        table["stage"] = stage
+        table["dac_mv"] = mv[hit]
+        table["request_ma"] = request_ma[hit]
+        table["reported_ma"] = reported_ma[hit]
+        table["output_ma"] = output_ma[hit]
+        rows.append(table)
+        low_ma = _float32_from(limit_ma)
+    table = np.concatenate(rows)
+    return table[np.argsort(table["output_ma"], kind="stable")]
+
+# All representable setpoints, 8 stages x DAC codes
+SETPOINT_TABLE = _build_table()
+
+def _nearest_indices(target_ma):
+    # Index into SETPOINT_TABLE of the output closest (in ratio) to each
+    # target, skipping the zero output rows at the start
+    output_ma = SETPOINT_TABLE["output_ma"]
+    first = np.searchsorted(output_ma, 0.0, side="right")
+    log_output = np.log(output_ma[first:])
+    log_target = np.log(np.maximum(np.asarray(target_ma, dtype=np.float64), output_ma[first]))
+    above = np.clip(np.searchsorted(log_output, log_target), 1, len(log_output) - 1)
+    below = above - 1
+    closer_above = (log_output[above] - log_target) < (log_target - log_output[below])
+    return first + np.where(closer_above, above, below)
+
+def nearest_setpoints(target_ma):
+    # Table rows whose output is closest to each target
+    return SETPOINT_TABLE[_nearest_indices(target_ma)]
+
+def plan_sweep(start_ma, stop_ma, num):
+    # Log spaced sweep snapped to representable setpoints, without repeats,
+    # in increasing order. Send request_ma; the supply will report
+    # reported_ma and drive output_ma.
+    return SETPOINT_TABLE[np.unique(_nearest_indices(np.geomspace(start_ma, stop_ma, num=num)))]
@@ -0,0 +1,199 @@
+import concurrent.futures
+import numpy as np
+import supply_model as sm
+from streaming_stats import LogHistogram
+
+# One row per setpoint. actual_ma is the current the supply reports it set
+# and predicted_ma the current supply_model expects it to drive (the
+# reported value after the DAC's own quantization); the errors compare the
+# MetaShunt mean against predicted_ma. The median, MAD and 2.5 / 97.5
+# percentiles are over the same samples as the mean; error_p95_pct is the
+# error of the percentile on the side the mean is off to, which unlike
+# mean + 2 sigma holds up when the noise has outliers or is not Gaussian.
+# ok is False for
+# points that never settled (their last reading is kept) or never got a
+# usable reply (left as NaN).
+SWEEP_DTYPE = np.dtype([
+    ("command_ma", "f8"),
+    ("actual_ma", "f8"),
+    ("predicted_ma", "f8"),
+    ("num_samples", "i8"),
+    ("mean_ma", "f8"),
+    ("std_dev_ma", "f8"),
+    ("std_error_ma", "f8"),
+    ("settled", "?"),
+    ("error_pct", "f8"),
+    ("error_2sigma_pct", "f8"),
+    ("median_ma", "f8"),
+    ("mad_ma", "f8"),
+    ("p2_5_ma", "f8"),
+    ("p97_5_ma", "f8"),
+    ("error_p95_pct", "f8"),
+    ("attempts", "i4"),
+    ("ok", "?"),
+])
+
+# The supply reports its setting as a float32 worked out exactly as
+# supply_model does, so a reply for the right request matches the
+# prediction to float32 rounding, about one part in 1e7
+REPLY_REL_TOL = float(np.finfo(np.float32).eps)
+
+class SweepEngine:
+    # Steps an HDRPrecisionCurrentSupply in adjustable reference mode
+    # through a list of setpoints and measures each with a streaming
+    # MetaShuntV2, so there is no flush or dummy measurement between points.
+    # Each point's window starts when the supply reports the new setting
+    # and ends as soon as measure_until() judges it settled and precise.
+    # The next command goes out on a worker thread right then, while the
+    # finished point is written up. Points that fail are retried together
+    # at the end. After a point that switches stage, samples are only used
+    # from supply_model.MIN_SETTLE_TIME_S of that stage on; min_settle_time
+    # instead sets one time used after every point.
+    def __init__(self, supply, metashunt, rel_precision=1e-4, max_time=1.5, setpoint_tol=0.01, max_retries=3, min_settle_time=None):
+        self.supply = supply
+        self.metashunt = metashunt
+        self.rel_precision = rel_precision
+        self.max_time = max_time
+        self.setpoint_tol = setpoint_tol
+        self.max_retries = max_retries
+        self.min_settle_time = min_settle_time
+
+    def _command(self, command_ma):
+        # Returns the reported setting and the stream position once it was
+        # reported, as the output has changed by then. The reply must match
+        # the model's prediction, which also rules out a stale one.
+        (stage, dac_mv, reported_ma, output_ma) = sm.predict(command_ma)
+        expected_ma = float(reported_ma) if stage >= 0 else None
+        actual_ma = self.supply.set_and_confirm(current_ma=command_ma, expected_ma=expected_ma, rel_tol=REPLY_REL_TOL)
+        return (actual_ma, self.metashunt.stream_position())
+
+    def _fill_row(self, row, actual_ma, stats, quantiles):
+        (num_meas, avg_ma, std_dev_ma, settled) = stats
+        row["attempts"] += 1
+        if actual_ma is None or avg_ma is None:
+            return
+        if np.abs((row["command_ma"] - actual_ma) / row["command_ma"]) >= self.setpoint_tol:
+            return
+
+        row["actual_ma"] = actual_ma
+        # Fall back to the reported value for requests the model rejects
+        true_ma = row["predicted_ma"] if np.isfinite(row["predicted_ma"]) else actual_ma
+        row["num_samples"] = num_meas
+        row["mean_ma"] = avg_ma
+        row["std_dev_ma"] = std_dev_ma
+        row["std_error_ma"] = std_dev_ma / np.sqrt(num_meas)
+        row["settled"] = settled
+        row["error_pct"] = 100.0 * (avg_ma - true_ma) / true_ma
+        # Mean + 2 sigma on the side the mean is already off to
+        if avg_ma > true_ma:
+            current_meas_2sigma_ma = avg_ma + 2.0 * std_dev_ma
+        else:
+            current_meas_2sigma_ma = avg_ma - 2.0 * std_dev_ma
+        row["error_2sigma_pct"] = 100.0 * (current_meas_2sigma_ma - true_ma) / true_ma
+        (num_quantile, median_ma, mad_ma, p2_5_ma, p97_5_ma) = quantiles.summary()
+        if num_quantile > 0:
+            row["median_ma"] = median_ma
+            row["mad_ma"] = mad_ma
+            row["p2_5_ma"] = p2_5_ma
+            row["p97_5_ma"] = p97_5_ma
+            current_meas_p95_ma = p97_5_ma if avg_ma > true_ma else p2_5_ma
+            row["error_p95_pct"] = 100.0 * (current_meas_p95_ma - true_ma) / true_ma
+        # Unsettled readings are kept but the point is tried again
+        row["ok"] = settled
+
+    def _settle_time(self, stage, prev_stage):
+        if self.min_settle_time is not None:
+            return self.min_settle_time
+        if stage < 0 or stage == prev_stage:
+            return 0.0
+        return sm.MIN_SETTLE_TIME_S[stage]
+
+    def _run_points(self, results, indices, pool):
+        stages = sm.stage_for_current(results["command_ma"][indices])
+        prev_stage = None
+        future = pool.submit(self._command, results["command_ma"][indices[0]])
+        for (n, i) in enumerate(indices):
+            (actual_ma, position) = future.result()
+            min_settle_time = self._settle_time(stages[n], prev_stage)
+            if stages[n] >= 0:
+                prev_stage = stages[n]
+            quantiles = LogHistogram()
+            stats = self.metashunt.measure_until(rel_precision=self.rel_precision, max_time=self.max_time, position=position, quantiles=quantiles, min_settle_time=min_settle_time)
+            if n + 1 < len(indices):
+                future = pool.submit(self._command, results["command_ma"][indices[n + 1]])
+            self._fill_row(results[i], actual_ma, stats, quantiles)
+
+    def run(self, setpoints_ma):
+        results = np.zeros(len(setpoints_ma), dtype=SWEEP_DTYPE)
+        results["command_ma"] = setpoints_ma
+        results["predicted_ma"] = sm.predict(results["command_ma"])[3]
+        for field in ["actual_ma", "mean_ma", "std_dev_ma", "std_error_ma", "error_pct", "error_2sigma_pct",
+                      "median_ma", "mad_ma", "p2_5_ma", "p97_5_ma", "error_p95_pct"]:
+            results[field] = np.nan
+        if len(results) == 0:
+            return results
+
+        started_stream = not self.metashunt.is_streaming()
+        if started_stream:
+            self.metashunt.start_stream(max_samples=1000000)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                indices = np.arange(len(results))
+                for attempt in range(self.max_retries):
+                    if len(indices) == 0:
+                        break
+                    self._run_points(results, indices, pool)
+                    indices = np.flatnonzero(~results["ok"])
+        finally:
+            if started_stream:
+                self.metashunt.stop_stream()
+        return results
+
+    def _refine_points(self, results, error_tol_pct, min_step):
+        # New setpoints for one round of refinement of a sorted results table
+        command_ma = results["command_ma"]
+        new_points = []
+        for i in range(len(results) - 1):
+            (low, high) = (results[i], results[i + 1])
+            (low_ma, high_ma) = (command_ma[i], command_ma[i + 1])
+
+            # Bracket each supply stage boundary in the interval, so the jump
+            # in error there is resolved from both sides, and never split
+            # across one on error alone. The firmware compares the float32
+            # request with the limit, so the bracket is the first float32
+            # request at or above the limit and the one before it.
+            limits_ma = [limit_ma for limit_ma in sm.STAGE_LIMITS_MA if low_ma < sm._float32_from(limit_ma) <= high_ma]
+            for limit_ma in limits_ma:
+                from_ma = sm._float32_from(limit_ma)
+                for point_ma in [np.nextafter(from_ma, np.float32(0.0)), from_ma]:
+                    if not np.any(command_ma == point_ma):
+                        new_points.append(float(point_ma))
+            if len(limits_ma) > 0:
+                continue
+
+            # Otherwise split where the error curve is not yet flat
+            if high_ma / low_ma < min_step or not (low["ok"] and high["ok"]):
+                continue
+            # Differences within the noise of the two means don't count
+            noise_pct = 200.0 * np.hypot(low["std_error_ma"] / low_ma, high["std_error_ma"] / high_ma)
+            if (np.abs(high["error_pct"] - low["error_pct"]) > error_tol_pct + noise_pct
+                    or np.abs(high["error_2sigma_pct"] - low["error_2sigma_pct"]) > error_tol_pct + noise_pct):
+                new_points.append(np.sqrt(low_ma * high_ma))
+        return np.unique(new_points)
+
+    def run_adaptive(self, start_ma, stop_ma, num_coarse=12, error_tol_pct=0.05, min_step=1.05, max_points=200):
+        # Sweeps a coarse log spaced grid, then keeps adding points between
+        # neighbours whose error (or 2 sigma error) differs by more than
+        # error_tol_pct, and either side of each supply stage boundary crossed,
+        # until the curve is resolved to that tolerance, intervals are down to
+        # a ratio of min_step, or max_points have been measured. Returns the
+        # same table as run(), sorted by command_ma.
+        results = self.run(np.geomspace(start_ma, stop_ma, num=num_coarse))
+        while len(results) < max_points:
+            new_points = self._refine_points(results, error_tol_pct, min_step)
+            new_points = new_points[:max_points - len(results)]
+            if len(new_points) == 0:
+                break
+            results = np.concatenate((results, self.run(new_points)))
+            results = results[np.argsort(results["command_ma"], kind="stable")]
+        return results
@@ -0,0 +1,32 @@
+import device_simulator as ds
+import HDRPrecisionCurrentSupply as pcs
+import metashunt_v2 as ms2
+import supply_model as sm
+import calibration_controller as cc
+
+def connect_rig(supply_settle_time):
+    supply_ser = ds.SimulatedHDRSupply(constant_ref_mode=True, settle_time=supply_settle_time)
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.FIXED_REFERENCE)
+    supply.connect(ser=supply_ser)
+    device = ds.SimulatedMetaShunt(current_source=supply_ser.output_ma, seed=1)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=device)
+    return (supply, metashunt, device)
+
+def test_unsettled_stage_is_not_calibrated(monkeypatch, tmp_path):
+    monkeypatch.setattr(cc, "measure_max_time", 0.3)
+    monkeypatch.setattr(sm, "MIN_SETTLE_TIME_S", [0.0] * sm.NUM_STAGES)
+    (supply, metashunt, device) = connect_rig(supply_settle_time=10.0)
+    config = dict(device.config)
+    messages = []
+    try:
+        result = cc.calibrate(supply, metashunt, pre_cal_filename=str(tmp_path / "pre.json"),
+                              post_cal_filename=str(tmp_path / "post.json"), log=messages.append)
+    finally:
+        metashunt.disconnect()
+        supply.disconnect()
+    assert not result["configured"]
+    assert False in result["pre_cal_settled"]
+    assert "post_cal_config" not in result
+    assert device.config == config
+    assert any("did not settle" in message for message in messages)
@@ -0,0 +1,55 @@
+import numpy as np
+import capture as cp
+import device_simulator as ds
+import metashunt_v2 as ms2
+
+def replay_samples(port):
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=port)
+    samples = []
+    while not port.at_end():
+        samples.append(metashunt.read_samples())
+    return np.concatenate(samples)
+
+def make_samples(n, seed):
+    samples = np.frombuffer(ds.make_sample_stream(n, current_ma=0.518, seed=seed), dtype=np.uint8)
+    return samples.reshape(-1, ms2.FRAME_LEN)[:, 1:9].copy().view(ms2.SAMPLE_DTYPE).ravel()
+
+def test_sample_capture_round_trip(tmp_path):
+    file_name = str(tmp_path / "samples.cap")
+    samples = make_samples(10000, seed=1)
+    # Small growth steps so the file is resized many times while mapped
+    writer = cp.CaptureWriter(file_name, dtype=ms2.SAMPLE_DTYPE, grow_bytes=4096)
+    for chunk in np.array_split(samples, 17):
+        writer.append(chunk)
+        # Readable with everything so far before close(), as after a crash
+        assert cp.read_header(file_name)[1] == writer.num_records
+    assert np.array_equal(cp.open_capture(file_name), samples[:writer.num_records])
+    writer.close()
+
+    (dtype, num_records, start_time) = cp.read_header(file_name)
+    assert (dtype, num_records, start_time) == (ms2.SAMPLE_DTYPE, len(samples), writer.start_time)
+    assert np.array_equal(cp.open_capture(file_name), samples)
+    replayed = replay_samples(cp.CaptureReplay(file_name, encode=ms2.encode_frames, chunk_size=999))
+    assert np.array_equal(replayed, samples)
+
+def test_raw_capture_round_trip(tmp_path):
+    file_name = str(tmp_path / "raw.cap")
+    stream = ds.damage_bytes(ds.make_sample_stream(5000, seed=2), 1e-3, 0.0, np.random.default_rng(3))
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.ReplaySerial(stream, chunk_size=1000))
+    metashunt.start_capture(file_name, raw=True)
+    samples = []
+    while not metashunt.ser.at_end():
+        samples.append(metashunt.read_samples())
+    metashunt.stop_capture()
+
+    assert cp.open_capture(file_name).tobytes() == stream
+    replayed = replay_samples(cp.CaptureReplay(file_name, chunk_size=333))
+    assert np.array_equal(replayed, np.concatenate(samples))
+
+def test_empty_capture(tmp_path):
+    file_name = str(tmp_path / "empty.cap")
+    cp.CaptureWriter(file_name, dtype=ms2.SAMPLE_DTYPE).close()
+    assert len(cp.open_capture(file_name)) == 0
+    assert cp.CaptureReplay(file_name, encode=ms2.encode_frames).at_end()
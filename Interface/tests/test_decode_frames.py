@@ -0,0 +1,94 @@
+import struct
+import pytest
+import numpy as np
+import device_simulator as ds
+import metashunt_v2 as ms2
+
+def baseline_decode(data):
+    # The original byte at a time get_packet() state machine: wait for the
+    # sync byte, take 8 payload bytes, keep them if the next byte is their
+    # sum and start over either way. Returns (samples, num_bad).
+    samples = []
+    num_bad = 0
+    step = 0
+    payload = []
+    for byte in data:
+        if step == 0:
+            if byte == ms2.FRAME_SYNC:
+                step = 1
+        elif step == 1:
+            payload.append(byte)
+            if len(payload) == 8:
+                step = 2
+        else:
+            if byte == sum(payload) & 0xFF:
+                samples.append(struct.unpack("<If", bytes(payload)))
+            else:
+                num_bad += 1
+            step = 0
+            payload = []
+    decoded = np.zeros(len(samples), dtype=ms2.SAMPLE_DTYPE)
+    if samples:
+        (decoded["time"], decoded["current_ma"]) = zip(*samples)
+    return (decoded, num_bad)
+
+def bulk_decode(data, chunk_size, config_reads=()):
+    # Everything MetaShuntV2 makes of data arriving chunk_size bytes at a time
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.ReplaySerial(data, chunk_size=chunk_size))
+    metashunt.config.request(config_reads)
+    samples = []
+    while not metashunt.ser.at_end():
+        samples.append(metashunt.read_samples())
+    counters = metashunt.instrumentation.snapshot()["counters"]
+    return (np.concatenate(samples), counters.get("checksum_failures", 0), metashunt.config)
+
+def same_samples(a, b):
+    # Bit for bit, as corrupt frames can decode to NaN
+    return len(a) == len(b) and np.array_equal(a.view(np.uint64), b.view(np.uint64))
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 10, 37, 4096])
+@pytest.mark.parametrize("corrupt_prob,drop_prob", [(0.0, 0.0), (1e-3, 0.0), (0.0, 1e-3), (1e-2, 1e-2)])
+def test_bulk_decoder_matches_state_machine(chunk_size, corrupt_prob, drop_prob):
+    rng = np.random.default_rng(1)
+    stream = ds.make_sample_stream(3000, current_ma=0.518, seed=2)
+    stream = ds.damage_bytes(stream, corrupt_prob, drop_prob, rng)
+    # Start part way into a frame, as after opening the port mid-stream
+    stream = stream[4:]
+
+    (expected, expected_bad) = baseline_decode(stream)
+    (samples, num_bad, config) = bulk_decode(stream, chunk_size)
+    assert same_samples(samples, expected)
+    assert num_bad == expected_bad
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_config_replies_among_damaged_samples(chunk_size):
+    # Replies land between frames of a stream with some corrupt bytes
+    rng = np.random.default_rng(3)
+    frames = np.frombuffer(ds.make_sample_stream(3000, current_ma=1.0, seed=4), dtype=np.uint8).reshape(-1, ms2.FRAME_LEN)
+    indices = list(ms2.config_key_dict)
+    at = np.sort(rng.choice(np.arange(1, len(frames)), len(indices), replace=False))
+    values = rng.uniform(0.1, 1000.0, len(indices)).astype(np.float32)
+    parts = []
+    prev = 0
+    for (i, index, value) in zip(at, indices, values):
+        parts.append(frames[prev:i].tobytes())
+        parts.append(ms2.encode_config_response(index, value))
+        prev = i
+    parts.append(frames[prev:].tobytes())
+    stream = ds.damage_bytes(b"".join(parts), 1e-4, 0.0, rng)
+
+    # Samples as the state machine had them, less any reply that ran into
+    # the next sync byte and passed a sample checksum
+    (expected, expected_bad) = baseline_decode(stream)
+    payload = expected.view(np.uint8).reshape(-1, 8)
+    is_reply = ((payload[:, 0] == ms2.CONFIG_RESPONSE) & (payload[:, :6].sum(axis=1) & 0xFF == payload[:, 6])
+                & (payload[:, 7] == ms2.FRAME_SYNC))
+    (samples, num_bad, config) = bulk_decode(stream, chunk_size, indices)
+    assert same_samples(samples, expected[~is_reply])
+    assert num_bad == expected_bad + np.count_nonzero(is_reply)
+    # Every reply that came through intact is taken
+    readback = config.finish(indices)
+    for (index, value) in zip(indices, values):
+        if ms2.encode_config_response(index, value) in stream:
+            assert readback[index] == value
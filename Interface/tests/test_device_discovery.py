@@ -0,0 +1,58 @@
+import json
+import types
+import device_discovery as dd
+
+VID = 1155
+PID = 100
+
+def comport(device, serial_number, vid=VID, pid=PID):
+    return types.SimpleNamespace(device=device, serial_number=serial_number, vid=vid, pid=pid)
+
+def fake_ports(monkeypatch, ports):
+    # comports() returns whatever ports holds when it is called, and counts
+    # the calls
+    calls = []
+    def comports():
+        calls.append(None)
+        return list(ports)
+    monkeypatch.setattr(dd.serial.tools.list_ports, "comports", comports)
+    monkeypatch.setattr(dd, "SysFS", None)
+    monkeypatch.setattr(dd, "poll_interval", 0.01)
+    return calls
+
+def test_scan_and_find(monkeypatch, tmp_path):
+    ports = [comport("/dev/ttyACM1", "B"), comport("/dev/ttyACM0", "A"), comport("/dev/ttyS0", None, vid=None, pid=None),
+             comport("/dev/ttyUSB0", "X", vid=0x0403, pid=0x6001)]
+    fake_ports(monkeypatch, ports)
+    cache_filename = str(tmp_path / "ports.json")
+    index = dd.DeviceIndex(cache_filename=cache_filename)
+
+    assert index.serial_numbers(VID, PID) == ["A", "B"]
+    assert index.find(VID, PID, "B") == ("/dev/ttyACM1", "B")
+    # The first by serial number without one
+    assert index.find(VID, PID) == ("/dev/ttyACM0", "A")
+    assert index.find(VID, PID, "C") is None
+    assert index.find(0x1234, 0x5678) is None
+
+    # The index is kept between runs
+    with open(cache_filename) as f:
+        assert json.load(f)["{0:04x}:{1:04x}".format(VID, PID)] == {"A" : "/dev/ttyACM0", "B" : "/dev/ttyACM1"}
+    assert dd.DeviceIndex(cache_filename=cache_filename).ports == index.ports
+
+def test_unreadable_cache_is_ignored(tmp_path):
+    cache_filename = tmp_path / "ports.json"
+    cache_filename.write_text("{not json")
+    assert dd.DeviceIndex(cache_filename=str(cache_filename)).ports == {}
+
+def test_waits(monkeypatch):
+    ports = []
+    calls = fake_ports(monkeypatch, ports)
+    index = dd.DeviceIndex(cache_filename=None)
+    assert index.wait_until_attached(VID, PID, "A", timeout=0.05) is None
+    assert len(calls) >= 2
+    assert index.wait_until_detached(VID, PID, "A", timeout=0.0)
+
+    ports.append(comport("/dev/ttyACM0", "A"))
+    assert index.wait_until_attached(VID, PID, "A", timeout=0.05) == ("/dev/ttyACM0", "A")
+    assert not index.wait_until_detached(VID, PID, "A", timeout=0.05)
+    assert index.wait_for_device(VID, PID, "B", timeout=0.05) is None
@@ -0,0 +1,67 @@
+import pytest
+import device_simulator as ds
+import HDRPrecisionCurrentSupply as pcs
+
+class UnpluggedPort:
+    # What a port that has dropped off the bus does
+    is_open = True
+    timeout = 0.1
+
+    @property
+    def in_waiting(self):
+        raise OSError("device disconnected")
+
+    def read(self, size=1):
+        raise OSError("device disconnected")
+
+    def write(self, data):
+        raise OSError("device disconnected")
+
+    def reset_input_buffer(self):
+        raise OSError("device disconnected")
+
+    def close(self):
+        pass
+
+def replug(monkeypatch, supply):
+    # The supply comes back as a fresh device on its next open
+    replugged = ds.SimulatedHDRSupply()
+    monkeypatch.setattr(pcs.dd.default_index, "wait_for_device", lambda vid, pid, serial_number, timeout: (replugged, serial_number))
+    supply.ser = UnpluggedPort()
+    return replugged
+
+def connect_supply(supply_type):
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=supply_type)
+    supply.connect(ser=ds.SimulatedHDRSupply())
+    supply.serial_number = "sim"
+    return supply
+
+def test_set_and_confirm_reconnects(monkeypatch):
+    supply = connect_supply(pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
+    assert supply.set_and_confirm(current_ma=1.0) == pytest.approx(1.0, rel=1e-3)
+    replugged = replug(monkeypatch, supply)
+    assert supply.set_and_confirm(current_ma=0.5) == pytest.approx(0.5, rel=1e-3)
+    assert supply.instrumentation.snapshot()["counters"]["reconnects"] == 1
+    assert replugged.scale == 3
+
+def test_plain_commands_reconnect(monkeypatch):
+    supply = connect_supply(pcs.CurrentSupplyType.FIXED_REFERENCE)
+    assert supply.set_and_confirm(stage=5) is not None
+    replugged = replug(monkeypatch, supply)
+    supply.command_stage(3)
+    assert replugged.scale == 3
+    assert supply.get_current_setting_ma() == pytest.approx(replugged.current_level_ma())
+
+    # A read that finds the port gone reopens it too
+    replugged = replug(monkeypatch, supply)
+    assert supply.get_current_setting_ma() is None
+    # With the last confirmed command put back
+    assert replugged.scale == 5
+    assert supply.instrumentation.snapshot()["counters"]["reconnects"] == 2
+
+def test_no_reconnect_without_serial_number():
+    supply = connect_supply(pcs.CurrentSupplyType.FIXED_REFERENCE)
+    supply.serial_number = None
+    supply.ser = UnpluggedPort()
+    with pytest.raises(OSError):
+        supply.command_stage(3)
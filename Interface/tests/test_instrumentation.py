@@ -0,0 +1,66 @@
+import re
+import threading
+import time
+import pytest
+import instrumentation as ins
+
+def collect_messages(monkeypatch):
+    messages = []
+    monkeypatch.setattr(ins, "_print_message", messages.append)
+    return messages
+
+def test_latency_histogram():
+    histogram = ins.LatencyHistogram()
+    assert histogram.percentile(50) is None
+    assert histogram.summary() == {"count" : 0}
+    for seconds in [1.0e-3] * 98 + [0.1, 1000.0]:
+        histogram.record(seconds)
+    summary = histogram.summary()
+    assert summary["count"] == 100
+    assert (summary["min_s"], summary["max_s"]) == (1.0e-3, 1000.0)
+    # Upper edge of the bin, within a tenth of a decade
+    assert 1.0e-3 <= summary["p50_s"] <= 1.0e-3 * 10.0 ** 0.1 * 1.0001
+    assert summary["p99_s"] == pytest.approx(0.1, rel=10.0 ** 0.1)
+    # Past max_s, capped at the largest value seen
+    assert histogram.percentile(100) == 1000.0
+
+def test_counters_and_snapshot(tmp_path):
+    instrumentation = ins.Instrumentation("test")
+    instrumentation.count("frames")
+    instrumentation.count("frames", 4)
+    instrumentation.record_time("read_s", 0.01)
+    snapshot = instrumentation.snapshot()
+    assert snapshot["counters"] == {"frames" : 5}
+    assert snapshot["latency"]["read_s"]["count"] == 1
+    instrumentation.write_snapshot(str(tmp_path / "snapshot.json"))
+    instrumentation.reset()
+    assert instrumentation.snapshot()["counters"] == {}
+
+def test_reports_are_rate_limited_across_threads(monkeypatch):
+    messages = collect_messages(monkeypatch)
+    reporter = ins.ErrorReporter("test", interval=0.05)
+    def report_many():
+        for i in range(2000):
+            reporter.report("checksum", "bad")
+    threads = [threading.Thread(target=report_many) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(0.06)
+    reporter.report("checksum", "bad")
+    reporter.report("other", "bad")
+
+    # Every report is either printed or counted in the next one printed
+    total = 0
+    for message in messages[:-1]:
+        match = re.fullmatch(r"test: bad(?: \((\d+) more since last report\))?", message)
+        assert match is not None
+        total += 1 + int(match.group(1) or 0)
+    assert total == 8 * 2000 + 1
+    assert messages[-1] == "test: bad"
+
+def test_one_print_thread_for_every_reporter():
+    ins.Instrumentation("first", report_interval=0.0).report("kind", "message")
+    ins.Instrumentation("second", report_interval=0.0).report("kind", "message")
+    assert len([thread for thread in threading.enumerate() if thread.name == "instrumentation-stderr"]) == 1
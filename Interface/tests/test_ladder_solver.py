@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import ladder_solver as ls
+
+RESISTORS = np.array([1000.0, 330.0, 100.0, 33.0, 10.0, 3.3, 1.0, 0.33])
+R_FET = 0.05
+
+def test_effective_resistance_is_the_parallel_ladder():
+    r_eff = ls.effective_resistance(RESISTORS, R_FET)
+    for i in range(ls.NUM_STAGES):
+        conductance = 1.0 / RESISTORS[0] + sum(1.0 / (r + R_FET) for r in RESISTORS[1:i + 1])
+        assert r_eff[i] == pytest.approx(1.0 / conductance, rel=1e-12)
+    assert np.all(np.diff(r_eff) < 0)
+
+def test_solve_inverts_in_batches():
+    rng = np.random.default_rng(1)
+    batch = RESISTORS * (1.0 + 0.01 * rng.standard_normal((5, 3, ls.NUM_STAGES)))
+    r_fet = R_FET * (1.0 + 0.1 * rng.standard_normal((5, 3)))
+    r_eff = ls.effective_resistance(batch, r_fet)
+    assert r_eff.shape == batch.shape
+    assert np.allclose(ls.solve_resistors(r_eff, r_fet), batch, rtol=1e-9)
+
+def test_calibrate_recovers_the_true_ladder():
+    true_resistors = RESISTORS * (1.0 + 0.002 * np.arange(ls.NUM_STAGES))
+    # What the MetaShunt reads over the truth with the nominal ladder assumed
+    ratios = ls.effective_resistance(true_resistors, R_FET) / ls.effective_resistance(RESISTORS, R_FET)
+    assert np.allclose(ls.calibrate(RESISTORS, R_FET, ratios), true_resistors, rtol=1e-9)
+    assert np.allclose(ls.calibrate(RESISTORS, R_FET, np.ones(ls.NUM_STAGES)), RESISTORS, rtol=1e-12)
+
+def test_fit_ratios():
+    stage_index = np.array([0, 0, 2, 2, 2])
+    truth_ma = np.array([1.0, 2.0, 0.5, 1.0, 1.5])
+    ratios = ls.fit_ratios(stage_index, 1.01 * truth_ma, truth_ma)
+    assert ratios[[0, 2]] == pytest.approx([1.01, 1.01])
+    # Stages with no measurements come back NaN
+    assert np.count_nonzero(np.isnan(ratios)) == ls.NUM_STAGES - 2
+    weighted = ls.fit_ratios([1, 1], [1.0, 4.0], [1.0, 2.0], weights=[1.0, 0.0])
+    assert weighted[1] == pytest.approx(1.0)
+
+def test_config_arrays_and_monte_carlo():
+    config_data = ls.arrays_to_config(RESISTORS, R_FET)
+    (resistors, r_fet) = ls.config_to_arrays(config_data)
+    assert np.array_equal(resistors, RESISTORS) and r_fet == R_FET
+    assert ls.ladder_index(7) == 0 and ls.ladder_index(0) == ls.NUM_STAGES - 1
+
+    samples = ls.monte_carlo(RESISTORS, R_FET, np.ones(ls.NUM_STAGES), 1e-4, 2000, seed=2)
+    assert samples.shape == (2000, ls.NUM_STAGES)
+    assert np.allclose(np.median(samples, axis=0), RESISTORS, rtol=1e-2)
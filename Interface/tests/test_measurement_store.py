@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import metashunt_v2 as ms2
+from measurement_store import MeasurementStore
+
+def make_samples(first, n):
+    samples = np.empty(n, dtype=ms2.SAMPLE_DTYPE)
+    samples["time"] = np.arange(first, first + n)
+    samples["current_ma"] = 0.5 * samples["time"]
+    return samples
+
+@pytest.mark.parametrize("max_samples", [None, 1, 1000])
+def test_store_keeps_the_newest(max_samples):
+    rng = np.random.default_rng(1)
+    store = MeasurementStore(max_samples=max_samples, initial_capacity=16)
+    total = 0
+    for n in list(rng.integers(0, 300, size=200)) + [2500, 7]:
+        mark = store.position()
+        store.append(make_samples(total, n))
+        total += n
+        expected = np.arange(0 if max_samples is None else max(0, total - max_samples), total)
+        assert np.array_equal(store.get_time(), expected)
+        assert np.array_equal(store.get_current_ma(), (0.5 * expected).astype(np.float32))
+        assert store.position() == total
+        assert store.num_discarded + len(store) == total
+        (time, current_ma) = store.get_since(mark)
+        assert np.array_equal(time, expected[-min(n, len(expected)):] if n > 0 else [])
+        assert len(current_ma) == len(time)
+
+def test_get_since_and_clear():
+    store = MeasurementStore(max_samples=10)
+    store.append(make_samples(0, 8))
+    assert np.array_equal(store.get_since(5)[0], [5, 6, 7])
+    assert len(store.get_since(8)[0]) == 0
+    store.append(make_samples(8, 8))
+    # Some of what came after position 2 is gone, so everything held
+    assert np.array_equal(store.get_since(2)[0], np.arange(6, 16))
+    store.clear()
+    assert (len(store), store.position()) == (0, 0)
+    assert len(store.get_since(0)[0]) == 0
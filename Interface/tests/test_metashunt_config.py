@@ -0,0 +1,154 @@
+import pytest
+import numpy as np
+import device_simulator as ds
+import metashunt_v2 as ms2
+import serial_protocol as sp
+
+# Sample frames at these currents are full of byte runs that decode as
+# checksum-valid config responses
+STREAM_CURRENTS_MA = [1.0, 0.518]
+
+def config_lookalikes(data):
+    decoder = sp.FrameDecoder(payload_lengths={ms2.CONFIG_RESPONSE : ms2.CONFIG_RESPONSE_LEN})
+    return decoder.feed(data)
+
+def replay_all(metashunt):
+    num_samples = 0
+    while not metashunt.ser.at_end():
+        num_samples += len(metashunt.read_samples())
+    return num_samples
+
+@pytest.mark.parametrize("current_ma", STREAM_CURRENTS_MA)
+def test_sample_stream_is_not_taken_for_config(current_ma):
+    # 100 s of samples at 10 kHz
+    stream = ds.make_sample_stream(1000000, current_ma=current_ma, seed=1)
+    assert len(config_lookalikes(stream)) > 0
+
+    metashunt = ms2.MetaShuntV2(max_samples=1000)
+    metashunt.connect(ser=ds.ReplaySerial(stream))
+    # Even with every index waiting on a reply
+    metashunt.config.request(list(ms2.config_key_dict))
+    assert replay_all(metashunt) == 1000000
+    assert metashunt.config.readback == {}
+    assert metashunt.config.cache == {}
+    assert "config_responses" not in metashunt.instrumentation.snapshot()["counters"]
+
+@pytest.mark.parametrize("current_ma", STREAM_CURRENTS_MA)
+def test_unrequested_config_response_is_ignored(current_ma):
+    stream = bytearray(ds.make_sample_stream(1000, current_ma=current_ma, seed=2))
+    reply = ms2.encode_config_response(ms2.config_index_dict["R9"], 12.5)
+    stream[5000:5000] = reply
+
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.ReplaySerial(stream))
+    metashunt.config.cache = {"R9" : 1.0, "R13" : 100.0}
+    replay_all(metashunt)
+    # Not trusted, but the device may have changed R9 since it was read
+    assert metashunt.config.cache == {"R13" : 100.0}
+    assert metashunt.get_config_param("R13") == 100.0
+    assert metashunt.instrumentation.snapshot()["counters"]["unsolicited_config_responses"] == 1
+
+    # The same reply answers a request for it
+    metashunt.connect(ser=ds.ReplaySerial(stream))
+    metashunt.config.request([ms2.config_index_dict["R9"]])
+    replay_all(metashunt)
+    assert metashunt.config.finish([ms2.config_index_dict["R9"]]) == {ms2.config_index_dict["R9"] : 12.5}
+    assert metashunt.config.cache == {"R9" : 12.5}
+
+@pytest.mark.parametrize("current_ma", STREAM_CURRENTS_MA)
+@pytest.mark.parametrize("corrupt_prob", [0.0, 1e-4])
+def test_config_exchange_while_streaming(current_ma, corrupt_prob):
+    device = ds.SimulatedMetaShunt(current_source=lambda t: current_ma, corrupt_prob=corrupt_prob, seed=3)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=device)
+    metashunt.start_stream()
+    try:
+        config_data = metashunt.read_all_config()
+        assert config_data == {key : device.config[index] for (key, index) in ms2.config_index_dict.items()}
+
+        config_data["R9"] = 1.25
+        config_data["R13"] = 101.5
+        assert metashunt.write_config(config_data)
+        assert device.config[ms2.config_index_dict["R9"]] == 1.25
+        assert device.config[ms2.config_index_dict["R13"]] == 101.5
+
+        metashunt.wait_samples(0.5)
+        for (key, value) in metashunt.config.cache.items():
+            assert value == device.config[ms2.config_index_dict[key]]
+        assert device.num_overwritten == 0
+    finally:
+        metashunt.disconnect()
+
+def test_every_write_is_persisted_before_the_next():
+    # Writes far slower than the gap between frames; nothing may be sent
+    # while the firmware's single command slot is still full
+    device = ds.SimulatedMetaShunt(current_source=lambda t: 1.0, write_time=0.05, seed=7)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=device)
+    try:
+        config_data = {key : 2.0 * float(device.config[index]) for (key, index) in ms2.config_index_dict.items()}
+        assert metashunt.write_config(config_data)
+        assert metashunt.instrumentation.snapshot()["counters"].get("config_timeouts", 0) == 0
+    finally:
+        metashunt.disconnect()
+    assert device.num_overwritten == 0
+    assert device.config == {index : np.float32(config_data[key]) for (key, index) in ms2.config_index_dict.items()}
+
+def test_reconnect_restores_only_confirmed_writes(monkeypatch):
+    device = ds.SimulatedMetaShunt(current_source=lambda t: 1.0, seed=4)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=device)
+    metashunt.serial_number = "sim"
+    metashunt.read_all_config()
+    assert metashunt.write_config({"R9" : 1.25})
+    # As a stray frame taken for a reply once could
+    metashunt.config.cache["R13"] = -1.03e38
+
+    # Comes back with its power-on config
+    replugged = ds.SimulatedMetaShunt(current_source=lambda t: 1.0, seed=5)
+    power_on_config = dict(replugged.config)
+    monkeypatch.setattr(ms2.dd.default_index, "wait_for_device", lambda vid, pid, serial_number, timeout: (replugged, serial_number))
+    assert metashunt.reconnect()
+    expected = dict(power_on_config)
+    expected[ms2.config_index_dict["R9"]] = 1.25
+    assert replugged.config == expected
+    metashunt.disconnect()
+
+def test_config_response_passing_sample_checksum():
+    # A reply followed by the next frame's sync byte makes a 10 byte window
+    # whose last byte is the next frame's first time byte. Pick that byte so
+    # the window passes as a sample frame.
+    index = ms2.config_index_dict["R1"]
+    reply = ms2.encode_config_response(index, 0.05)
+    window_chk = (sum(reply[1:]) + ms2.FRAME_SYNC) & 0xFF
+    samples = np.zeros(200, dtype=ms2.SAMPLE_DTYPE)
+    samples["time"] = np.arange(200) * 256 + window_chk
+    samples["current_ma"] = 1.0
+    stream = bytearray(ms2.encode_frames(samples))
+    stream[1000:1000] = reply
+
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.ReplaySerial(stream))
+    metashunt.config.request([index])
+    # Only the frame the reply ran into is lost
+    assert replay_all(metashunt) == 199
+    assert metashunt.config.finish([index]) == {index : np.float32(0.05)}
+
+def test_async_config_exchange_while_streaming():
+    import asyncio
+    import async_interface as ai
+
+    async def exchange():
+        device = ds.SimulatedMetaShunt(current_source=lambda t: 0.518, seed=6)
+        metashunt = ai.AsyncMetaShuntV2()
+        await metashunt.connect(ser=device)
+        try:
+            config_data = await metashunt.read_all_config()
+            assert config_data == {key : device.config[index] for (key, index) in ms2.config_index_dict.items()}
+            assert await metashunt.write_config({"R9" : 1.25})
+            assert device.config[ms2.config_index_dict["R9"]] == 1.25
+            assert metashunt.config.written == {"R9" : 1.25}
+        finally:
+            await metashunt.disconnect()
+
+    asyncio.run(exchange())
@@ -0,0 +1,37 @@
+import time
+import pytest
+import device_simulator as ds
+import HDRPrecisionCurrentSupply as pcs
+import metashunt_v2 as ms2
+
+@pytest.mark.parametrize("settle_time", [0.05, 0.2])
+def test_slow_settling_is_not_reported_settled(settle_time):
+    supply_ser = ds.SimulatedHDRSupply(settle_time=settle_time)
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
+    supply.connect(ser=supply_ser)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.SimulatedMetaShunt(current_source=supply_ser.output_ma, seed=1))
+    metashunt.start_stream()
+    try:
+        supply.set_and_confirm(current_ma=1.0)
+        time.sleep(10 * settle_time)
+        supply.set_and_confirm(current_ma=10.0)
+        position = metashunt.stream_position()
+        (num_meas, mean_ma, std_dev_ma, settled) = metashunt.measure_until(rel_precision=1e-4, max_time=1.5, position=position)
+    finally:
+        metashunt.disconnect()
+        supply.disconnect()
+
+    error = (mean_ma - supply_ser.output_to_ma) / supply_ser.output_to_ma
+    if settle_time < 0.1:
+        assert settled
+        assert abs(error) < 5e-5
+    else:
+        # With a 0.2 s time constant the output is still about 0.1% short
+        # when two 10 ms windows first agree, and the halves of the average
+        # never do within max_time. The stats are still those of the last
+        # stretch of the approach.
+        assert not settled
+        assert num_meas >= 200
+        assert -2e-3 < error < 0.0
+        assert std_dev_ma < 5.0 * 1e-4 * supply_ser.output_to_ma
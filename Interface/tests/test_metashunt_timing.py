@@ -0,0 +1,37 @@
+import numpy as np
+import device_simulator as ds
+import metashunt_v2 as ms2
+
+def test_device_time_carries_on_across_reconnect(monkeypatch):
+    # Comes back counting from 0 after a run that had gone past a wrap
+    device = ds.SimulatedMetaShunt(current_source=lambda t: 1.0, tick_offset=2 ** 32 - 200000, seed=1)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=device)
+    metashunt.serial_number = "sim"
+    metashunt.measure(0.5)
+    replugged = ds.SimulatedMetaShunt(current_source=lambda t: 2.0, seed=2)
+    monkeypatch.setattr(ms2.dd.default_index, "wait_for_device", lambda vid, pid, serial_number, timeout: (replugged, serial_number))
+    assert metashunt.reconnect()
+    metashunt.measure(0.5)
+    metashunt.disconnect()
+
+    buckets = metashunt.get_decimated(max_points=100000)
+    assert np.all(np.diff(buckets["t_first"]) > 0)
+    assert np.all(buckets["t_last"] >= buckets["t_first"])
+    # Each stretch is found by its own time range
+    assert abs(metashunt.summarize(None, buckets["t_first"][0] + 300000)[1] - 1.0) < 0.01
+    assert abs(metashunt.summarize(buckets["t_last"][-1] - 300000, None)[1] - 2.0) < 0.01
+
+def test_window_across_tick_wrap():
+    device = ds.SimulatedMetaShunt(current_source=lambda t: 1.0, tick_offset=2 ** 32 - 200000, seed=3)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=device)
+    metashunt.measure(0.5)
+    metashunt.disconnect()
+
+    (t, current_ma) = metashunt.get_window(2 ** 32 - 20000, 2 ** 32 + 20000)
+    # 100 us apart at 10 kHz, straight through the wrap
+    assert len(t) == 401
+    assert np.all(np.diff(t) == 100)
+    assert t[0] == 2 ** 32 - 20000
+    assert np.all(np.abs(current_ma - 1.0) < 0.01)
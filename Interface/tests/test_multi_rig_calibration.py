@@ -0,0 +1,50 @@
+import json
+import pytest
+import device_simulator as ds
+import HDRPrecisionCurrentSupply as pcs
+import ladder_solver as ls
+import metashunt_v2 as ms2
+import multi_rig_calibration as mrc
+
+NOMINAL = [100000.0, 10000.0, 1000.0, 100.0, 10.0, 1.0, 0.1, 0.05]
+
+def connect_simulated(supply_serial, metashunt_serial):
+    # Each rig's MetaShunt is 0.1% off its stored config; "gone" stands in
+    # for a device that doesn't open
+    if supply_serial == "gone":
+        return None
+    supply_ser = ds.SimulatedHDRSupply(constant_ref_mode=True)
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.FIXED_REFERENCE)
+    supply.connect(ser=supply_ser)
+    true_config = ls.arrays_to_config([r * 1.001 for r in NOMINAL], 0.05)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.SimulatedMetaShunt(current_source=supply_ser.output_ma, true_config=true_config, seed=1))
+    return (supply, metashunt)
+
+def test_pair_rigs(monkeypatch):
+    monkeypatch.setattr(pcs, "list_serial_numbers", lambda: ["S1", "S2"])
+    monkeypatch.setattr(ms2, "list_serial_numbers", lambda: ["M1"])
+    assert mrc.pair_rigs() is None
+    rig_map = {"a" : {"supply" : "S1", "metashunt" : "M1"}, "b" : {"supply" : "S2", "metashunt" : "M2"}}
+    assert mrc.pair_rigs(rig_map) == [("a", "S1", "M1")]
+    monkeypatch.setattr(pcs, "list_serial_numbers", lambda: ["S2"])
+    assert mrc.pair_rigs() == [("rig", "S2", "M1")]
+
+def test_rigs_calibrate_side_by_side(monkeypatch, tmp_path, capsys):
+    monkeypatch.chdir(tmp_path)
+    report = mrc.run_rigs([("a", "S1", "M1"), ("b", "S2", "M2"), ("c", "gone", "M3")], connect=connect_simulated)
+    rigs = report["rigs"]
+    assert (rigs["c"]["status"], rigs["c"]["error"]) == ("failed", "could not connect")
+    for name in ["a", "b"]:
+        result = rigs[name]
+        assert result["status"] == "ok"
+        assert max(abs(error) for error in result["pre_cal_errors"]) > 5e-4
+        assert max(abs(error) for error in result["post_cal_errors"]) < 1e-4
+        with open("post_cal_cfg_{0}.json".format(name)) as f:
+            assert json.load(f)["R19"] == pytest.approx(1.001 * NOMINAL[0], rel=1e-4)
+    # Rigs ran at the same time rather than one after the other
+    assert report["elapsed_s"] < 0.75 * (rigs["a"]["elapsed_s"] + rigs["b"]["elapsed_s"])
+    json.dumps(report)
+
+    mrc.print_report(report)
+    assert "2 of 3 rigs calibrated" in capsys.readouterr().out
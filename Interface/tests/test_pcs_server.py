@@ -0,0 +1,57 @@
+import os
+import threading
+import time
+import pytest
+import serial
+import device_simulator as ds
+import hdr_pcs_interface as hpi
+
+class LostPort(ds.SimulatedHDRSupply):
+    def write(self, data):
+        raise serial.SerialException("device disconnected")
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    # A server on a simulated supply, stopped again after the test
+    monkeypatch.setattr(hpi, "socket_path", str(tmp_path / "pcs.sock"))
+    session = hpi.DeviceSession()
+    assert session.supply.connect(ser=ds.SimulatedHDRSupply())
+    thread = threading.Thread(target=hpi.serve, args=(session,), daemon=True)
+    thread.start()
+    end_time = time.time() + 5.0
+    while not os.path.exists(hpi.socket_path) and time.time() < end_time:
+        time.sleep(0.01)
+    yield session
+    with hpi.PcsClient() as client:
+        assert client.request("stop") == "ok"
+    thread.join(timeout=5.0)
+    assert not thread.is_alive()
+    assert not os.path.exists(hpi.socket_path)
+    session.disconnect()
+
+def test_no_server(monkeypatch, tmp_path):
+    monkeypatch.setattr(hpi, "socket_path", str(tmp_path / "pcs.sock"))
+    assert hpi.send_commands([("s", 3)]) is None
+
+def test_commands(server):
+    (at_stage, at_current) = hpi.send_commands([("s", 3), ("c", 0.5)])
+    assert at_stage is not None
+    assert at_current == pytest.approx(0.5, rel=1e-3)
+    # One connection for any number of requests, each answered in turn
+    with hpi.PcsClient() as client:
+        assert client.request("x 1") == "error bad command"
+        assert client.request("s 3 s 4") == "error bad command"
+        assert client.command("s", 4) == pytest.approx(server.supply.ser.current_level_ma(), rel=1e-6)
+    assert server.supply.ser.scale == 4
+
+def test_reconnect_after_serial_error(server, monkeypatch):
+    server.supply.ser = LostPort()
+    reconnects = []
+    def reconnect():
+        reconnects.append(None)
+        return server.supply.connect(ser=ds.SimulatedHDRSupply())
+    monkeypatch.setattr(server, "reconnect", reconnect)
+    with hpi.PcsClient() as client:
+        assert client.request("s 3").startswith("error device disconnected")
+        assert len(reconnects) == 1
+        assert client.command("s", 3) is not None
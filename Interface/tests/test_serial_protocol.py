@@ -0,0 +1,51 @@
+import struct
+import pytest
+import serial_protocol as sp
+import device_simulator as ds
+import metashunt_v2 as ms2
+
+def test_encoder_round_trip_in_any_chunks():
+    encoder = sp.FrameEncoder()
+    frames = [encoder.pack(sp.SET_CURRENT, "<f", 1.5), encoder.encode(sp.SET_SCALE, bytes([3])),
+              encoder.encode(sp.GET_CONFIG, b""), encoder.pack(sp.SET_CONFIG, "<Bf", 7, -2.0)]
+    assert frames[0] == bytes([sp.FRAME_SYNC, sp.SET_CURRENT, 4]) + struct.pack("<f", 1.5) + bytes([sp.checksum(frames[0][1:-1])])
+    # Noise ahead of and between frames is skipped
+    stream = b"\x00\x01" + frames[0] + frames[1] + b"\x55\x09" + frames[2] + frames[3]
+    expected = [(sp.SET_CURRENT, struct.pack("<f", 1.5)), (sp.SET_SCALE, bytes([3])), (sp.GET_CONFIG, b""),
+                (sp.SET_CONFIG, struct.pack("<Bf", 7, -2.0))]
+    for chunk_size in [1, 2, 5, len(stream)]:
+        decoder = sp.FrameDecoder()
+        decoded = []
+        for i in range(0, len(stream), chunk_size):
+            decoded += decoder.feed(stream[i:i + chunk_size])
+        assert decoded == expected
+        assert decoder.num_frames == len(expected)
+        assert decoder.num_skipped > 0
+
+def test_bad_checksum_is_dropped():
+    frame = bytearray(sp.FrameEncoder().pack(sp.CURRENT_SET, "<f", 0.25))
+    frame[-1] ^= 0xFF
+    decoder = sp.FrameDecoder()
+    assert decoder.feed(bytes(frame) + sp.FrameEncoder().pack(sp.CURRENT_SET, "<f", 0.5)) == [(sp.CURRENT_SET, struct.pack("<f", 0.5))]
+    assert decoder.num_bad_checksum == 1
+
+def test_fixed_length_replies_among_samples():
+    # Config replies carry no length byte, and the decoder looks only for
+    # them among the sample frames
+    decoder = sp.FrameDecoder(payload_lengths={ms2.CONFIG_RESPONSE : ms2.CONFIG_RESPONSE_LEN})
+    stream = ds.make_sample_stream(3, seed=1) + ms2.encode_config_response(4, 0.125)
+    assert decoder.feed(stream[:-1]) == []
+    assert decoder.feed(stream[-1:]) == [(ms2.CONFIG_RESPONSE, struct.pack("<Bf", 4, 0.125))]
+
+def test_payload_too_long():
+    with pytest.raises(ValueError):
+        sp.FrameEncoder().encode(sp.SET_CONFIG, bytes(sp.MAX_PAYLOAD_LEN + 1))
+
+def test_read_frame_keeps_the_rest_for_later():
+    encoder = sp.FrameEncoder()
+    stream = encoder.pack(sp.CONFIG_RESPONSE, "<Bf", 1, 1.0) + encoder.pack(sp.CURRENT_SET, "<f", 2.0) + encoder.pack(sp.CONFIG_RESPONSE, "<Bf", 2, 3.0)
+    ser = ds.ReplaySerial(stream, chunk_size=len(stream))
+    decoder = sp.FrameDecoder()
+    assert sp.read_frame(ser, decoder, timeout=0.1, msg_type=sp.CURRENT_SET) == (sp.CURRENT_SET, struct.pack("<f", 2.0))
+    assert sp.read_frame(ser, decoder, timeout=0.1) == (sp.CONFIG_RESPONSE, struct.pack("<Bf", 2, 3.0))
+    assert sp.read_frame(ser, decoder, timeout=0.05) == (None, None)
@@ -0,0 +1,78 @@
+import warnings
+import pytest
+import numpy as np
+import streaming_stats as ss
+
+def filled(ref):
+    histogram = ss.LogHistogram(ref=ref)
+    histogram.update([ref])
+    return histogram
+
+def test_histogram_quantiles_match_numpy():
+    rng = np.random.default_rng(1)
+    values = 1.0 + 1.0e-3 * rng.standard_normal(100000)
+    histogram = ss.LogHistogram()
+    for chunk in np.array_split(values, 37):
+        histogram.update(chunk)
+    (count, median, mad, low, high) = histogram.summary()
+    assert count == len(values)
+    # Good to a fraction of a bin (5% at 50 per decade) of the distance
+    # from ref
+    for (got, q) in [(median, 50.0), (low, 2.5), (high, 97.5)]:
+        expected = np.percentile(values, q)
+        assert abs(got - expected) <= 0.05 * abs(expected - histogram.ref) + 1e-6
+    expected_mad = np.median(np.abs(values - np.median(values)))
+    assert abs(mad - expected_mad) <= 0.05 * expected_mad
+
+def test_histogram_merge_is_one_update():
+    rng = np.random.default_rng(2)
+    values = 0.5 + 1.0e-2 * rng.standard_cauchy(10000)
+    whole = ss.LogHistogram(ref=0.5)
+    whole.update(values)
+    (first, second) = (ss.LogHistogram(ref=0.5), ss.LogHistogram(ref=0.5))
+    first.update(values[:3000])
+    second.update(values[3000:])
+    first.merge(second)
+    assert np.array_equal(first.counts, whole.counts)
+    assert (first.min, first.max) == (whole.min, whole.max)
+    with pytest.raises(ValueError):
+        first.merge(filled(1.0))
+
+def test_histogram_bins_zero_and_non_finite_deviations():
+    histogram = ss.LogHistogram(ref=1.0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        histogram.update([1.0, 1.0, np.nan, np.inf, -np.inf, 1.5])
+    # Exactly ref and NaN in the zero bin, infinities in the overflow bins
+    assert histogram.counts[histogram.num_bins] == 3
+    assert histogram.counts[0] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.count == 6
+    assert np.count_nonzero(histogram.counts) == 4
+    assert (histogram.min, histogram.max) == (-np.inf, np.inf)
+
+def test_running_stats_match_numpy():
+    rng = np.random.default_rng(3)
+    values = 1.0e3 + rng.standard_normal(100001)
+    stats = ss.RunningStats()
+    for chunk in np.array_split(values, 101):
+        stats.update(chunk)
+    (count, mean, std_dev) = stats.summary()
+    assert count == len(values)
+    assert mean == pytest.approx(values.mean(), rel=1e-12)
+    assert std_dev == pytest.approx(values.std(), rel=1e-9)
+    assert stats.std_error() == pytest.approx(values.std(ddof=1) / np.sqrt(len(values)), rel=1e-9)
+    assert (stats.min, stats.max) == (values.min(), values.max())
+
+def test_running_stats_merge_and_empty():
+    stats = ss.RunningStats()
+    assert stats.summary() == (0, None, None)
+    assert stats.std_error() is None
+    stats.update([])
+    (first, second) = (ss.RunningStats(), ss.RunningStats())
+    first.update([1.0, 2.0])
+    second.update([3.0, 4.0, 5.0])
+    merged = first.copy()
+    merged.merge(second)
+    assert merged.summary() == pytest.approx((5, 3.0, np.sqrt(2.0)))
+    assert first.summary() == pytest.approx((2, 1.5, 0.5))
@@ -0,0 +1,52 @@
+import numpy as np
+import device_simulator as ds
+import supply_model as sm
+
+def firmware_setpoint(request_ma):
+    # (stage, dac_mv, reported_ma) from the simulator's transcription of
+    # set_current_level() and _get_current_level(), or None if ignored
+    supply = ds.SimulatedHDRSupply()
+    supply.scale = -1
+    supply.set_current_level(request_ma)
+    if supply.scale < 0:
+        return None
+    return (supply.scale, supply.ref_mv, supply.current_level_ma())
+
+def boundary_requests():
+    # Each stage limit as requested and the float32 values either side
+    requests = []
+    for limit_ma in sm.STAGE_LIMITS_MA:
+        x = np.float32(limit_ma)
+        requests += [np.nextafter(x, np.float32(0.0)), x, np.nextafter(x, np.float32(np.inf))]
+    return np.array(requests, dtype=np.float32)
+
+def test_request_at_limit_is_compared_in_double():
+    (stage, dac_mv, reported_ma, output_ma) = sm.predict(0.02)
+    assert stage == 5
+    assert firmware_setpoint(0.02) == (5, int(dac_mv), float(reported_ma))
+    assert abs(reported_ma - 0.019998) < 1e-6
+
+def test_model_matches_firmware():
+    rng = np.random.default_rng(1)
+    requests = np.concatenate((
+        boundary_requests(),
+        np.float32(10.0) ** rng.uniform(-7.0, np.log10(400.0), 5000).astype(np.float32),
+        sm.SETPOINT_TABLE["request_ma"],
+    ))
+    (stage, dac_mv, reported_ma, output_ma) = sm.predict(requests)
+    for i in range(len(requests)):
+        expected = firmware_setpoint(requests[i])
+        if expected is None:
+            assert stage[i] == -1
+        else:
+            assert (int(stage[i]), int(dac_mv[i]), float(reported_ma[i])) == expected
+
+def test_setpoint_table_reaches_stage_limits():
+    # The table's requests land where they say, right up to each limit
+    table = sm.SETPOINT_TABLE
+    (stage, dac_mv, reported_ma, output_ma) = sm.predict(table["request_ma"])
+    assert np.array_equal(stage, table["stage"])
+    assert np.array_equal(dac_mv, table["dac_mv"])
+    for (i, limit_ma) in enumerate(sm.STAGE_LIMITS_MA):
+        in_stage = table["request_ma"][table["stage"] == sm.NUM_STAGES - 1 - i]
+        assert np.all(in_stage.astype(np.float64) < limit_ma)
@@ -0,0 +1,38 @@
+import numpy as np
+import device_simulator as ds
+import HDRPrecisionCurrentSupply as pcs
+import metashunt_v2 as ms2
+import supply_model as sm
+import sweep_engine as se
+
+def test_refined_points_confirm_at_stage_limits():
+    supply_ser = ds.SimulatedHDRSupply(seed=1)
+    supply = pcs.HDRPrecisionCurrentSupply(supply_type=pcs.CurrentSupplyType.ADJUSTABLE_REFERENCE)
+    supply.connect(ser=supply_ser)
+    metashunt = ms2.MetaShuntV2()
+    metashunt.connect(ser=ds.SimulatedMetaShunt(current_source=supply_ser.output_ma, seed=2))
+    engine = se.SweepEngine(supply, metashunt, rel_precision=1e-3, max_time=0.5, max_retries=1, min_settle_time=0.0)
+
+    # What run_adaptive() adds either side of each limit
+    limits_ma = sm.STAGE_LIMITS_MA[:-1]
+    coarse = np.zeros(2, dtype=se.SWEEP_DTYPE)
+    coarse["command_ma"] = [limits_ma[0] * 0.5, 250.0]
+    points_ma = engine._refine_points(coarse, error_tol_pct=0.05, min_step=1.05)
+    assert len(points_ma) == 2 * len(limits_ma)
+    (below_ma, from_ma) = (points_ma[0::2], points_ma[1::2])
+    # Adjacent float32 requests that the firmware puts in adjacent stages
+    assert np.all(np.nextafter(from_ma.astype(np.float32), np.float32(0.0)) == below_ma.astype(np.float32))
+    assert np.all(sm.stage_for_current(below_ma) == sm.stage_for_current(from_ma) + 1)
+    assert np.all(from_ma >= limits_ma)
+    assert np.all(below_ma < limits_ma)
+    # Nothing more once both sides are there
+    refined = np.zeros(len(points_ma), dtype=se.SWEEP_DTYPE)
+    refined["command_ma"] = points_ma
+    assert len(engine._refine_points(refined, error_tol_pct=0.05, min_step=1.05)) == 0
+
+    results = engine.run(points_ma)
+    supply.disconnect()
+    metashunt.disconnect()
+    assert np.all(results["ok"])
+    assert np.all(results["attempts"] == 1)
+    assert np.array_equal(results["actual_ma"], sm.predict(points_ma)[2].astype(np.float64))
@@ -0,0 +1,15 @@
+import numpy as np
+import timing
+
+def test_clock_fit_starts_on_host_span():
+    # A device clock 20% slow of nominal, read every 5 ms with up to 2 ms of
+    # transport delay
+    rng = np.random.default_rng(1)
+    tick_hz = 800000.0
+    clock = timing.ClockSync(min_span_s=0.5)
+    host_time = np.arange(0.0, 0.6, 0.005)
+    for t in host_time:
+        clock.add(int(t * tick_hz), 1000.0 + t + rng.uniform(0.0, 0.002))
+    assert abs(clock.drift_ppm() + 200000.0) < 1000.0
+    ticks = np.arange(0.0, 0.6, 0.1) * tick_hz
+    assert np.all(np.abs(clock.to_host(ticks) - (1000.0 + ticks / tick_hz)) < 0.002)
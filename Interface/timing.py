@@ -0,0 +1,223 @@
+import collections
+import time
+import numpy as np
+import HDRPrecisionCurrentSupply as pcs
+import supply_model as sm
+
+# Device time for the MetaShunt V2 and step response measurement against
+# supply commands. Sample frames carry a uint32 tick count; TickUnwrapper
+# turns it into a continuous count and ClockSync maps that onto host
+# time.time(), so samples can be lined up with the host time stamps the
+# supply takes when it sends each command.
+
+TICK_WRAP = 1 << 32
+
+class TickUnwrapper:
+    # Continuous int64 tick counts from the wrapping uint32 ones, assuming
+    # less than half a wrap passes between consecutive samples
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last_raw = None
+        self.last = None
+        self.resume_at = None
+
+    def restart(self, resume_at):
+        # The raw count starts again from somewhere unrelated (another port,
+        # or the device reset): the next tick seen unwraps to resume_at and
+        # those after it follow on, so the counts keep increasing
+        self.last_raw = None
+        self.resume_at = resume_at
+
+    def unwrap(self, ticks):
+        ticks = np.asarray(ticks, dtype=np.int64)
+        if len(ticks) == 0:
+            return ticks
+        if self.last_raw is None:
+            self.last_raw = int(ticks[0])
+            self.last = int(ticks[0]) if self.resume_at is None else self.resume_at
+            self.resume_at = None
+        steps = np.diff(ticks, prepend=self.last_raw)
+        steps = (steps + TICK_WRAP // 2) % TICK_WRAP - TICK_WRAP // 2
+        unwrapped = self.last + np.cumsum(steps)
+        self.last_raw = int(ticks[-1])
+        self.last = int(unwrapped[-1])
+        return unwrapped
+
+    def unwrap_recent(self, ticks):
+        # Continuous counts for samples already seen, taken as lying within
+        # half a wrap before the newest one, without changing the state
+        if self.last_raw is None:
+            return np.asarray(ticks, dtype=np.int64)
+        back = (self.last_raw - np.asarray(ticks, dtype=np.int64)) % TICK_WRAP
+        back = np.where(back >= TICK_WRAP // 2, back - TICK_WRAP, back)
+        return self.last - back
+
+class ClockSync:
+    # Online fit of host time against device ticks. Each point pairs the
+    # newest tick in a read with the host time of that read, which is late
+    # by the (varying) transport delay. Reads are grouped into intervals of
+    # interval_s and only the earliest arrival of each (relative to the
+    # nominal rate) is kept, for the last max_points intervals. The slope
+    # (tick period, i.e. clock drift) is a least squares fit through those
+    # and the line is then lowered onto the earliest of them, so offset is
+    # the host time of tick 0 with the least delay seen.
+    #
+    # tick_hz is only the nominal rate the fit starts from. The MetaShunt
+    # firmware isn't in this repo; 1 MHz is what its sample time stamps
+    # count at as far as the host side knows (microseconds, wrapping every
+    # 71.6 minutes), and what device_simulator uses. Once the points span
+    # min_span_s of host time the tick period is always fitted, so a
+    # different real rate shows up in drift_ppm() rather than in the times.
+    def __init__(self, tick_hz=1000000.0, interval_s=0.05, max_points=2000, min_span_s=0.5):
+        self.tick_hz = tick_hz
+        self.interval_s = interval_s
+        self.min_span_s = min_span_s
+        self.points = collections.deque(maxlen=max_points)
+        self.reset()
+
+    def reset(self):
+        self.points.clear()
+        self.best = None
+        self.interval_start = None
+        self.fit = None
+        self.period = 1.0 / self.tick_hz
+
+    def add(self, ticks, host_time):
+        if self.interval_start is None:
+            self.interval_start = host_time
+        elif host_time - self.interval_start >= self.interval_s:
+            self.points.append(self.best)
+            self.best = None
+            self.interval_start = host_time
+        # Earliest arrival at the rate fitted so far
+        if self.best is None or host_time - ticks * self.period < self.best[1] - self.best[0] * self.period:
+            self.best = (ticks, host_time)
+            self.fit = None
+
+    def _solve(self):
+        if self.fit is not None:
+            return self.fit
+        points = np.array(list(self.points) + [self.best], dtype=np.float64)
+        ticks = points[:, 0] - points[0, 0]
+        host = points[:, 1] - points[0, 1]
+        # Use the nominal rate until the points span long enough to see drift
+        if host[-1] - host[0] >= self.min_span_s:
+            self.period = np.polyfit(ticks, host, 1)[0]
+        period = self.period
+        offset = points[0, 1] + np.min(host - period * ticks) - period * points[0, 0]
+        self.fit = (period, offset)
+        return self.fit
+
+    def is_synced(self):
+        return self.best is not None
+
+    def drift_ppm(self):
+        # Device clock rate error relative to tick_hz, in ppm
+        if not self.is_synced():
+            return None
+        (period, offset) = self._solve()
+        return (1.0 / (period * self.tick_hz) - 1.0) * 1.0e6
+
+    def to_host(self, ticks):
+        (period, offset) = self._solve()
+        return offset + period * np.asarray(ticks, dtype=np.float64)
+
+    def to_ticks(self, host_time):
+        (period, offset) = self._solve()
+        return (np.asarray(host_time, dtype=np.float64) - offset) / period
+
+def cut_window(host_time, current_ma, t0, t1):
+    # The samples with host time in [t0, t1)
+    in_window = (host_time >= t0) & (host_time < t1)
+    return (host_time[in_window], current_ma[in_window])
+
+def step_response(host_time, current_ma, command_time, settle_tol_rel=1.0e-3, final_fraction=0.25, noise_sigma=4.0):
+    # Step response to a command sent at command_time, from samples around
+    # it. The level before is the mean of the samples before command_time,
+    # and the final level the mean of the last final_fraction of the window.
+    # Returns a dict of times in seconds after command_time: delay to 10%
+    # of the step, 10-90% rise time, and settling time, after which the
+    # current stays within the larger of settle_tol_rel of the final level
+    # and noise_sigma standard deviations of the final samples. Times are
+    # None where the window doesn't show them.
+    before = host_time < command_time
+    after = ~before
+    result = {"initial_ma" : None, "final_ma" : None, "delay_s" : None, "rise_s" : None, "settling_s" : None}
+    if np.count_nonzero(after) < 4:
+        return result
+    t = host_time[after] - command_time
+    i = current_ma[after].astype(np.float64)
+    num_final = max(2, int(len(i) * final_fraction))
+    final_ma = np.mean(i[-num_final:])
+    result["final_ma"] = float(final_ma)
+    tol = max(settle_tol_rel * abs(final_ma), noise_sigma * np.std(i[-num_final:]))
+    outside = np.flatnonzero(np.abs(i - final_ma) > tol)
+    if len(outside) == 0:
+        result["settling_s"] = 0.0
+    elif outside[-1] + 1 < len(t):
+        result["settling_s"] = float(t[outside[-1] + 1])
+
+    if np.count_nonzero(before) == 0:
+        return result
+    initial_ma = float(np.mean(current_ma[before]))
+    result["initial_ma"] = initial_ma
+    step = final_ma - initial_ma
+    if abs(step) <= tol:
+        return result
+    progress = (i - initial_ma) / step
+    reached_10 = np.flatnonzero(progress >= 0.1)
+    reached_90 = np.flatnonzero(progress >= 0.9)
+    if len(reached_10) > 0:
+        result["delay_s"] = float(t[reached_10[0]])
+        if len(reached_90) > 0:
+            result["rise_s"] = float(t[reached_90[0]] - t[reached_10[0]])
+    return result
+
+def measure_step(supply, metashunt, current_ma=None, stage=None, pre_time=0.02, post_time=0.2):
+    # Command the supply (as set_and_confirm()) while metashunt is
+    # streaming, and measure the step response from the samples recorded
+    # pre_time before to post_time after the command was sent, placed in
+    # host time through the MetaShunt's clock fit. Returns the
+    # step_response() dict plus the command's round trip time, or None if
+    # the command was not confirmed.
+    position = metashunt.stream_position()
+    time.sleep(pre_time)
+    reported_ma = supply.set_and_confirm(stage=stage, current_ma=current_ma)
+    if reported_ma is None:
+        return None
+    (send_time, reply_time) = supply.last_command_time
+    # Wait until samples taken post_time after the command have arrived
+    end_time = send_time + post_time + 1.0
+    while metashunt.latest_host_time() < send_time + post_time and time.time() < end_time:
+        metashunt.wait_for_samples(1, post_time)
+    (host_time, samples_ma) = metashunt.get_samples_host(position)
+    (host_time, samples_ma) = cut_window(host_time, samples_ma, send_time - pre_time, send_time + post_time)
+    result = step_response(host_time, samples_ma, send_time)
+    result["reported_ma"] = reported_ma
+    result["round_trip_s"] = reply_time - send_time
+    return result
+
+def characterize_stages(supply, metashunt, pre_time=0.02, post_time=0.2, baseline_precision=1.0e-3):
+    # Step response into each supply stage from the bottom of stage 7, so
+    # settling times per stage can replace fixed waits. The baseline is
+    # held until measure_until() finds it settled before each step. In fixed reference
+    # mode each stage is commanded directly; in adjustable reference mode
+    # the step goes to the middle (in ratio) of the stage's current range.
+    # Returns stage -> measure_step() result.
+    fixed = supply.supply_type == pcs.CurrentSupplyType.FIXED_REFERENCE
+    results = {}
+    for stage in range(sm.NUM_STAGES - 1, -1, -1):
+        if fixed:
+            supply.set_and_confirm(stage=sm.NUM_STAGES - 1)
+            metashunt.measure_until(rel_precision=baseline_precision, max_time=1.0)
+            results[stage] = measure_step(supply, metashunt, stage=stage, pre_time=pre_time, post_time=post_time)
+        else:
+            i = sm.NUM_STAGES - 1 - stage
+            high_ma = sm.STAGE_LIMITS_MA[i]
+            low_ma = sm.STAGE_LIMITS_MA[i - 1] if i > 0 else high_ma * 0.1
+            supply.set_and_confirm(current_ma=sm.STAGE_LIMITS_MA[0] * 0.1)
+            metashunt.measure_until(rel_precision=baseline_precision, max_time=1.0)
+            results[stage] = measure_step(supply, metashunt, current_ma=float(np.sqrt(low_ma * high_ma)), pre_time=pre_time, post_time=post_time)
+    return results